@@ -32,4 +32,17 @@ inference_configs = {
     ),
     "num_workers": 16,
     "use_msa": True,
+    # featurize every input and run its trunk once for all seeds, only the diffusion
+    # and the confidence head run per seed
+    "multi_seed": False,
+    # with multi_seed, still run the trunk per seed (its MSA subsampling depends on the seed)
+    "trunk_per_seed": False,
+    # order the inputs largest first, choose the chunk sizes of every input from a memory
+    # model of the GPU and retry with smaller chunks when running out of memory
+    "schedule_by_size": False,
+    # share of the GPU memory the chunk sizes are chosen for
+    "scheduler_memory_fraction": 0.9,
+    # dir of the on-disk featurization cache, keyed by the input JSON and its MSA files,
+    # empty to featurize every input on every run
+    "feature_cache_dir": "",
 }
@@ -0,0 +1,158 @@
+# Copyright 2024 ByteDance and/or its affiliates.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import uuid
+from os.path import exists as opexists
+from os.path import join as opjoin
+from typing import Any, Mapping, Optional
+
+import numpy as np
+import torch
+from biotite.structure import AtomArray
+
+logger = logging.getLogger(__name__)
+
+# bump when the featurization changes, so that stale features are not reused
+FEATURE_CACHE_VERSION = 1
+META_FILE = "meta.pkl"
+
+
+def _hash_file(hasher: "hashlib._Hash", path: str) -> None:
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(block)
+
+
+class FeatureCache(object):
+    """
+    On-disk store of the outputs of InferenceDataset.process_one.
+
+    An entry is keyed by the hash of the input JSON dict and of the files its features are
+    read from (the a3m files of precomputed MSA dirs and ligand files). Every tensor is
+    saved as a .npy file and loaded memory-mapped (copy-on-write), so loading an entry
+    only reads the pages that are used. The AtomArray and the other values are pickled.
+    Entries are written to a temporary dir and renamed, readers never see a partial entry.
+    """
+
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(
+        single_sample_dict: Mapping[str, Any], use_msa: bool = True
+    ) -> Optional[str]:
+        """
+        Hash of a sample and of the files it is featurized from.
+
+        Args:
+            single_sample_dict (Mapping[str, Any]): one input of the inference JSON.
+            use_msa (bool): whether MSA features are made. Defaults to True.
+
+        Returns:
+            Optional[str]: the key, or None if the sample can not be cached because its
+                MSA is not precomputed yet.
+        """
+        hasher = hashlib.sha256()
+        hasher.update(
+            json.dumps(
+                [FEATURE_CACHE_VERSION, use_msa, single_sample_dict], sort_keys=True
+            ).encode()
+        )
+        for entity_dict in single_sample_dict["sequences"]:
+            for entity_type, entity in entity_dict.items():
+                if entity_type == "proteinChain" and use_msa:
+                    msa_dir = entity.get("msa", {}).get("precomputed_msa_dir")
+                    if msa_dir is None or not opexists(msa_dir):
+                        return None
+                    for fname in sorted(os.listdir(msa_dir)):
+                        if fname.endswith(".a3m"):
+                            hasher.update(fname.encode())
+                            _hash_file(hasher, opjoin(msa_dir, fname))
+                elif entity_type == "ligand" and entity["ligand"].startswith("FILE_"):
+                    _hash_file(hasher, entity["ligand"][5:])
+        return hasher.hexdigest()
+
+    def entry_dir(self, key: str) -> str:
+        return opjoin(self.cache_dir, key[:2], key)
+
+    def load(self, key: str) -> Optional[tuple[dict[str, Any], AtomArray]]:
+        """
+        Load the features and the AtomArray of key.
+
+        Returns:
+            Optional[tuple[dict[str, Any], AtomArray]]: None if there is no entry.
+        """
+        entry_dir = self.entry_dir(key)
+        if not opexists(opjoin(entry_dir, META_FILE)):
+            return None
+        with open(opjoin(entry_dir, META_FILE), "rb") as f:
+            meta = pickle.load(f)
+
+        def load_tensor(fname):
+            # copy-on-write, the pages are only read when used
+            return torch.from_numpy(np.load(opjoin(entry_dir, fname), mmap_mode="c"))
+
+        data = meta["values"]
+        data["input_feature_dict"] = {
+            name: load_tensor(f"input_feature_dict.{name}.npy")
+            for name in meta["input_feature_dict"]
+        }
+        data.update({name: load_tensor(f"{name}.npy") for name in meta["tensors"]})
+        return data, meta["atom_array"]
+
+    def save(self, key: str, data: Mapping[str, Any], atom_array: AtomArray) -> None:
+        """Save the output of InferenceDataset.process_one under key."""
+        entry_dir = self.entry_dir(key)
+        if opexists(entry_dir):
+            return
+        tmp_dir = f"{entry_dir}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(tmp_dir)
+        try:
+            meta = {
+                "input_feature_dict": [],
+                "tensors": [],
+                "values": {},
+                "atom_array": atom_array,
+            }
+            for name, value in data["input_feature_dict"].items():
+                np.save(
+                    opjoin(tmp_dir, f"input_feature_dict.{name}.npy"),
+                    value.numpy(),
+                )
+                meta["input_feature_dict"].append(name)
+            for name, value in data.items():
+                if name == "input_feature_dict":
+                    continue
+                if isinstance(value, torch.Tensor):
+                    np.save(opjoin(tmp_dir, f"{name}.npy"), value.numpy())
+                    meta["tensors"].append(name)
+                else:
+                    meta["values"][name] = value
+            with open(opjoin(tmp_dir, META_FILE), "wb") as f:
+                pickle.dump(meta, f)
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                # written by another worker in the meantime
+                pass
+        finally:
+            if opexists(tmp_dir):
+                shutil.rmtree(tmp_dir)
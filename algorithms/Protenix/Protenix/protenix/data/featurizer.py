@@ -60,16 +60,17 @@ class Featurizer(object):
         Returns:
             torch.Tensor: A tensor representing the binary encoding of the input values.
         """
-        onehot_dict = {}
-        num_keys = len(encode_def_list)
-        for index, key in enumerate(encode_def_list):
-            onehot = [0] * num_keys
-            onehot[index] = 1
-            onehot_dict[key] = onehot
-
-        onehot_encoded_data = [onehot_dict[item] for item in input_list]
-        onehot_tensor = torch.Tensor(onehot_encoded_data)
-        return onehot_tensor
+        if len(input_list) == 0:
+            return torch.Tensor([])
+        # a key listed twice encodes as its last index
+        key_to_index = {key: index for index, key in enumerate(encode_def_list)}
+        # only the distinct values are looked up in Python
+        unique_items, inverse = np.unique(np.asarray(input_list), return_inverse=True)
+        indices = np.array([key_to_index[str(item)] for item in unique_items])[
+            inverse.reshape(-1)
+        ]
+        onehot = np.eye(len(encode_def_list), dtype=np.float32)[indices]
+        return torch.from_numpy(onehot)
 
     @staticmethod
     def restype_onehot_encoded(restype_list: list[str]) -> torch.Tensor:
@@ -117,21 +118,23 @@ class Featurizer(object):
         Returns:
             torch.Tensor:  A Tensor of character encoded atom names
         """
-        onehot_dict = {}
-        for index, key in enumerate(range(64)):
-            onehot = [0] * 64
-            onehot[index] = 1
-            onehot_dict[key] = onehot
+        if len(atom_names) == 0:
+            return torch.Tensor([])
+        names = np.asarray(atom_names, dtype=str)
+        lengths = np.char.str_len(names)
+        if lengths.max() > 4:
+            raise ValueError(
+                f"Atom names longer than 4 characters: {names[lengths > 4][:5].tolist()}"
+            )
+        names = np.char.ljust(names, 4).astype("U4")
+        # [N_atom, 4] character codes, through a view of the code points of the names
+        codes = names.view(np.uint32).reshape(len(names), 4).astype(int) - 32
+        if codes.min() < 0 or codes.max() >= 64:
+            invalid = names[((codes < 0) | (codes >= 64)).any(axis=-1)]
+            raise KeyError(f"Atom names can not be encoded: {invalid[:5].tolist()}")
         # [N_atom, 4, 64]
-        mol_encode = []
-        for atom_name in atom_names:
-            # [4, 64]
-            atom_encode = []
-            for name_str in atom_name.ljust(4):
-                atom_encode.append(onehot_dict[ord(name_str) - 32])
-            mol_encode.append(atom_encode)
-        onehot_tensor = torch.Tensor(mol_encode)
-        return onehot_tensor
+        onehot = np.eye(64, dtype=np.float32)[codes]
+        return torch.from_numpy(onehot)
 
     @staticmethod
     def get_prot_nuc_frame(token: Token, centre_atom: Atom) -> tuple[int, list[int]]:
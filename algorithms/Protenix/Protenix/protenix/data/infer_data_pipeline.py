@@ -17,13 +17,14 @@ import logging
 import time
 import traceback
 import warnings
-from typing import Any, Mapping
+from typing import Any, Mapping, Optional
 
 import torch
 from biotite.structure import AtomArray
 from torch.utils.data import DataLoader, Dataset, DistributedSampler
 
 from protenix.data.data_pipeline import DataPipeline
+from protenix.data.feature_cache import FeatureCache
 from protenix.data.json_to_feature import SampleDictToFeatures
 from protenix.data.msa_featurizer import InferenceMSAFeaturizer
 from protenix.data.utils import data_type_transform, make_dummy_feature
@@ -49,6 +50,7 @@ def get_inference_dataloader(configs: Any) -> DataLoader:
         input_json_path=configs.input_json_path,
         dump_dir=configs.dump_dir,
         use_msa=configs.use_msa,
+        feature_cache_dir=configs.feature_cache_dir or None,
     )
     sampler = DistributedSampler(
         dataset=inference_dataset,
@@ -72,11 +74,15 @@ class InferenceDataset(Dataset):
         input_json_path: str,
         dump_dir: str,
         use_msa: bool = True,
+        feature_cache_dir: Optional[str] = None,
     ) -> None:
 
         self.input_json_path = input_json_path
         self.dump_dir = dump_dir
         self.use_msa = use_msa
+        self.feature_cache = (
+            FeatureCache(feature_cache_dir) if feature_cache_dir is not None else None
+        )
         with open(self.input_json_path, "r") as f:
             self.inputs = json.load(f)
 
@@ -206,11 +212,27 @@ class InferenceDataset(Dataset):
         try:
             single_sample_dict = self.inputs[index]
             sample_name = single_sample_dict["name"]
-            logger.info(f"Featurizing {sample_name}...")
-
-            data, atom_array, _ = self.process_one(
-                single_sample_dict=single_sample_dict
+            cache_key = (
+                FeatureCache.key(single_sample_dict, self.use_msa)
+                if self.feature_cache is not None
+                else None
             )
+            cached = self.feature_cache.load(cache_key) if cache_key else None
+            if cached is not None:
+                logger.info(f"Loading cached features of {sample_name}...")
+                data, atom_array = cached
+            else:
+                logger.info(f"Featurizing {sample_name}...")
+                data, atom_array, _ = self.process_one(
+                    single_sample_dict=single_sample_dict
+                )
+                if cache_key:
+                    try:
+                        self.feature_cache.save(cache_key, data, atom_array)
+                    except Exception as e:
+                        logger.warning(
+                            f"Can not cache the features of {sample_name}: {e}"
+                        )
             error_message = ""
         except Exception as e:
             data, atom_array = {}, None
@@ -15,8 +15,10 @@
 import logging
 from typing import Optional
 
+import numpy as np
 import torch
 import torch.nn as nn
+from scipy.spatial import cKDTree
 
 from protenix.data.constants import rdkit_vdws
 
@@ -30,6 +32,34 @@ def get_vdw_radii(elements_one_hot):
     return RDKIT_VDWS.to(element_order.device)[element_order]
 
 
+def find_close_atom_pairs(pred_coordinate, cutoff):
+    """Find the atom pairs closer than cutoff in every sample with a single KD-tree.
+
+    The samples are laid out side by side along x, further than cutoff apart, so one
+    tree query covers the whole batch and never pairs atoms of different samples.
+
+    Args:
+        pred_coordinate (torch.Tensor): [N_sample, N_atom, 3]
+        cutoff (float): distance cutoff
+
+    Returns:
+        tuple of torch.LongTensor: sample index, first and second atom index of
+            each pair (first < second), each of shape [N_pair]
+    """
+    N_sample, N_atom, _ = pred_coordinate.shape
+    device = pred_coordinate.device
+    coords = pred_coordinate.detach().cpu().double().numpy().copy()
+    if N_atom == 0:
+        empty = torch.zeros(0, dtype=torch.long, device=device)
+        return empty, empty, empty
+    x_extent = coords[..., 0].max() - coords[..., 0].min()
+    coords[..., 0] += np.arange(N_sample)[:, None] * (x_extent + 2 * cutoff + 1.0)
+
+    pairs = cKDTree(coords.reshape(-1, 3)).query_pairs(r=cutoff, output_type="ndarray")
+    pairs = torch.from_numpy(pairs.astype(np.int64)).to(device)
+    return pairs[:, 0] // N_atom, pairs[:, 0] % N_atom, pairs[:, 1] % N_atom
+
+
 class Clash(nn.Module):
     def __init__(
         self,
@@ -179,85 +209,116 @@ class Clash(nn.Module):
         asym_id_to_mol_id: Optional[torch.Tensor] = None,
     ):
         device = pred_coordinate.device
-        N_sample = pred_coordinate.shape[0]
+        N_sample, N_atom, _ = pred_coordinate.shape
+        N_pairs = N_sample * N_chains * N_chains
 
-        # initialize results
-        if self.compute_af3_clash:
-            has_af3_clash_flag = torch.zeros(
-                N_sample, N_chains, N_chains, device=device, dtype=torch.bool
+        # chain of every atom and the chain pairs (i < j) each check applies to
+        atom_asym_id = torch.stack(
+            [asym_id_to_asym_mask[aid] for aid in range(N_chains)]
+        ).long().argmax(dim=0)[atom_to_token_idx].to(device)
+        is_known = torch.tensor([t != "UNK" for t in chain_types], device=device)
+        is_lig = torch.tensor([t == "lig" for t in chain_types], device=device)
+        upper = torch.ones(N_chains, N_chains, dtype=torch.bool, device=device).triu(1)
+        known_pair_mask = upper & is_known[:, None] & is_known[None, :]
+        # AF3 clash only consider polymer chains
+        polymer_pair_mask = known_pair_mask & ~is_lig[:, None] & ~is_lig[None, :]
+
+        skipped_pairs = []
+        vdw_pair_mask = known_pair_mask.clone()
+        if self.compute_vdw_clash:
+            # Skip potential bonded ligand to polymers
+            chain_mol_id = torch.tensor(
+                [asym_id_to_mol_id[aid] for aid in range(N_chains)], device=device
             )
-            af3_clash_details = torch.zeros(
-                N_sample, N_chains, N_chains, 2, device=device, dtype=torch.bool
+            bonded_pair_mask = (
+                known_pair_mask
+                & (is_lig[:, None] != is_lig[None, :])
+                & (chain_mol_id[:, None] == chain_mol_id[None, :])
             )
+            for i, j in bonded_pair_mask.nonzero().tolist():
+                logging.warning(
+                    f"mol_id {asym_id_to_mol_id[i]} may contain bonded ligand to polymers"
+                )
+                skipped_pairs.append((i, j))
+            vdw_pair_mask &= ~bonded_pair_mask
+            # reported once per sample
+            skipped_pairs = skipped_pairs * N_sample
+
+        # only atom pairs within the largest clash distance are ever looked at
+        cutoff = 0.0
+        if self.compute_af3_clash:
+            cutoff = self.af3_clash_threshold
+        if self.compute_vdw_clash:
+            vdw_radii = get_vdw_radii(elements_one_hot).to(device)
+            cutoff = max(cutoff, self.vdw_clash_threshold * 2 * vdw_radii.max().item())
+        sample_idx, atom_1, atom_2 = find_close_atom_pairs(pred_coordinate, cutoff + 1e-3)
+
+        # orient every pair as (atom of chain i, atom of chain j) with i <= j
+        chain_1, chain_2 = atom_asym_id[atom_1], atom_asym_id[atom_2]
+        swap = chain_1 > chain_2
+        atom_1, atom_2 = torch.where(swap, atom_2, atom_1), torch.where(swap, atom_1, atom_2)
+        chain_1, chain_2 = torch.where(swap, chain_2, chain_1), torch.where(swap, chain_1, chain_2)
+        pair_dist = torch.linalg.norm(
+            pred_coordinate[sample_idx, atom_1] - pred_coordinate[sample_idx, atom_2],
+            dim=-1,
+        )
+        # flat index of (sample_id, i, j) into [N_sample, N_chains, N_chains]
+        flat_idx = (sample_idx * N_chains + chain_1) * N_chains + chain_2
+
+        if self.compute_af3_clash:
+            is_af3_clash = (pair_dist < self.af3_clash_threshold) & polymer_pair_mask[
+                chain_1, chain_2
+            ]
+            total_clash = torch.bincount(
+                flat_idx[is_af3_clash], minlength=N_pairs
+            ).reshape(N_sample, N_chains, N_chains)
+            N_chain_atoms = torch.bincount(atom_asym_id, minlength=N_chains)
+            relative_clash = total_clash / torch.minimum(
+                N_chain_atoms[:, None], N_chain_atoms[None, :]
+            ).clamp(min=1)
+            has_af3_clash_flag = (
+                (total_clash > 100) | (relative_clash > 0.5)
+            ) & polymer_pair_mask
+            has_af3_clash_flag = has_af3_clash_flag | has_af3_clash_flag.transpose(1, 2)
+            af3_clash_details = torch.stack((total_clash > 0, relative_clash > 0), dim=-1)
+            af3_clash_details = af3_clash_details | af3_clash_details.transpose(1, 2)
+
         if self.compute_vdw_clash:
-            has_vdw_clash_flag = torch.zeros(
-                N_sample, N_chains, N_chains, device=device, dtype=torch.bool
+            relative_vdw_distance = pair_dist / (vdw_radii[atom_1] + vdw_radii[atom_2])
+            is_vdw_clash = (
+                relative_vdw_distance < self.vdw_clash_threshold
+            ) & vdw_pair_mask[chain_1, chain_2]
+            has_vdw_clash_flag = (
+                torch.bincount(flat_idx[is_vdw_clash], minlength=N_pairs) > 0
+            ).reshape(N_sample, N_chains, N_chains)
+            has_vdw_clash_flag = has_vdw_clash_flag | has_vdw_clash_flag.transpose(1, 2)
+
+            # [N_clash, 3] (atom of chain i, atom of chain j, relative distance) per
+            # (sample_id, i, j), rows sorted by atom index as a dense scan would give
+            clash_idx = torch.nonzero(is_vdw_clash).squeeze(-1)
+            for key in (atom_2, atom_1, flat_idx):
+                order = torch.sort(key[clash_idx], stable=True).indices
+                clash_idx = clash_idx[order]
+            clash_atom_pairs = torch.stack(
+                (
+                    atom_1[clash_idx].to(relative_vdw_distance.dtype),
+                    atom_2[clash_idx].to(relative_vdw_distance.dtype),
+                    relative_vdw_distance[clash_idx],
+                ),
+                dim=-1,
+            )
+            clash_keys, clash_counts = torch.unique_consecutive(
+                flat_idx[clash_idx], return_counts=True
             )
             vdw_clash_details = {}
+            for key, pairs in zip(
+                clash_keys.tolist(),
+                torch.split(clash_atom_pairs, clash_counts.tolist()),
+            ):
+                sample_id, chain_pair = divmod(key, N_chains * N_chains)
+                i, j = divmod(chain_pair, N_chains)
+                vdw_clash_details[(sample_id, i, j)] = pairs
 
-        skipped_pairs = []
-        for sample_id in range(N_sample):
-            for i in range(N_chains):
-                if chain_types[i] == "UNK":
-                    continue
-                atom_chain_mask_i = asym_id_to_asym_mask[i][atom_to_token_idx]
-                N_chain_i = torch.sum(atom_chain_mask_i).item()
-                for j in range(i + 1, N_chains):
-                    if chain_types[j] == "UNK":
-                        continue
-                    chain_pair_type = set([chain_types[i], chain_types[j]])
-                    # Skip potential bonded ligand to polymers
-                    skip_bonded_ligand = False
-                    if (
-                        self.compute_vdw_clash
-                        and "lig" in chain_pair_type
-                        and len(chain_pair_type) > 1
-                        and asym_id_to_mol_id[i] == asym_id_to_mol_id[j]
-                    ):
-                        common_mol_id = asym_id_to_mol_id[i]
-                        logging.warning(
-                            f"mol_id {common_mol_id} may contain bonded ligand to polymers"
-                        )
-                        skip_bonded_ligand = True
-                        skipped_pairs.append((i, j))
-                    atom_chain_mask_j = asym_id_to_asym_mask[j][atom_to_token_idx]
-                    N_chain_j = torch.sum(atom_chain_mask_j).item()
-                    if self.compute_vdw_clash and not skip_bonded_ligand:
-                        vdw_clash_pairs = self.get_chain_pair_violations(
-                            pred_coordinate=pred_coordinate[sample_id, :, :],
-                            violation_type="vdw",
-                            chain_1_mask=atom_chain_mask_i,
-                            chain_2_mask=atom_chain_mask_j,
-                            elements_one_hot=elements_one_hot,
-                        )
-                        if vdw_clash_pairs.shape[0] > 0:
-                            vdw_clash_details[(sample_id, i, j)] = vdw_clash_pairs
-                            has_vdw_clash_flag[sample_id, i, j] = True
-                            has_vdw_clash_flag[sample_id, j, i] = True
-                    if (
-                        chain_types[i] == "lig" or chain_types[j] == "lig"
-                    ):  # AF3 clash only consider polymer chains
-                        continue
-                    if self.compute_af3_clash:
-                        af3_clash_pairs = self.get_chain_pair_violations(
-                            pred_coordinate=pred_coordinate[sample_id, :, :],
-                            violation_type="af3",
-                            chain_1_mask=atom_chain_mask_i,
-                            chain_2_mask=atom_chain_mask_j,
-                        )
-                        total_clash = af3_clash_pairs.shape[0]
-                        relative_clash = total_clash / min(N_chain_i, N_chain_j)
-                        af3_clash_details[sample_id, i, j, 0] = total_clash
-                        af3_clash_details[sample_id, i, j, 1] = relative_clash
-                        has_af3_clash_flag[sample_id, i, j] = (
-                            total_clash > 100 or relative_clash > 0.5
-                        )
-                        af3_clash_details[sample_id, j, i, :] = af3_clash_details[
-                            sample_id, i, j, :
-                        ]
-                        has_af3_clash_flag[sample_id, j, i] = has_af3_clash_flag[
-                            sample_id, i, j
-                        ]
         return {
             "summary": {
                 "af3_clash": has_af3_clash_flag if self.compute_af3_clash else None,
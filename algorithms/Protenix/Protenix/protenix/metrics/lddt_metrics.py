@@ -14,8 +14,10 @@
 
 from typing import Optional
 
+import numpy as np
 import torch
 import torch.nn as nn
+from scipy.spatial import cKDTree
 
 from protenix.model import sample_confidence
 
@@ -75,7 +77,8 @@ class LDDTMetrics(nn.Module):
                 coordinate: [N_sample, N_atom, 3]
             label_dict (Dict): a dictionary containing
                 coordinate: [N_sample, N_atom, 3]
-                lddt_mask: [N_atom, N_atom]
+                lddt_pair_index: [N_pair, 2], used if present (see LDDT.compute_lddt_pair_index)
+                lddt_mask: [N_atom, N_atom], used otherwise
         """
 
         out = {}
@@ -84,7 +87,8 @@ class LDDTMetrics(nn.Module):
         lddt = self.lddt_base.forward(
             pred_coordinate=pred_dict["coordinate"],
             true_coordinate=label_dict["coordinate"],
-            lddt_mask=label_dict["lddt_mask"],
+            lddt_mask=label_dict.get("lddt_mask"),
+            lddt_pair_index=label_dict.get("lddt_pair_index"),
             chunk_size=self.chunk_size,
         )  # [N_sample]
         out["complex"] = lddt
@@ -210,8 +214,9 @@ class LDDT(nn.Module):
         self,
         pred_coordinate: torch.Tensor,
         true_coordinate: torch.Tensor,
-        lddt_mask: torch.Tensor,
+        lddt_mask: Optional[torch.Tensor] = None,
         chunk_size: Optional[int] = None,
+        lddt_pair_index: Optional[torch.Tensor] = None,
     ) -> dict[str, torch.Tensor]:
         """LDDT: evaluated on complex, chains and interfaces
         sparse implementation, which largely reduce cuda memory when atom num reaches 10^4 +
@@ -221,8 +226,10 @@ class LDDT(nn.Module):
                 [N_sample, N_atom, 3]
             true_coordinate (torch.Tensor): the ground truth atom coordinates
                 [N_atom, 3]
-            lddt_mask (torch.Tensor):
-                sparse version of [N_atom, N_atom] atompair mask based on bespoke radius of true distance
+            lddt_mask (torch.Tensor, optional):
+                [N_atom, N_atom] atompair mask based on bespoke radius of true distance
+            lddt_pair_index (torch.Tensor, optional):
+                sparse version of lddt_mask given by compute_lddt_pair_index, used instead of it
                 [N_nonzero_mask, 2]
 
         Returns:
@@ -230,9 +237,10 @@ class LDDT(nn.Module):
                 "best": [N_eval]
                 "worst": [N_eval]
         """
-        lddt_indices = torch.nonzero(lddt_mask, as_tuple=True)
-        l_index = lddt_indices[0]
-        m_index = lddt_indices[1]
+        if lddt_pair_index is None:
+            lddt_pair_index = torch.nonzero(lddt_mask)
+        l_index = lddt_pair_index[:, 0]
+        m_index = lddt_pair_index[:, 1]
         pred_distance_sparse_lm, true_distance_sparse_lm = self._calc_sparse_dist(
             pred_coordinate, true_coordinate, l_index, m_index
         )
@@ -242,36 +250,73 @@ class LDDT(nn.Module):
         return group_lddt
 
     @staticmethod
-    def compute_lddt_mask(
+    def compute_lddt_pair_index(
         true_coordinate: torch.Tensor,
         true_coordinate_mask: torch.Tensor,
         is_nucleotide: torch.Tensor = None,
         is_nucleotide_threshold: float = 30.0,
-        threshold: float = 15.0,
-    ):
-        # Distance mask
-        distance_mask = (
-            true_coordinate_mask[..., None] * true_coordinate_mask[..., None, :]
-        )
-        # Distances for all atom pairs
-        # Note: we convert to bf16 for saving cuda memory, if performance drops, do not convert it
-        distance = (torch.cdist(true_coordinate, true_coordinate) * distance_mask).to(
-            true_coordinate.dtype
-        )  # [..., N_atom, N_atom]
-
-        # Local mask
-        c_lm = distance < threshold  # [..., N_atom, N_atom]
-        if is_nucleotide is not None:
-            # Use a different radius for nucleotide
-            is_nucleotide_mask = is_nucleotide.bool()[..., None]
-            c_lm = (distance < is_nucleotide_threshold) * is_nucleotide_mask + c_lm * (
-                ~is_nucleotide_mask
+        is_not_nucleotide_threshold: float = 15.0,
+    ) -> torch.Tensor:
+        """indices of the atom pair mask with the bespoke radius
+
+        Pairs are found with KD-tree radius queries, so memory scales with the
+        number of pairs instead of N_atom^2. Same pairs as torch.nonzero on the dense
+        mask of protenix.model.loss.compute_lddt_mask.
+
+        Args:
+            true_coordinate (torch.Tensor): the ground truth atom coordinates
+                [N_atom, 3]
+            true_coordinate_mask (torch.Tensor): whether true coordinates exist
+                [N_atom]
+            is_nucleotide (torch.Tensor, optional): Indicator for nucleotide atoms.
+                [N_atom]
+            is_nucleotide_threshold (float): radius for pairs (l, m) with l a nucleotide atom. Defaults to 30.0.
+            is_not_nucleotide_threshold (float): radius for other pairs. Defaults to 15.0.
+
+        Returns:
+            torch.Tensor: indices (l, m) of the nonzero entries of the [N_atom, N_atom] mask,
+                l != m and both with true coordinates, in the order of torch.nonzero
+                [N_nonzero_mask, 2]
+        """
+        device = true_coordinate.device
+        N_atom = true_coordinate.shape[-2]
+        coords = true_coordinate.detach().cpu().double().numpy()
+        has_coord = true_coordinate_mask.bool().cpu().numpy()
+        if is_nucleotide is None:
+            is_nucleotide = torch.zeros_like(true_coordinate_mask, dtype=torch.bool)
+        is_nucleotide = is_nucleotide.bool().to(device)
+        is_nuc = is_nucleotide.cpu().numpy()
+
+        # Candidate pairs within the radius of their first atom
+        col_index = np.flatnonzero(has_coord)
+        col_tree = cKDTree(coords[col_index])
+        pair_index = [np.zeros((0, 2), dtype=np.int64)]
+        for row_mask, radius in [
+            (has_coord & is_nuc, is_nucleotide_threshold),
+            (has_coord & ~is_nuc, is_not_nucleotide_threshold),
+        ]:
+            row_index = np.flatnonzero(row_mask)
+            if len(row_index) == 0:
+                continue
+            pairs = cKDTree(coords[row_index]).sparse_distance_matrix(
+                col_tree, radius + 1e-3, output_type="ndarray"
             )
+            pair_index.append(
+                np.stack([row_index[pairs["i"]], col_index[pairs["j"]]], axis=-1)
+            )
+        pair_index = np.concatenate(pair_index)
+        pair_index = torch.from_numpy(pair_index.astype(np.int64)).to(device)
+        l_index, m_index = pair_index[:, 0], pair_index[:, 1]
 
-        # Zero-out diagonals of c_lm and cast to float
-        c_lm = c_lm * (
-            1 - torch.eye(n=c_lm.size(-1), device=c_lm.device, dtype=distance.dtype)
+        # Exact radius test on the true distances, zero-out diagonals
+        distance = torch.norm(
+            true_coordinate[l_index] - true_coordinate[m_index], p=2, dim=-1
+        )
+        radius = torch.where(
+            is_nucleotide[l_index], is_nucleotide_threshold, is_not_nucleotide_threshold
         )
-        # Zero-out atom pairs without true coordinates
-        c_lm = c_lm * distance_mask  # [..., N_atom, N_atom]
-        return c_lm
+        pair_index = pair_index[(distance < radius) & (l_index != m_index)]
+
+        # Row-major order, as torch.nonzero on the dense mask
+        order = torch.argsort(pair_index[:, 0] * N_atom + pair_index[:, 1])
+        return pair_index[order]
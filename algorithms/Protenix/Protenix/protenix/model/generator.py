@@ -170,6 +170,18 @@ def sample_diffusion(
     dtype = s_inputs.dtype
 
     def _chunk_sample_diffusion(chunk_n_sample, inplace_safe):
+        # The conditioning does not depend on the noise level, compute it once for all steps
+        conditioning = None
+        if hasattr(denoise_net, "prepare_conditioning"):
+            conditioning = denoise_net.prepare_conditioning(
+                input_feature_dict=input_feature_dict,
+                s_inputs=s_inputs,
+                s_trunk=s_trunk,
+                z_trunk=z_trunk,
+                N_sample=chunk_n_sample,
+                inplace_safe=inplace_safe,
+            )
+
         # init noise
         # [..., N_sample, N_atom, 3]
         x_l = noise_schedule[0] * torch.randn(
@@ -213,6 +225,7 @@ def sample_diffusion(
                 z_trunk=z_trunk,
                 chunk_size=attn_chunk_size,
                 inplace_safe=inplace_safe,
+                conditioning=conditioning,
             )
 
             delta = (x_noisy - x_denoised) / t_hat[
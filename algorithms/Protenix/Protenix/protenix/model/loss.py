@@ -19,6 +19,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from protenix.metrics.lddt_metrics import LDDT
 from protenix.metrics.rmsd import weighted_rigid_align
 from protenix.model.modules.frames import (
     expressCoordinatesInFrame,
@@ -149,8 +150,9 @@ class SmoothLDDTLoss(nn.Module):
         self,
         pred_coordinate: torch.Tensor,
         true_coordinate: torch.Tensor,
-        lddt_mask: torch.Tensor,
+        lddt_mask: Optional[torch.Tensor] = None,
         diffusion_chunk_size: Optional[int] = None,
+        lddt_pair_index: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
         """SmoothLDDTLoss sparse implementation
 
@@ -162,12 +164,17 @@ class SmoothLDDTLoss(nn.Module):
             lddt_mask (torch.Tensor, optional): whether true distance is within radius (30A for nuc and 15A for others)
                 [N_atom, N_atom]
             diffusion_chunk_size (Optional[int]): Chunk size over the N_sample dimension. Defaults to None.
+            lddt_pair_index (torch.Tensor, optional): indices of the nonzero entries of lddt_mask, used instead of it
+                [N_pair, 2]
 
         Returns:
             torch.Tensor: the smooth lddt loss
                 [...] if reduction is None else []
         """
-        lddt_indices = torch.nonzero(lddt_mask, as_tuple=True)
+        if lddt_pair_index is None:
+            lddt_indices = torch.nonzero(lddt_mask, as_tuple=True)
+        else:
+            lddt_indices = lddt_pair_index.unbind(dim=-1)
         true_coords_l = true_coordinate.index_select(-2, lddt_indices[0])
         true_coords_m = true_coordinate.index_select(-2, lddt_indices[1])
         true_distance_sparse_lm = torch.norm(true_coords_l - true_coords_m, p=2, dim=-1)
@@ -1439,12 +1446,31 @@ class ProtenixLoss(nn.Module):
                     [..., N_atom, N_atom]
                 distance_mask (torch.Tensor): atom-atom mask indicating whether true distance exists.
                     [..., N_atom, N_atom]
+                lddt_mask (torch.Tensor): atom pair mask with the bespoke radius.
+                    [..., N_atom, N_atom]
+                lddt_pair_index (torch.Tensor): instead of lddt_mask, if the smooth lddt loss is sparse.
+                    [N_pair, 2]
         """
         # Distance mask
         distance_mask = (
             label_dict["coordinate_mask"][..., None]
             * label_dict["coordinate_mask"][..., None, :]
         )
+        is_nucleotide = feat_dict["is_rna"].bool() + feat_dict["is_dna"].bool()
+        if (
+            self.configs.loss.diffusion_sparse_loss_enable
+            and not self.configs.loss.diffusion_lddt_loss_dense
+        ):
+            # Neither the losses nor the lddt metrics need dense distances,
+            # only the indices of the lddt mask (from a KD-tree search)
+            label_dict["lddt_pair_index"] = LDDT.compute_lddt_pair_index(
+                true_coordinate=label_dict["coordinate"],
+                true_coordinate_mask=label_dict["coordinate_mask"],
+                is_nucleotide=is_nucleotide,
+                **self.lddt_radius,
+            )
+            label_dict["distance_mask"] = distance_mask
+            return label_dict
         # Distances for all atom pairs
         # Note: we convert to bf16 for saving cuda memory, if performance drops, do not convert it
         distance = (
@@ -1456,7 +1482,7 @@ class ProtenixLoss(nn.Module):
         lddt_mask = compute_lddt_mask(
             true_distance=distance,
             distance_mask=distance_mask,
-            is_nucleotide=feat_dict["is_rna"].bool() + feat_dict["is_dna"].bool(),
+            is_nucleotide=is_nucleotide,
             **self.lddt_radius,
         )
 
@@ -1595,8 +1621,9 @@ class ProtenixLoss(nn.Module):
                         "smooth_lddt_loss": lambda: self.smooth_lddt_loss.sparse_forward(
                             pred_coordinate=pred_dict["coordinate"],
                             true_coordinate=label_dict["coordinate"],
-                            lddt_mask=label_dict["lddt_mask"],
+                            lddt_mask=label_dict.get("lddt_mask"),
                             diffusion_chunk_size=self.configs.loss.diffusion_lddt_chunk_size,
+                            lddt_pair_index=label_dict.get("lddt_pair_index"),
                         )
                     }
                 )
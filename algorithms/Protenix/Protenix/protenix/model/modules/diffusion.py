@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Optional, Union
+from typing import Any, Optional, Union
 
 import torch
 import torch.nn as nn
@@ -81,19 +81,17 @@ class DiffusionConditioning(nn.Module):
         self.transition_s2 = Transition(c_in=self.c_s, n=2)
         print(f"Diffusion Module has {self.sigma_data}")
 
-    def forward(
+    def prepare_conditioning(
         self,
-        t_hat_noise_level: torch.Tensor,
         input_feature_dict: dict[str, Union[torch.Tensor, int, float, dict]],
         s_inputs: torch.Tensor,
         s_trunk: torch.Tensor,
         z_trunk: torch.Tensor,
         inplace_safe: bool = False,
-    ) -> tuple[torch.Tensor, torch.Tensor]:
-        """
+    ) -> dict[str, torch.Tensor]:
+        """The noise-level independent part of forward (Line1-Line7)
+
         Args:
-            t_hat_noise_level (torch.Tensor): the noise level
-                [..., N_sample]
             input_feature_dict (dict[str, Union[torch.Tensor, int, float, dict]]): input meta feature dict
             s_inputs (torch.Tensor): single embedding from InputFeatureEmbedder
                 [..., N_tokens, c_s_inputs]
@@ -103,9 +101,9 @@ class DiffusionConditioning(nn.Module):
                 [..., N_tokens, N_tokens, c_z]
             inplace_safe (bool): Whether it is safe to use inplace operations.
         Returns:
-            tuple[torch.Tensor, torch.Tensor]: embeddings s and z
-                - s (torch.Tensor): [..., N_sample, N_tokens, c_s]
-                - z (torch.Tensor): [..., N_tokens, N_tokens, c_z]
+            dict[str, torch.Tensor]: conditioning for forward
+                - pair_z (torch.Tensor): [..., N_tokens, N_tokens, c_z]
+                - single_s (torch.Tensor): [..., N_tokens, c_s], before adding the noise embedding
         """
         # Pair conditioning
         pair_z = torch.cat(
@@ -123,6 +121,47 @@ class DiffusionConditioning(nn.Module):
             tensors=[s_trunk, s_inputs], dim=-1
         )  # [..., N_tokens, c_s + c_s_inputs]
         single_s = self.linear_no_bias_s(self.layernorm_s(single_s))
+        return {"pair_z": pair_z, "single_s": single_s}
+
+    def forward(
+        self,
+        t_hat_noise_level: torch.Tensor,
+        input_feature_dict: dict[str, Union[torch.Tensor, int, float, dict]],
+        s_inputs: torch.Tensor,
+        s_trunk: torch.Tensor,
+        z_trunk: torch.Tensor,
+        inplace_safe: bool = False,
+        conditioning: Optional[dict[str, torch.Tensor]] = None,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            t_hat_noise_level (torch.Tensor): the noise level
+                [..., N_sample]
+            input_feature_dict (dict[str, Union[torch.Tensor, int, float, dict]]): input meta feature dict
+            s_inputs (torch.Tensor): single embedding from InputFeatureEmbedder
+                [..., N_tokens, c_s_inputs]
+            s_trunk (torch.Tensor): single feature embedding from PairFormer (Alg17)
+                [..., N_tokens, c_s]
+            z_trunk (torch.Tensor): pair feature embedding from PairFormer (Alg17)
+                [..., N_tokens, N_tokens, c_z]
+            inplace_safe (bool): Whether it is safe to use inplace operations.
+            conditioning (Optional[dict[str, torch.Tensor]]): output of prepare_conditioning for the same
+                inputs, computed once for all noise levels. Computed here if None.
+        Returns:
+            tuple[torch.Tensor, torch.Tensor]: embeddings s and z
+                - s (torch.Tensor): [..., N_sample, N_tokens, c_s]
+                - z (torch.Tensor): [..., N_tokens, N_tokens, c_z]
+        """
+        if conditioning is None:
+            conditioning = self.prepare_conditioning(
+                input_feature_dict=input_feature_dict,
+                s_inputs=s_inputs,
+                s_trunk=s_trunk,
+                z_trunk=z_trunk,
+                inplace_safe=inplace_safe,
+            )
+        pair_z = conditioning["pair_z"]
+        single_s = conditioning["single_s"]
         noise_n = self.fourier_embedding(
             t_hat_noise_level=torch.log(input=t_hat_noise_level / self.sigma_data) / 4
         ).to(
@@ -327,6 +366,52 @@ class DiffusionModule(nn.Module):
         if initialization.get("zero_init_dit_output", False):
             nn.init.zeros_(self.atom_attention_decoder.linear_no_bias_out.weight)
 
+    def prepare_conditioning(
+        self,
+        input_feature_dict: dict[str, Union[torch.Tensor, int, float, dict]],
+        s_inputs: torch.Tensor,
+        s_trunk: torch.Tensor,
+        z_trunk: torch.Tensor,
+        N_sample: int,
+        inplace_safe: bool = False,
+    ) -> dict[str, Any]:
+        """Computes the step-invariant tensors of f_forward once, before the denoising loop.
+        These are the pair and single conditioning of DiffusionConditioning (without the noise embedding)
+        and the atom single/pair conditioning c_l, p_lm of AtomAttentionEncoder.
+        Passing the result to forward/f_forward gives the same outputs as computing them at every step.
+
+        Args:
+            input_feature_dict (dict[str, Union[torch.Tensor, int, float, dict]]): input feature
+            s_inputs (torch.Tensor): single embedding from InputFeatureEmbedder
+                [..., N_tokens, c_s_inputs]
+            s_trunk (torch.Tensor): single feature embedding from PairFormer (Alg17)
+                [..., N_tokens, c_s]
+            z_trunk (torch.Tensor): pair feature embedding from PairFormer (Alg17)
+                [..., N_tokens, N_tokens, c_z]
+            N_sample (int): number of samples denoised together
+            inplace_safe (bool): Whether it is safe to use inplace operations. Defaults to False.
+
+        Returns:
+            dict[str, Any]: the conditioning for f_forward
+        """
+        conditioning = self.diffusion_conditioning.prepare_conditioning(
+            input_feature_dict=input_feature_dict,
+            s_inputs=s_inputs,
+            s_trunk=s_trunk,
+            z_trunk=z_trunk,
+            inplace_safe=inplace_safe,
+        )
+        conditioning["N_sample"] = N_sample
+        conditioning["atom_encoder"] = (
+            self.atom_attention_encoder.prepare_conditioning(
+                input_feature_dict=input_feature_dict,
+                s=expand_at_dim(s_trunk, dim=-3, n=N_sample),
+                z=expand_at_dim(conditioning["pair_z"], dim=-4, n=N_sample),
+                inplace_safe=inplace_safe,
+            )
+        )
+        return conditioning
+
     def f_forward(
         self,
         r_noisy: torch.Tensor,
@@ -337,6 +422,7 @@ class DiffusionModule(nn.Module):
         z_trunk: torch.Tensor,
         inplace_safe: bool = False,
         chunk_size: Optional[int] = None,
+        conditioning: Optional[dict[str, Any]] = None,
     ) -> torch.Tensor:
         """The raw network to be trained.
         As in EDM equation (7), this is F_theta(c_in * x, c_noise(sigma)).
@@ -356,6 +442,8 @@ class DiffusionModule(nn.Module):
                 [..., N_tokens, N_tokens, c_z]
             inplace_safe (bool): Whether it is safe to use inplace operations. Defaults to False.
             chunk_size (Optional[int]): Chunk size for memory-efficient operations. Defaults to None.
+            conditioning (Optional[dict[str, Any]]): output of prepare_conditioning for the same inputs and N_sample.
+                Defaults to None, which computes the conditioning in this call.
 
         Returns:
             torch.Tensor: coordinates update
@@ -363,6 +451,8 @@ class DiffusionModule(nn.Module):
         """
         N_sample = r_noisy.size(-3)
         assert t_hat_noise_level.size(-1) == N_sample
+        if conditioning is not None:
+            assert conditioning["N_sample"] == N_sample
 
         blocks_per_ckpt = self.blocks_per_ckpt
         if not torch.is_grad_enabled():
@@ -370,7 +460,17 @@ class DiffusionModule(nn.Module):
         # Conditioning, shared across difference samples
         # Diffusion_conditioning consumes 7-8G when token num is 768,
         # use checkpoint here if blocks_per_ckpt is not None.
-        if blocks_per_ckpt:
+        if conditioning is not None:
+            s_single, z_pair = self.diffusion_conditioning(
+                t_hat_noise_level=t_hat_noise_level,
+                input_feature_dict=input_feature_dict,
+                s_inputs=s_inputs,
+                s_trunk=s_trunk,
+                z_trunk=z_trunk,
+                inplace_safe=inplace_safe,
+                conditioning=conditioning,
+            )
+        elif blocks_per_ckpt:
             checkpoint_fn = get_checkpoint_fn()
             s_single, z_pair = checkpoint_fn(
                 self.diffusion_conditioning,
@@ -399,7 +499,17 @@ class DiffusionModule(nn.Module):
             z_pair, dim=-4, n=N_sample
         )  # [..., N_sample, N_token, N_token, c_z]
         # Fine-grained checkpoint for finetuning stage 2 (token num: 768) for avoiding OOM
-        if blocks_per_ckpt and self.use_fine_grained_checkpoint:
+        if conditioning is not None:
+            a_token, q_skip, c_skip, p_skip = self.atom_attention_encoder(
+                input_feature_dict=input_feature_dict,
+                r_l=r_noisy,
+                s=s_trunk,
+                z=z_pair,
+                inplace_safe=inplace_safe,
+                chunk_size=chunk_size,
+                conditioning=conditioning["atom_encoder"],
+            )
+        elif blocks_per_ckpt and self.use_fine_grained_checkpoint:
             checkpoint_fn = get_checkpoint_fn()
             a_token, q_skip, c_skip, p_skip = checkpoint_fn(
                 self.atom_attention_encoder,
@@ -476,6 +586,7 @@ class DiffusionModule(nn.Module):
         z_trunk: torch.Tensor,
         inplace_safe: bool = False,
         chunk_size: Optional[int] = None,
+        conditioning: Optional[dict[str, Any]] = None,
     ) -> torch.Tensor:
         """One step denoise: x_noisy, noise_level -> x_denoised
 
@@ -493,6 +604,7 @@ class DiffusionModule(nn.Module):
                 [..., N_tokens, N_tokens, c_z]
             inplace_safe (bool): Whether it is safe to use inplace operations. Defaults to False.
             chunk_size (Optional[int]): Chunk size for memory-efficient operations. Defaults to None.
+            conditioning (Optional[dict[str, Any]]): step-invariant tensors from prepare_conditioning. Defaults to None.
 
         Returns:
             torch.Tensor: the denoised coordinates of x
@@ -519,6 +631,7 @@ class DiffusionModule(nn.Module):
             z_trunk=z_trunk,
             inplace_safe=inplace_safe,
             chunk_size=chunk_size,
+            conditioning=conditioning,
         )
 
         # Rescale updates to positions and combine with input positions
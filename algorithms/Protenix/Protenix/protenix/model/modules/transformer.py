@@ -677,43 +677,34 @@ class AtomAttentionEncoder(nn.Module):
                 self.linear_no_bias_q.weight, a=0, mode="fan_in", nonlinearity="relu"
             )
 
-    def forward(
+    def prepare_conditioning(
         self,
         input_feature_dict: dict[str, Union[torch.Tensor, int, float, dict]],
-        r_l: torch.Tensor = None,
         s: torch.Tensor = None,
         z: torch.Tensor = None,
         inplace_safe: bool = False,
-        chunk_size: Optional[int] = None,
-    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
-        """
+    ) -> dict[str, Union[torch.Tensor, int]]:
+        """The part of forward that does not depend on the noisy positions r_l:
+        the atom single conditioning c_l and the atom pair representation p_lm.
+
         Args:
             input_feature_dict (dict[str, Union[torch.Tensor, int, float, dict]]): input meta feature dict
-            r_l (torch.Tensor, optional): noisy position.
-                [..., N_sample, N_atom, 3] if has_coords else None.
             s (torch.Tensor, optional): single embedding.
                 [..., N_sample, N_token, c_s] if has_coords else None.
             z (torch.Tensor, optional): pair embedding
                 [..., N_sample, N_token, N_token, c_z] if has_coords else None.
+            inplace_safe (bool): Whether it is safe to use inplace operations. Defaults to False.
 
         Returns:
-            tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]: the output of AtomAttentionEncoder
-            a:
-                [..., (N_sample), N_token, c_token]
-            q_l:
-                [..., (N_sample), N_atom, c_atom]
+            dict[str, Union[torch.Tensor, int]]: conditioning for forward
+            c_ref: per-atom embedding of the reference features, the initial q_l
+                [..., N_atom, c_atom]
             c_l:
                 [..., (N_sample), N_atom, c_atom]
             p_lm:
-                [..., (N_sample), N_atom, N_atom, c_atompair]
-
+                [..., (N_sample), n_blocks, n_queries, n_keys, c_atompair]
+            n_token: number of tokens if has_coords else None
         """
-
-        if self.has_coords:
-            assert r_l is not None
-            assert s is not None
-            assert z is not None
-
         atom_to_token_idx = input_feature_dict["atom_to_token_idx"]
         # Create the atom single conditioning: Embed per-atom meta data
         # [..., N_atom, C_atom]
@@ -776,14 +767,12 @@ class AtomAttentionEncoder(nn.Module):
             )
             p_lm = p_lm + self.linear_no_bias_v(v_lm.to(dtype=p_lm.dtype)) * v_lm
 
-        # Line7: Initialise the atom single representation as the single conditioning
-        q_l = c_l.clone()
+        # Line7: the atom single representation is initialised as this single conditioning (in forward)
+        c_ref = c_l
 
-        # If provided, add trunk embeddings and noisy positions
+        # If provided, add trunk embeddings
         n_token = None
-        if r_l is not None:
-            N_sample = r_l.size(-3)
-
+        if self.has_coords:
             # Broadcast the single and pair embedding from the trunk
             n_token = s.size(-2)
             c_l = c_l.unsqueeze(dim=-3) + self.linear_no_bias_s(
@@ -804,11 +793,6 @@ class AtomAttentionEncoder(nn.Module):
                 self.layernorm_z(z_local_pairs)
             )  # [..., N_sample, n_blocks, n_queries, n_keys, c_atompair]
 
-            # Add the noisy positions
-            q_l = q_l.unsqueeze(dim=-3) + self.linear_no_bias_r(
-                r_l
-            )  # [..., N_sample, N_atom, c_atom]
-
         # Add the combined single conditioning to the pair representation
         c_l_q, c_l_k, _ = rearrange_qk_to_dense_trunk(
             q=c_l,
@@ -832,6 +816,67 @@ class AtomAttentionEncoder(nn.Module):
 
             # Run a small MLP on the pair activations
             p_lm = p_lm + self.small_mlp(p_lm)
+        return {"c_ref": c_ref, "c_l": c_l, "p_lm": p_lm, "n_token": n_token}
+
+    def forward(
+        self,
+        input_feature_dict: dict[str, Union[torch.Tensor, int, float, dict]],
+        r_l: torch.Tensor = None,
+        s: torch.Tensor = None,
+        z: torch.Tensor = None,
+        inplace_safe: bool = False,
+        chunk_size: Optional[int] = None,
+        conditioning: Optional[dict[str, Union[torch.Tensor, int]]] = None,
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            input_feature_dict (dict[str, Union[torch.Tensor, int, float, dict]]): input meta feature dict
+            r_l (torch.Tensor, optional): noisy position.
+                [..., N_sample, N_atom, 3] if has_coords else None.
+            s (torch.Tensor, optional): single embedding.
+                [..., N_sample, N_token, c_s] if has_coords else None.
+            z (torch.Tensor, optional): pair embedding
+                [..., N_sample, N_token, N_token, c_z] if has_coords else None.
+            conditioning (dict[str, Union[torch.Tensor, int]], optional): output of prepare_conditioning
+                for the same input_feature_dict, s and z. Computed here if None.
+
+        Returns:
+            tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]: the output of AtomAttentionEncoder
+            a:
+                [..., (N_sample), N_token, c_token]
+            q_l:
+                [..., (N_sample), N_atom, c_atom]
+            c_l:
+                [..., (N_sample), N_atom, c_atom]
+            p_lm:
+                [..., (N_sample), N_atom, N_atom, c_atompair]
+
+        """
+
+        if self.has_coords:
+            assert r_l is not None
+            assert conditioning is not None or (s is not None and z is not None)
+
+        if conditioning is None:
+            conditioning = self.prepare_conditioning(
+                input_feature_dict=input_feature_dict,
+                s=s,
+                z=z,
+                inplace_safe=inplace_safe,
+            )
+        c_l = conditioning["c_l"]
+        p_lm = conditioning["p_lm"]
+        n_token = conditioning["n_token"]
+        atom_to_token_idx = input_feature_dict["atom_to_token_idx"]
+
+        # Line7: Initialise the atom single representation as the single conditioning
+        q_l = conditioning["c_ref"].clone()
+
+        # If provided, add the noisy positions
+        if r_l is not None:
+            q_l = q_l.unsqueeze(dim=-3) + self.linear_no_bias_r(
+                r_l
+            )  # [..., N_sample, N_atom, c_atom]
 
         # Cross attention transformer
         q_l = self.atom_transformer(
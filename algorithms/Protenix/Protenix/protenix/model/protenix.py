@@ -287,6 +287,70 @@ class Protenix(nn.Module):
             self.confidence_head
         )(*args, **kwargs)
 
+    def _inference_trunk(
+        self,
+        input_feature_dict: dict[str, Any],
+        N_cycle: int,
+        mode: str,
+        inplace_safe: bool = True,
+        chunk_size: Optional[int] = 4,
+    ) -> tuple[torch.Tensor, ...]:
+        """
+        Runs the trunk for inference. In inference mode, the MSA and template features are
+        removed from input_feature_dict afterwards, the diffusion and the heads do not need them.
+
+        Returns:
+            tuple[torch.Tensor, ...]: s_inputs, s and z.
+        """
+        s_inputs, s, z = self.get_pairformer_output(
+            input_feature_dict=input_feature_dict,
+            N_cycle=N_cycle,
+            inplace_safe=inplace_safe,
+            chunk_size=chunk_size,
+        )
+        if mode == "inference":
+            keys_to_delete = []
+            for key in input_feature_dict.keys():
+                if "template_" in key or key in [
+                    "msa",
+                    "has_deletion",
+                    "deletion_value",
+                    "profile",
+                    "deletion_mean",
+                    "token_bonds",
+                ]:
+                    keys_to_delete.append(key)
+
+            for key in keys_to_delete:
+                del input_feature_dict[key]
+            torch.cuda.empty_cache()
+        return s_inputs, s, z
+
+    def get_inference_trunk_output(
+        self, input_feature_dict: dict[str, Any]
+    ) -> tuple[torch.Tensor, ...]:
+        """
+        Runs only the trunk of the inference mode, so that several seeds can share it
+        (forward(..., mode="inference", trunk_output=...)). The trunk depends on the RNG
+        state through the MSA subsampling.
+
+        Args:
+            input_feature_dict (dict[str, Any]): Input features dictionary. The MSA and template
+                features are removed from it.
+
+        Returns:
+            tuple[torch.Tensor, ...]: s_inputs, s and z.
+        """
+        inplace_safe = not (self.training or torch.is_grad_enabled())
+        chunk_size = self.configs.infer_setting.chunk_size if inplace_safe else None
+        return self._inference_trunk(
+            input_feature_dict=input_feature_dict,
+            N_cycle=self.N_cycle,
+            mode="inference",
+            inplace_safe=inplace_safe,
+            chunk_size=chunk_size,
+        )
+
     def main_inference_loop(
         self,
         input_feature_dict: dict[str, Any],
@@ -297,6 +361,7 @@ class Protenix(nn.Module):
         chunk_size: Optional[int] = 4,
         N_model_seed: int = 1,
         symmetric_permutation: SymmetricPermutation = None,
+        trunk_output: Optional[tuple[torch.Tensor, ...]] = None,
     ) -> tuple[dict[str, torch.Tensor], dict[str, Any], dict[str, Any]]:
         """
         Main inference loop (multiple model seeds) for the Alphafold3 model.
@@ -310,6 +375,8 @@ class Protenix(nn.Module):
             chunk_size (Optional[int]): Chunk size for memory-efficient operations. Defaults to 4.
             N_model_seed (int): Number of model seeds. Defaults to 1.
             symmetric_permutation (SymmetricPermutation): Symmetric permutation object. Defaults to None.
+            trunk_output (Optional[tuple[torch.Tensor, ...]]): (s_inputs, s, z) from get_inference_trunk_output.
+                If given, the trunk is not run and only the diffusion and the heads are. Defaults to None.
 
         Returns:
             tuple[dict[str, torch.Tensor], dict[str, Any], dict[str, Any]]: Prediction, log, and time dictionaries.
@@ -326,6 +393,7 @@ class Protenix(nn.Module):
                 inplace_safe=inplace_safe,
                 chunk_size=chunk_size,
                 symmetric_permutation=symmetric_permutation,
+                trunk_output=trunk_output,
             )
             pred_dicts.append(pred_dict)
             log_dicts.append(log_dict)
@@ -361,9 +429,11 @@ class Protenix(nn.Module):
         inplace_safe: bool = True,
         chunk_size: Optional[int] = 4,
         symmetric_permutation: SymmetricPermutation = None,
+        trunk_output: Optional[tuple[torch.Tensor, ...]] = None,
     ) -> tuple[dict[str, torch.Tensor], dict[str, Any], dict[str, Any]]:
         """
         Main inference loop (single model seed) for the Alphafold3 model.
+        The trunk is only run if no trunk_output (s_inputs, s, z) is given.
 
         Returns:
             tuple[dict[str, torch.Tensor], dict[str, Any], dict[str, Any]]: Prediction, log, and time dictionaries.
@@ -379,28 +449,15 @@ class Protenix(nn.Module):
         pred_dict = {}
         time_tracker = {}
 
-        s_inputs, s, z = self.get_pairformer_output(
-            input_feature_dict=input_feature_dict,
-            N_cycle=N_cycle,
-            inplace_safe=inplace_safe,
-            chunk_size=chunk_size,
-        )
-        if mode == "inference":
-            keys_to_delete = []
-            for key in input_feature_dict.keys():
-                if "template_" in key or key in [
-                    "msa",
-                    "has_deletion",
-                    "deletion_value",
-                    "profile",
-                    "deletion_mean",
-                    "token_bonds",
-                ]:
-                    keys_to_delete.append(key)
-
-            for key in keys_to_delete:
-                del input_feature_dict[key]
-            torch.cuda.empty_cache()
+        if trunk_output is None:
+            trunk_output = self._inference_trunk(
+                input_feature_dict=input_feature_dict,
+                N_cycle=N_cycle,
+                mode=mode,
+                inplace_safe=inplace_safe,
+                chunk_size=chunk_size,
+            )
+        s_inputs, s, z = trunk_output
         step_trunk = time.time()
         time_tracker.update({"pairformer": step_trunk - step_st})
         # Sample diffusion
@@ -651,6 +708,7 @@ class Protenix(nn.Module):
         mode: str = "inference",
         current_step: Optional[int] = None,
         symmetric_permutation: SymmetricPermutation = None,
+        trunk_output: Optional[tuple[torch.Tensor, ...]] = None,
     ) -> tuple[dict[str, torch.Tensor], dict[str, Any], dict[str, Any]]:
         """
         Forward pass of the Alphafold3 model.
@@ -662,6 +720,8 @@ class Protenix(nn.Module):
             mode (str): Mode of operation ('train', 'inference', 'eval'). Defaults to 'inference'.
             current_step (Optional[int]): Current training step. Defaults to None.
             symmetric_permutation (SymmetricPermutation): Symmetric permutation object. Defaults to None.
+            trunk_output (Optional[tuple[torch.Tensor, ...]]): Inference mode only, (s_inputs, s, z)
+                from get_inference_trunk_output to reuse instead of running the trunk. Defaults to None.
 
         Returns:
             tuple[dict[str, torch.Tensor], dict[str, Any], dict[str, Any]]:
@@ -698,6 +758,7 @@ class Protenix(nn.Module):
                 chunk_size=chunk_size,
                 N_model_seed=self.N_model_seed,
                 symmetric_permutation=None,
+                trunk_output=trunk_output,
             )
             log_dict.update({"time": time_tracker})
         elif mode == "eval":
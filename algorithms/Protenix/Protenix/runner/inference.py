@@ -19,7 +19,7 @@ import urllib.request
 from contextlib import nullcontext
 from os.path import exists as opexists
 from os.path import join as opjoin
-from typing import Any, Mapping
+from typing import Any, Mapping, Optional
 
 import torch
 import torch.distributed as dist
@@ -27,6 +27,7 @@ from configs.configs_base import configs as configs_base
 from configs.configs_data import data_configs
 from configs.configs_inference import inference_configs
 from runner.dumper import DataDumper
+from runner.inference_scheduler import InferenceScheduler, is_oom_error
 from runner.msa_search import contain_msa_res, msa_search_update
 
 from protenix.config import parse_configs, parse_sys_args
@@ -122,32 +123,56 @@ class InferenceRunner(object):
             base_dir=self.dump_dir, need_atom_confidence=need_atom_confidence
         )
 
-    # Adapted from runner.train.Trainer.evaluate
-    @torch.no_grad()
-    def predict(self, data: Mapping[str, Mapping[str, Any]]) -> dict[str, torch.Tensor]:
+    def autocast(self):
         eval_precision = {
             "fp32": torch.float32,
             "bf16": torch.bfloat16,
             "fp16": torch.float16,
         }[self.configs.dtype]
 
-        enable_amp = (
+        return (
             torch.autocast(device_type="cuda", dtype=eval_precision)
             if torch.cuda.is_available()
             else nullcontext()
         )
 
+    # Adapted from runner.train.Trainer.evaluate
+    @torch.no_grad()
+    def predict(
+        self,
+        data: Mapping[str, Mapping[str, Any]],
+        trunk_output: Optional[tuple[torch.Tensor, ...]] = None,
+    ) -> dict[str, torch.Tensor]:
         data = to_device(data, self.device)
-        with enable_amp:
+        with self.autocast():
             prediction, _, _ = self.model(
                 input_feature_dict=data["input_feature_dict"],
                 label_full_dict=None,
                 label_dict=None,
                 mode="inference",
+                trunk_output=trunk_output,
             )
 
         return prediction
 
+    @torch.no_grad()
+    def predict_trunk(
+        self, data: Mapping[str, Mapping[str, Any]], keep_features: bool = True
+    ) -> tuple[torch.Tensor, ...]:
+        """
+        Run only the trunk, its output can be passed to predict for every seed.
+        With keep_features, the MSA and template features of data are kept, so that the
+        trunk can be run again. Otherwise they are removed once the trunk finished.
+        """
+        data = to_device(data, self.device)
+        input_feature_dict = data["input_feature_dict"]
+        with self.autocast():
+            return self.model.get_inference_trunk_output(
+                input_feature_dict=(
+                    dict(input_feature_dict) if keep_features else input_feature_dict
+                )
+            )
+
     def print(self, msg: str):
         if DIST_WRAPPER.rank == 0:
             logger.info(msg)
@@ -226,60 +251,134 @@ def infer_predict(runner: InferenceRunner, configs: Any) -> None:
     logger.info(f"Loading data from\n{configs.input_json_path}")
     dataloader = get_inference_dataloader(configs=configs)
 
+    scheduler = None
+    if configs.schedule_by_size:
+        scheduler = InferenceScheduler(configs, runner.model, runner.device)
+        dataloader.dataset.inputs = scheduler.order_inputs(dataloader.dataset.inputs)
+
     num_data = len(dataloader.dataset)
-    for seed in configs.seeds:
-        seed_everything(seed=seed, deterministic=True)
+    if configs.multi_seed:
+        # every input is featurized once, and its trunk is shared by all seeds unless
+        # trunk_per_seed is set. Every seed gets its own RNG stream for the diffusion.
+        # The featurization (e.g. ligand conformers, leaving atoms) is seeded with the
+        # first seed, through the dataloader's worker base seed
+        seed_everything(seed=configs.seeds[0], deterministic=True)
         for batch in dataloader:
-            try:
-                data, atom_array, data_error_message = batch[0]
-
-                if len(data_error_message) > 0:
-                    logger.info(data_error_message)
-                    with open(
-                        opjoin(runner.error_dir, f"{data['sample_name']}.txt"),
-                        "w",
-                    ) as f:
-                        f.write(data_error_message)
-                    continue
-
-                sample_name = data["sample_name"]
-                logger.info(
-                    (
-                        f"[Rank {DIST_WRAPPER.rank} ({data['sample_index'] + 1}/{num_data})] {sample_name}: "
-                        f"N_asym {data['N_asym'].item()}, N_token {data['N_token'].item()}, "
-                        f"N_atom {data['N_atom'].item()}, N_msa {data['N_msa'].item()}"
-                    )
-                )
-                new_configs = update_inference_configs(configs, data["N_token"].item())
-                runner.update_model_configs(new_configs)
-                prediction = runner.predict(data)
-                runner.dumper.dump(
-                    dataset_name="",
-                    pdb_id=sample_name,
-                    seed=seed,
-                    pred_dict=prediction,
-                    atom_array=atom_array,
-                    entity_poly_type=data["entity_poly_type"],
+            predict_batch(
+                runner, configs, batch, num_data, configs.seeds, True, scheduler
+            )
+    else:
+        for seed in configs.seeds:
+            seed_everything(seed=seed, deterministic=True)
+            for batch in dataloader:
+                predict_batch(
+                    runner, configs, batch, num_data, [seed], False, scheduler
                 )
 
-                logger.info(
-                    f"[Rank {DIST_WRAPPER.rank}] {data['sample_name']} succeeded.\n"
-                    f"Results saved to {configs.dump_dir}"
-                )
-                torch.cuda.empty_cache()
-            except Exception as e:
-                error_message = f"[Rank {DIST_WRAPPER.rank}]{data['sample_name']} {e}:\n{traceback.format_exc()}"
-                logger.info(error_message)
-                # Save error info
-                if opexists(
-                    error_path := opjoin(runner.error_dir, f"{sample_name}.txt")
-                ):
-                    os.remove(error_path)
-                with open(error_path, "w") as f:
-                    f.write(error_message)
-                if hasattr(torch.cuda, "empty_cache"):
-                    torch.cuda.empty_cache()
-                raise RuntimeError(f"run infer failed: {str(e)}")
+
+def predict_batch(
+    runner: InferenceRunner,
+    configs: Any,
+    batch: Any,
+    num_data: int,
+    seeds: list[int],
+    multi_seed: bool = False,
+    scheduler: Optional[InferenceScheduler] = None,
+) -> None:
+    """
+    Predict one featurized input for seeds and dump the predictions to seed_{seed}/predictions.
+
+    Args:
+        runner (InferenceRunner): the inference runner.
+        configs (Any): the inference configs.
+        batch (Any): a batch of the inference dataloader.
+        num_data (int): the number of inputs, for logging.
+        seeds (list[int]): the seeds to predict.
+        multi_seed (bool): seed every prediction and run the trunk only for the first seed
+            (for every seed with configs.trunk_per_seed). Otherwise, the prediction runs with
+            the current RNG state. Defaults to False.
+        scheduler (Optional[InferenceScheduler]): chooses the chunk sizes of the input and
+            retries predictions that run out of GPU memory with smaller ones. An input that does
+            not fit with the smallest chunk sizes is skipped. Defaults to None.
+    """
+    data, atom_array, data_error_message = batch[0]
+
+    if len(data_error_message) > 0:
+        logger.info(data_error_message)
+        with open(
+            opjoin(runner.error_dir, f"{data['sample_name']}.txt"),
+            "w",
+        ) as f:
+            f.write(data_error_message)
+        return
+
+    sample_name = data["sample_name"]
+    try:
+        logger.info(
+            (
+                f"[Rank {DIST_WRAPPER.rank} ({data['sample_index'] + 1}/{num_data})] {sample_name}: "
+                f"N_asym {data['N_asym'].item()}, N_token {data['N_token'].item()}, "
+                f"N_atom {data['N_atom'].item()}, N_msa {data['N_msa'].item()}"
+            )
+        )
+        new_configs = update_inference_configs(configs, data["N_token"].item())
+        runner.update_model_configs(new_configs)
+        if scheduler is not None:
+            scheduler.start(
+                data["N_token"].item(), data["N_atom"].item(), data["N_msa"].item()
+            )
+            run = scheduler.run
+        else:
+            run = lambda function, with_trunk=True: function()
+        # with a scheduler, the trunk runs on its own, so that running out of memory in the
+        # diffusion only retries the diffusion
+        keep_features = multi_seed and configs.trunk_per_seed
+        trunk_output = None
+        for seed in seeds:
+            if multi_seed:
+                seed_everything(seed=seed, deterministic=True)
+            if (multi_seed or scheduler is not None) and (
+                trunk_output is None or keep_features
+            ):
+                # free the previous trunk output first
+                trunk_output = None
+                trunk_output = run(lambda: runner.predict_trunk(data, keep_features))
+            prediction = run(
+                lambda: runner.predict(data, trunk_output=trunk_output),
+                with_trunk=trunk_output is None,
+            )
+            runner.dumper.dump(
+                dataset_name="",
+                pdb_id=sample_name,
+                seed=seed,
+                pred_dict=prediction,
+                atom_array=atom_array,
+                entity_poly_type=data["entity_poly_type"],
+            )
+
+            logger.info(
+                f"[Rank {DIST_WRAPPER.rank}] {data['sample_name']} (seed {seed}) succeeded.\n"
+                f"Results saved to {configs.dump_dir}"
+            )
+            torch.cuda.empty_cache()
+    except Exception as e:
+        error_message = f"[Rank {DIST_WRAPPER.rank}]{data['sample_name']} {e}:\n{traceback.format_exc()}"
+        if scheduler is not None and is_oom_error(e):
+            # out of memory even with the smallest chunk sizes, skip the input
+            logger.info(error_message)
+            with open(opjoin(runner.error_dir, f"{sample_name}.txt"), "w") as f:
+                f.write(error_message)
+            torch.cuda.empty_cache()
+            return
+        logger.info(error_message)
+        # Save error info
+        if opexists(error_path := opjoin(runner.error_dir, f"{sample_name}.txt")):
+            os.remove(error_path)
+        with open(error_path, "w") as f:
+            f.write(error_message)
+        if hasattr(torch.cuda, "empty_cache"):
+            torch.cuda.empty_cache()
+        raise RuntimeError(f"run infer failed: {str(e)}")
 
 
 def main(configs: Any) -> None:
@@ -0,0 +1,337 @@
+# Copyright 2024 ByteDance and/or its affiliates.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import math
+from typing import Any, Callable, Mapping, Optional
+
+import torch
+from rdkit import Chem
+
+from protenix.data import ccd
+from protenix.data.constants import RES_ATOMS_DICT
+from protenix.data.json_parser import (
+    DNA_1to3,
+    PROTEIN_1to3,
+    RNA_1to3,
+    lig_file_to_atom_info,
+)
+
+logger = logging.getLogger(__name__)
+
+POLYMER_1to3 = {
+    "proteinChain": PROTEIN_1to3,
+    "dnaSequence": DNA_1to3,
+    "rnaSequence": RNA_1to3,
+}
+# atoms assumed for a CCD code without a rdkit mol in the CCD cache
+UNKNOWN_CCD_N_ATOM = 30
+
+# trunk chunk sizes (infer_setting.chunk_size, also the attention chunk size of the
+# diffusion), from the fastest to the least memory
+CHUNK_SIZES = [None, 256, 128, 64, 32, 16, 8, 4]
+
+# bytes of an activation, the memory model does not distinguish bf16 and fp32
+BYTES = 4
+# pair representations alive at once in the trunk and the confidence head (z, z_init,
+# the triangle update in flight, ...)
+PAIR_COPIES = 6
+TRIANGLE_HEADS = 4
+DIFFUSION_HEADS = 16
+C_TOKEN = 768
+# keys per atom query of the local atom attention
+ATOM_N_KEYS = 128
+
+
+def ccd_n_atom(ccd_code: str) -> int:
+    """Number of heavy atoms of a CCD component, leaving atoms included."""
+    mol = ccd.get_component_rdkit_mol(ccd_code)
+    if mol is None:
+        return UNKNOWN_CCD_N_ATOM
+    return mol.GetNumHeavyAtoms()
+
+
+def estimate_input_size(single_sample_dict: Mapping[str, Any]) -> tuple[int, int]:
+    """
+    Estimate N_token and N_atom of an inference input from its JSON, without featurizing it.
+    Standard residues are one token, modified residues and ligands are one token per atom.
+
+    Args:
+        single_sample_dict (Mapping[str, Any]): one input of the inference JSON.
+
+    Returns:
+        tuple[int, int]: the estimated N_token and N_atom.
+    """
+    N_token, N_atom = 0, 0
+    for entity_dict in single_sample_dict["sequences"]:
+        for entity_type, entity in entity_dict.items():
+            count = entity.get("count", 1)
+            if entity_type in POLYMER_1to3:
+                res_names = [POLYMER_1to3[entity_type][x] for x in entity["sequence"]]
+                modified = {}
+                for m in entity.get("modifications", []):
+                    position = m.get("ptmPosition", m.get("basePosition"))
+                    mtype = m.get("ptmType", m.get("modificationType"))
+                    modified[position - 1] = mtype[4:]
+                # the last residue keeps its leaving atom (OXT, OP3)
+                entity_token, entity_atom = 0, 1
+                for idx, res_name in enumerate(res_names):
+                    if idx in modified:
+                        n_atom = ccd_n_atom(modified[idx]) - 1
+                        entity_token += n_atom
+                    else:
+                        n_atom = len(RES_ATOMS_DICT[res_name]) - 1
+                        entity_token += 1
+                    entity_atom += n_atom
+            elif entity_type == "ion":
+                entity_token, entity_atom = 1, 1
+            else:
+                ligand_str = entity["ligand"]
+                if ligand_str.startswith("CCD_"):
+                    entity_atom = sum(
+                        ccd_n_atom(code) for code in ligand_str[4:].split("_")
+                    )
+                elif ligand_str.startswith("FILE_"):
+                    entity_atom = len(
+                        lig_file_to_atom_info(ligand_str[5:])["atom_array"]
+                    )
+                else:
+                    mol = Chem.MolFromSmiles(ligand_str)
+                    entity_atom = mol.GetNumHeavyAtoms() if mol is not None else 0
+                entity_token = entity_atom
+            N_token += count * entity_token
+            N_atom += count * entity_atom
+    return N_token, N_atom
+
+
+def is_oom_error(e: BaseException) -> bool:
+    return isinstance(e, torch.cuda.OutOfMemoryError) or (
+        isinstance(e, RuntimeError) and "out of memory" in str(e)
+    )
+
+
+class InferenceScheduler(object):
+    """
+    Size-aware scheduling of the inference inputs on a GPU.
+
+    Inputs are ordered largest first by their estimated size, so that the memory the caching
+    allocator holds after the first inputs fits all later ones. For every input, the chunk sizes
+    (infer_setting.chunk_size, which is also the attention chunk size of the diffusion, and
+    infer_setting.sample_diffusion_chunk_size) are the least chunked ones whose estimated peak
+    memory fits the budget. The memory model is calibrated with the peak memory measured for
+    every finished run. A run that goes out of memory is retried with the next smaller chunks.
+
+    Without CUDA there is no budget, and the configured chunk sizes are kept.
+    """
+
+    def __init__(
+        self, configs: Any, model: torch.nn.Module, device: torch.device
+    ) -> None:
+        self.configs = configs
+        self.device = device
+        self.use_cuda = device.type == "cuda"
+        self.param_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+        if self.use_cuda:
+            total_memory = torch.cuda.get_device_properties(device).total_memory
+            self.budget = total_memory * configs.scheduler_memory_fraction
+        else:
+            self.budget = None
+        # measured / estimated peak memory, None until the first measurement
+        self.calibration = None
+        self.levels = []
+        self.level = 0
+        self.size = None
+
+    def order_inputs(self, inputs: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """Sort the inputs of the inference JSON largest first, by their estimated size."""
+        costs = []
+        for single_sample_dict in inputs:
+            try:
+                N_token, N_atom = estimate_input_size(single_sample_dict)
+            except Exception as e:
+                # the featurizer reports invalid inputs
+                logger.info(
+                    f"Can not estimate the size of {single_sample_dict.get('name')}: {e}"
+                )
+                N_token, N_atom = 0, 0
+            costs.append(
+                (
+                    N_token**2 * (N_token + ATOM_N_KEYS) + N_atom * ATOM_N_KEYS,
+                    N_token,
+                    N_atom,
+                )
+            )
+        order = sorted(range(len(inputs)), key=lambda idx: costs[idx], reverse=True)
+        if order:
+            largest = costs[order[0]]
+            logger.info(
+                f"Scheduling {len(inputs)} inputs largest first, largest: "
+                f"{inputs[order[0]]['name']} (~{largest[1]} tokens, ~{largest[2]} atoms)"
+            )
+        return [inputs[idx] for idx in order]
+
+    def estimate_memory(
+        self,
+        N_token: int,
+        N_atom: int,
+        N_msa: int,
+        chunk_size: Optional[int],
+        diffusion_chunk_size: int,
+        with_trunk: bool = True,
+    ) -> float:
+        """
+        Uncalibrated peak memory in bytes of a prediction: the maximum of the trunk, the
+        diffusion and the confidence head, plus the parameters.
+
+        Args:
+            N_token (int): number of tokens.
+            N_atom (int): number of atoms.
+            N_msa (int): number of MSA rows.
+            chunk_size (Optional[int]): trunk and diffusion attention chunk size, None for no chunking.
+            diffusion_chunk_size (int): samples denoised at once.
+            with_trunk (bool): whether the prediction runs the trunk. Defaults to True.
+
+        Returns:
+            float: the estimated peak memory in bytes.
+        """
+        c_z = self.configs.model.pairformer.c_z
+        c_m = self.configs.model.msa_module.c_m
+        c_atompair = self.configs.c_atompair
+        N_sample = self.configs.sample_diffusion.N_sample
+        rows = N_token if chunk_size is None else min(chunk_size, N_token)
+        pair = N_token**2 * c_z * BYTES
+
+        trunk = (
+            PAIR_COPIES * pair
+            + 2 * rows * N_token**2 * TRIANGLE_HEADS * BYTES
+            + 3
+            * min(N_msa, self.configs.data.msa.sample_cutoff.test)
+            * N_token
+            * c_m
+            * BYTES
+        )
+        per_sample = (
+            2 * rows * N_token * DIFFUSION_HEADS * BYTES
+            + 4 * N_token * C_TOKEN * BYTES
+            + 2 * N_atom * ATOM_N_KEYS * (c_atompair + DIFFUSION_HEADS) * BYTES
+        )
+        # the trunk output and the pair conditioning stay alive
+        diffusion = 3 * pair + diffusion_chunk_size * per_sample
+        confidence = PAIR_COPIES * pair + N_sample * N_token**2 * BYTES
+        stages = [diffusion, confidence] + ([trunk] if with_trunk else [])
+        return self.param_bytes + max(stages)
+
+    def start(self, N_token: int, N_atom: int, N_msa: int) -> None:
+        """
+        Choose the chunk sizes of the next input. All chunk combinations are ordered by their
+        estimated memory, the first one that fits the budget is used, and back-offs walk down
+        the rest.
+        """
+        N_sample = self.configs.sample_diffusion.N_sample
+        self.size = (N_token, N_atom, N_msa)
+        if self.budget is None:
+            self.levels = [
+                (
+                    self.configs.infer_setting.chunk_size,
+                    self.configs.infer_setting.sample_diffusion_chunk_size,
+                )
+            ]
+            self.level = 0
+            return
+        diffusion_chunk_sizes = sorted(
+            set(math.ceil(N_sample / 2**k) for k in range(N_sample.bit_length() + 1)),
+            reverse=True,
+        )
+        levels = [
+            (chunk_size, diffusion_chunk_size)
+            for chunk_size in CHUNK_SIZES
+            for diffusion_chunk_size in diffusion_chunk_sizes
+            if chunk_size is None or chunk_size < N_token
+        ]
+        # stable, so of two equally large combinations the less chunked trunk comes first
+        self.levels = sorted(
+            levels,
+            key=lambda level: self.estimate_memory(N_token, N_atom, N_msa, *level),
+            reverse=True,
+        )
+        calibration = self.calibration or 1.0
+        self.level = len(self.levels) - 1
+        for idx, level in enumerate(self.levels):
+            if (
+                calibration * self.estimate_memory(N_token, N_atom, N_msa, *level)
+                < self.budget
+            ):
+                self.level = idx
+                break
+        self.apply()
+
+    def apply(self) -> None:
+        chunk_size, diffusion_chunk_size = self.levels[self.level]
+        self.configs.infer_setting.chunk_size = chunk_size
+        self.configs.infer_setting.sample_diffusion_chunk_size = diffusion_chunk_size
+
+    def back_off(self) -> bool:
+        """Move to the next smaller chunk sizes. Returns False if there are none left."""
+        if self.level + 1 >= len(self.levels):
+            return False
+        self.level += 1
+        self.apply()
+        return True
+
+    def run(self, function: Callable[[], Any], with_trunk: bool = True) -> Any:
+        """
+        Run function (a prediction of the current input) with the chosen chunk sizes, and again
+        with smaller ones whenever it runs out of GPU memory. Raises the last out of memory
+        error if the smallest chunk sizes do not fit either.
+
+        Args:
+            function (Callable[[], Any]): the prediction, it reads the chunk sizes from the configs.
+            with_trunk (bool): whether the prediction runs the trunk, for the memory model. Defaults to True.
+
+        Returns:
+            Any: the result of function.
+        """
+        while True:
+            if self.use_cuda:
+                torch.cuda.reset_peak_memory_stats(self.device)
+            try:
+                return_value = function()
+                break
+            except Exception as e:
+                if not (self.use_cuda and is_oom_error(e)):
+                    raise
+                # only the message is kept, so the tensors of the failed attempt are freed
+                oom_message = str(e)
+            torch.cuda.empty_cache()
+            chunk_size, diffusion_chunk_size = self.levels[self.level]
+            # the failed chunk sizes needed more than the budget, later inputs of this size won't get them
+            estimate = self.estimate_memory(
+                *self.size, chunk_size, diffusion_chunk_size, with_trunk=with_trunk
+            )
+            self.calibration = max(self.calibration or 0.0, self.budget / estimate)
+            if not self.back_off():
+                raise torch.cuda.OutOfMemoryError(oom_message)
+            logger.info(
+                f"Out of memory with chunk_size {chunk_size}, diffusion_chunk_size {diffusion_chunk_size}, "
+                f"retrying with {self.levels[self.level]}"
+            )
+        if self.use_cuda:
+            estimate = self.estimate_memory(
+                *self.size, *self.levels[self.level], with_trunk=with_trunk
+            )
+            ratio = torch.cuda.max_memory_allocated(self.device) / estimate
+            self.calibration = (
+                ratio if self.calibration is None else max(self.calibration, ratio)
+            )
+        return return_value
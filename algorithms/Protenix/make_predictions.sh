@@ -5,6 +5,8 @@ input_dir=$2
 prediction_dir=$3
 evaluation_dir=$4
 gpu_id=$5
+# optional: tmpfs dir to hand postprocessed targets to a running evaluate.py --handoff_dir
+handoff_dir=$6
 
 PYTHON_PATH="/opt/conda/bin/python"
 # convert af3 input data to model format
@@ -20,6 +22,11 @@ N_cycle=10
 
 # seed=42
 seed=42,66,101,2024,8888
+# --multi_seed: featurize and run the trunk once per input, only the diffusion and the
+# confidence head run per seed (add --trunk_per_seed true to rerun the trunk per seed)
+# --schedule_by_size: largest inputs first, chunk sizes per input from the GPU memory,
+# smaller chunks instead of failing when running out of memory
+# --feature_cache_dir: featurized inputs are reused by reruns (keyed by the input and its MSA files)
 
 $PYTHON_PATH /algo/Protenix/runner/inference.py \
 --seeds ${seed} \
@@ -28,8 +35,11 @@ $PYTHON_PATH /algo/Protenix/runner/inference.py \
 --model.N_cycle ${N_cycle} \
 --sample_diffusion.N_sample ${N_sample} \
 --sample_diffusion.N_step ${N_step}  \
+--multi_seed true \
+--schedule_by_size true \
+--feature_cache_dir $input_dir/feature_cache \
 --use_msa_server
 
 # Convert predictions to the general cif format, 
 # and generate evaluation prediction_reference.csv in evaluation_dir
-$PYTHON_PATH ./postprocess.py --input_dir="$input_dir" --prediction_dir="$prediction_dir" --evaluation_dir="$evaluation_dir"
\ No newline at end of file
+$PYTHON_PATH ./postprocess.py --input_dir="$input_dir" --prediction_dir="$prediction_dir" --evaluation_dir="$evaluation_dir" ${handoff_dir:+--handoff_dir="$handoff_dir"}
\ No newline at end of file
@@ -11,22 +11,168 @@ import re
 import numpy as np
 from tqdm import tqdm
 import json
+import shutil
 import biotite.structure.io.pdbx as pdbx
 import glob
 import multiprocessing as mp    
 import pandas as pd
 
 
+def is_empty_cif_line(line):
+    return len(line.strip()) == 0 or line[0] == "#"
+
+
+def split_cif_line(line):
+    """Split a CIF data line into its values, removing the quotes around quoted values."""
+    if "'" not in line and '"' not in line:
+        return line.split()
+    values = []
+    while line:
+        stripped_line = line.lstrip()
+        word, _, line = stripped_line.partition(" ")
+        if word.startswith(("'", '"')):
+            separator = word[0]
+            if word.endswith(separator) and len(word) > 1:
+                values.append(word[1:-1])
+                continue
+            word, _, line = stripped_line[1:].partition(separator)
+        values.append(word)
+    return values
+
+
+def escape_cif_value(value):
+    """Quote a value the way biotite writes it, None for values that need a multiline field."""
+    if "\n" in value or ("'" in value and '"' in value):
+        return None
+    if len(value) == 0:
+        return "''"
+    if value[0] == "_":
+        return "'" + value + "'"
+    if "'" in value:
+        return '"' + value + '"'
+    if '"' in value or " " in value or "\t" in value:
+        return "'" + value + "'"
+    return value
+
+
+def find_cif_categories(lines):
+    """(name, start line) of every category of a data block, split the way biotite does."""
+    categories = []
+    current_name = None
+    for i, line in enumerate(lines):
+        if is_empty_cif_line(line):
+            continue
+        is_loop = line.startswith("loop_")
+        name = line[1:line.find(".")] if line[0] == "_" else None
+        if is_loop or (name is not None and name != current_name):
+            if is_loop:
+                if i + 1 == len(lines) or lines[i + 1][:1] != "_":
+                    return None
+                name = lines[i + 1][1:lines[i + 1].find(".")]
+            current_name = name
+            categories.append((name, i))
+    return categories
+
+
+def infer_entity_types(entity_ids, group_pdbs):
+    """
+    Entity ids in order of appearance and their types: an entity is a polymer if its first
+    atom is an ATOM record or if it mixes ATOM and HETATM records (modified residues).
+    """
+    ids, first, inverse = np.unique(entity_ids, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    first_group = group_pdbs[first]
+    mixed = np.bincount(inverse, weights=group_pdbs != first_group[inverse], minlength=len(ids)) > 0
+    types = np.where((first_group == 'ATOM') | mixed, 'polymer', 'non-polymer')
+    order = np.argsort(first)
+    return ids[order].tolist(), types[order].tolist()
+
+
+def patch_atom_site(lines):
+    """
+    Rewrite a looped atom_site category with occupancy 1 and B-factor 0.
+    Missing occupancy and B-factor columns are added.
+    Returns the category text and the entity category, or None if the category needs the
+    full biotite parser (multiline values, a single atom, no entity ids, ...).
+    """
+    lines = [line.strip() for line in lines if not is_empty_cif_line(line)]
+    if lines[0] != "loop_" or any(line[0] == ";" for line in lines):
+        return None
+    n_keys = 1
+    while n_keys < len(lines) and lines[n_keys][0] == "_":
+        n_keys += 1
+    keys = [line.split(".")[1] for line in lines[1:n_keys]]
+
+    values = []
+    escape = False
+    for line in lines[n_keys:]:
+        values.extend(split_cif_line(line))
+        escape = escape or "'" in line or '"' in line or "_" in line
+    if len(keys) == 0 or len(values) % len(keys) != 0 or len(values) // len(keys) < 2:
+        return None
+    if "label_entity_id" not in keys or "group_PDB" not in keys:
+        return None
+    values = np.array(values, dtype=str).reshape(-1, len(keys))
+    n_atoms = len(values)
+
+    entity_ids, entity_types = infer_entity_types(
+        values[:, keys.index('label_entity_id')], values[:, keys.index('group_PDB')]
+    )
+    entity = pdbx.CIFCategory({"id": entity_ids, "type": entity_types}, name="entity")
+
+    if escape:
+        escaped = [escape_cif_value(value) for value in values.ravel().tolist()]
+        if None in escaped:
+            return None
+        values = np.array(escaped, dtype=str).reshape(n_atoms, len(keys))
+    for key, value in (("occupancy", "1"), ("B_iso_or_equiv", "0")):
+        if key not in keys:
+            keys.append(key)
+            values = np.concatenate([values, np.empty((n_atoms, 1), dtype=values.dtype)], axis=1)
+        values[:, keys.index(key)] = value
+
+    widths = np.char.str_len(values).max(axis=0) + 1
+    row_format = "".join(f"%-{width}s" for width in widths)
+    rows = [(row_format % tuple(row)).strip() for row in values.tolist()]
+    text = "\n".join(["loop_"] + [f"_atom_site.{key} " for key in keys] + rows) + "\n#\n"
+    return text, entity.serialize() + "#\n"
+
+
+def patch_cif(text):
+    """
+    Single pass version of the biotite round trip in PostProcess.process_file_biotite:
+    all categories but atom_site are copied as text, atom_site gets occupancy 1 and
+    B-factor 0, and the entity category is set from the atom_site records.
+    Returns the new file content, or None if the file has to go through biotite.
+    """
+    lines = text.splitlines()
+    block_starts = [i for i, line in enumerate(lines) if line.startswith("data_")]
+    if len(block_starts) != 1:
+        return None
+    lines = lines[block_starts[0]:]
+    categories = find_cif_categories(lines)
+    if categories is None:
+        return None
+    names = [name for name, _ in categories]
+    if len(set(names)) != len(names) or "atom_site" not in names:
+        return None
+
+    starts = [start for _, start in categories] + [len(lines)]
+    texts = {
+        name: "\n".join(lines[starts[i]:starts[i + 1]]) + "\n" for i, name in enumerate(names)
+    }
+    patched = patch_atom_site(lines[starts[names.index("atom_site")]:starts[names.index("atom_site") + 1]])
+    if patched is None:
+        return None
+    texts["atom_site"], texts["entity"] = patched
+    return "".join(["data_" + lines[0][5:] + "\n#\n"] + list(texts.values()))
+
+
 class PostProcess():
     def __init__(self):
         pass
-    
-    def process_file(self,cif_paths):
-        pdb_id,file_path,new_file_path,seed,sample = cif_paths
-
-        if not os.path.exists(file_path):
-            return None
 
+    def process_file_biotite(self,file_path,new_file_path):
         dict_entity_id = {}
         
         cif_file = pdbx.CIFFile.read(file_path)
@@ -52,10 +198,56 @@ class PostProcess():
                                             "type": [dict_entity_id[key][0] for key in dict_entity_id.keys()]})
         
         cif_file.write(new_file_path)
+    
+    def process_file(self,cif_paths):
+        pdb_id,file_path,new_file_path,seed,sample,handoff_path = cif_paths
+
+        if not os.path.exists(file_path):
+            return None
+
+        with open(file_path, "r") as f:
+            text = patch_cif(f.read())
+        if text is None:
+            self.process_file_biotite(file_path, new_file_path)
+            if handoff_path is not None:
+                shutil.copyfile(new_file_path, handoff_path)
+        else:
+            for path in (new_file_path, handoff_path):
+                if path is not None:
+                    with open(path, "w") as f:
+                        f.write(text)
+        
+        return pdb_id,new_file_path,seed,sample,handoff_path
+
+    def prediction_record(self,prediction_dir,result):
+        pdb_id,new_file_path,seed,sample,_ = result
+        
+        # get ranking score
+        confidence_path = f"{prediction_dir}/{pdb_id}/seed_{seed}/predictions/{pdb_id}_seed_{seed}_summary_confidence_sample_{sample}.json"
+        with open(confidence_path, "r") as f:
+            confidence = json.load(f)
         
-        return pdb_id,new_file_path,seed,sample
+        tmp = {}
+        tmp['pdb_id'] = pdb_id
+        tmp['seed'] = seed
+        tmp['sample'] = sample
+        tmp['ranking_score'] = confidence.get('ranking_score', 0)
+        tmp['prediction_path'] = new_file_path
+        return tmp
+
+    def publish_target(self,handoff_dir,pdb_id,records):
+        # evaluate.py --handoff_dir picks up ready/{pdb_id}.csv, rename makes it appear complete
+        ready_path = os.path.join(handoff_dir, 'ready', f'{pdb_id}.csv')
+        pd.DataFrame(records).to_csv(ready_path + '.tmp', index=False)
+        os.replace(ready_path + '.tmp', ready_path)
 
-    def postprocess(self,input_dir,prediction_dir,evaluation_dir):
+    def postprocess(self,input_dir,prediction_dir,evaluation_dir,handoff_dir=None):
+        """
+        With handoff_dir, the postprocessed CIFs are also written to {handoff_dir}/{pdb_id}/ and every
+        target is published to evaluate.py --handoff_dir as soon as all its files are processed
+        (see evaluation/handoff.py). evaluate.py scores and then removes the copies, while
+        prediction_reference.csv lists the files next to the predictions, so later runs can rescore them.
+        """
         
         with open(os.path.join(input_dir, "inputs.json"), "r") as f:
             input_data = json.load(f)
@@ -64,6 +256,11 @@ class PostProcess():
         samples = [0,1,2,3,4]
         cif_paths = []
 
+        if handoff_dir is not None:
+            os.makedirs(os.path.join(handoff_dir, 'ready'), exist_ok=True)
+            if os.path.exists(os.path.join(handoff_dir, 'done')):
+                os.remove(os.path.join(handoff_dir, 'done'))
+
         for input_data in input_data:
             pdb_id = input_data['name']
             for seed in seeds:
@@ -72,9 +269,13 @@ class PostProcess():
                     # print(f"Processing {cif_path}")
                     
                     if os.path.exists(cif_path):
-                        cif_new_path =  os.path.join(os.path.dirname(cif_path),
-                                f'{os.path.splitext(os.path.basename(cif_path))[0]}_postprocessed.cif')
-                        cif_paths.append((pdb_id,cif_path,cif_new_path,seed,sample))
+                        cif_new_name = f'{os.path.splitext(os.path.basename(cif_path))[0]}_postprocessed.cif'
+                        cif_new_path =  os.path.join(os.path.dirname(cif_path), cif_new_name)
+                        handoff_path = None
+                        if handoff_dir is not None:
+                            os.makedirs(os.path.join(handoff_dir, pdb_id), exist_ok=True)
+                            handoff_path = os.path.join(handoff_dir, pdb_id, cif_new_name)
+                        cif_paths.append((pdb_id,cif_path,cif_new_path,seed,sample,handoff_path))
         
         print(f"Processing {len(cif_paths)} files")
         num_cores = mp.cpu_count()
@@ -83,33 +284,30 @@ class PostProcess():
         print(f"Will use {num_processes} processes for parallel processing")
         
         # Create process pool
+        # imap keeps the order of cif_paths, so a target is complete once the next one starts
+        data = []
+        target_records = []
         with mp.Pool(processes=num_processes) as pool:
-            results = list(tqdm(
+            for result in tqdm(
                 pool.imap(self.process_file, cif_paths), 
                 total=len(cif_paths),
                 desc="Processing progress"
-            ))
-        
-        data = []
-        for result in results:
-            if result is None:
-                continue
-            tmp = {}
-            pdb_id,new_file_path,seed,sample = result
-            
-            # get ranking score
-            confidence_path = f"{prediction_dir}/{pdb_id}/seed_{seed}/predictions/{pdb_id}_seed_{seed}_summary_confidence_sample_{sample}.json"
-            with open(confidence_path, "r") as f:
-                confidence = json.load(f)
-            
-            tmp['pdb_id'] = pdb_id
-            tmp['seed'] = seed
-            tmp['sample'] = sample
-            tmp['ranking_score'] = confidence.get('ranking_score', 0)
-            tmp['prediction_path'] = new_file_path
-            
-           
-            data.append(tmp)
+            ):
+                if result is None:
+                    continue
+                record = self.prediction_record(prediction_dir, result)
+                if handoff_dir is not None:
+                    if target_records and target_records[0]['pdb_id'] != record['pdb_id']:
+                        self.publish_target(handoff_dir, target_records[0]['pdb_id'], target_records)
+                        target_records = []
+                    # evaluate.py scores the handoff copy
+                    target_records.append({**record, 'prediction_path': result[-1]})
+                data.append(record)
+
+        if handoff_dir is not None:
+            if target_records:
+                self.publish_target(handoff_dir, target_records[0]['pdb_id'], target_records)
+            open(os.path.join(handoff_dir, 'done'), 'w').close()
 
         df = pd.DataFrame(data)
         df.to_csv(os.path.join(evaluation_dir, f'prediction_reference.csv'), index=False)
@@ -124,9 +322,12 @@ parser.add_argument(
 parser.add_argument(
     "--evaluation_dir", required=True, help="The dir with the evaluation files.",
 )
+parser.add_argument(
+    "--handoff_dir", required=False, default=None, help="Also copy the postprocessed files to this (tmpfs) dir and hand every finished target to evaluate.py --handoff_dir.",
+)
 args = parser.parse_args()
 
 
 postprocess = PostProcess()
 
-postprocess.postprocess(args.input_dir, args.prediction_dir,args.evaluation_dir)
\ No newline at end of file
+postprocess.postprocess(args.input_dir, args.prediction_dir,args.evaluation_dir,args.handoff_dir)
\ No newline at end of file
@@ -0,0 +1,105 @@
+"""
+Bootstrap confidence intervals and paired significance tests for the summary table.
+
+Targets are resampled with one (n_boot, n_targets) index matrix per target set. It is turned
+into a matrix of how often each target is drawn per resample, so the means of all resamples
+of a metric are a single matrix-vector product. Paired comparisons between two models reuse
+the same resamples on the per-target differences of their common targets.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def resample_weights(index_matrix):
+    """(n_boot, n) index matrix -> (n_boot, n) matrix of draw counts divided by n."""
+    n_boot, n = index_matrix.shape
+    flat = (np.arange(n_boot)[:, None] * n + index_matrix).ravel()
+    return np.bincount(flat, minlength=n_boot * n).reshape(n_boot, n) / n
+
+
+class Resamples():
+    """Bootstrap resamples of n targets, drawn once per number of targets."""
+
+    def __init__(self, n_boot, seed=0):
+        self.n_boot = n_boot
+        self.rng = np.random.default_rng(seed)
+        self.matrices = {}
+
+    def get(self, n):
+        if n not in self.matrices:
+            index_matrix = self.rng.integers(0, n, size=(self.n_boot, n))
+            self.matrices[n] = resample_weights(index_matrix)
+        return self.matrices[n]
+
+
+def bootstrap_means(values, weights):
+    """Mean of every resample of values (n,), weights from Resamples.get(n)."""
+    return weights @ values
+
+
+def percentile_interval(boot_means, alpha):
+    low, high = np.percentile(boot_means, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+    return low, high
+
+
+def bootstrap_ci(values, index_matrices, alpha=0.05):
+    """Point estimate and percentile bootstrap interval of the mean of values."""
+    values = np.asarray(values, dtype=float)
+    boot_means = bootstrap_means(values, index_matrices.get(len(values)))
+    return (values.mean(), *percentile_interval(boot_means, alpha))
+
+
+def paired_bootstrap(values_a, values_b, index_matrices, alpha=0.05):
+    """
+    Paired bootstrap of mean(values_a - values_b) over common targets.
+    Returns the mean difference, its interval and a two-sided p-value for a zero difference.
+    """
+    diff = np.asarray(values_a, dtype=float) - np.asarray(values_b, dtype=float)
+    boot_means = bootstrap_means(diff, index_matrices.get(len(diff)))
+    p_value = min(1.0, 2 * min((boot_means <= 0).mean(), (boot_means >= 0).mean()))
+    return (diff.mean(), *percentile_interval(boot_means, alpha), p_value)
+
+
+def bootstrap_summary(values, models, metrics, scale, n_boot=10000, alpha=0.05, seed=0):
+    """
+    values: model -> target -> metric -> per-target values (Series indexed by target keys).
+    metrics: target -> metric names, scale: metric name -> factor applied to the reported numbers.
+    Returns a DataFrame of intervals per (target, metric, model) and one of paired tests
+    per (target, metric, model_a, model_b).
+    """
+    index_matrices = Resamples(n_boot, seed)
+    intervals = []
+    paired = []
+    for target, target_metrics in metrics.items():
+        for metric in target_metrics:
+            factor = scale(metric)
+            series = {
+                model: values[model][target][metric]
+                for model in models
+                if metric in values.get(model, {}).get(target, {})
+            }
+            for model, column in series.items():
+                estimate, low, high = bootstrap_ci(column.to_numpy(), index_matrices, alpha)
+                intervals.append({
+                    'target': target, 'metric': metric, 'model': model, 'n_targets': len(column),
+                    'estimate': estimate * factor, 'ci_low': low * factor, 'ci_high': high * factor,
+                })
+
+            names = list(series)
+            for i, model_a in enumerate(names):
+                for model_b in names[i + 1:]:
+                    common = series[model_a].index.intersection(series[model_b].index)
+                    if len(common) == 0:
+                        continue
+                    diff, low, high, p_value = paired_bootstrap(
+                        series[model_a].loc[common].to_numpy(),
+                        series[model_b].loc[common].to_numpy(),
+                        index_matrices, alpha,
+                    )
+                    paired.append({
+                        'target': target, 'metric': metric, 'model_a': model_a, 'model_b': model_b,
+                        'n_targets': len(common), 'diff': diff * factor,
+                        'ci_low': low * factor, 'ci_high': high * factor, 'p_value': p_value,
+                    })
+    return pd.DataFrame(intervals), pd.DataFrame(paired)
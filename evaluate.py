@@ -1,6 +1,6 @@
 
 
-from evaluation import eval_by_dockqv2,eval_by_ost
+from evaluation import eval_by_dockqv2,eval_by_ost,eval_monomer,eval_handoff,eval_job_graph,run_queue_worker,finalize_queue,profiling
 import pandas as pd
 import argparse
 import os
@@ -24,6 +24,54 @@ parser.add_argument(
 parser.add_argument(
         "--targets", required=False, default= ["interface_protein_ligand","interface_antibody_antigen","interface_protein_dna", "monomer_protein"], nargs='+', help="targets to evaluate.",
     )
+parser.add_argument(
+    "--ost_workers", required=False, type=int, default=0, help="Number of resident OpenStructure workers. 0 launches a new ost process for every sample.",
+)
+parser.add_argument(
+    "--dockq_kdtree", required=False, action="store_true", help="Only compute atom distances within the interface threshold in DockQv2 (KD-tree search).",
+)
+parser.add_argument(
+    "--dockq_max_chain_maps", required=False, type=int, default=None, help="Score at most this many chain maps per DockQv2 prediction, chosen by chain centroid distances while they are built. A heuristic that can miss the best mapping, off by default.",
+)
+parser.add_argument(
+    "--result_cache", required=False, default=None, help="SQLite file caching OpenStructure outputs by file hashes, flags and ost version. Only changed predictions are rescored.",
+)
+parser.add_argument(
+    "--max_workers", required=False, type=int, default=None, help="Number of concurrent OpenStructure jobs. Defaults to what the available cores and memory allow.",
+)
+parser.add_argument(
+    "--job_timeout", required=False, type=float, default=600, help="Seconds after which an OpenStructure job is killed.",
+)
+parser.add_argument(
+    "--monomer_scorer", required=False, default='ost', choices=['ost', 'native'], help="Score monomer targets with OpenStructure or in-process with NumPy (no ost needed).",
+)
+parser.add_argument(
+    "--handoff_dir", required=False, default=None, help="Score predictions as the postprocessor publishes them into this directory (postprocess.py --handoff_dir), instead of reading prediction_reference.csv.",
+)
+parser.add_argument(
+    "--keep_handoff", required=False, action="store_true", help="Keep the postprocessed structures in --handoff_dir after they are scored.",
+)
+parser.add_argument(
+    "--job_graph", required=False, action="store_true", help="Run all target types as one deduplicated job graph in a single pool, checkpointed so an interrupted run resumes.",
+)
+parser.add_argument(
+    "--checkpoint", required=False, default=None, help="Checkpoint file of --job_graph. Defaults to job_graph_checkpoint.jsonl in the evaluation dir.",
+)
+parser.add_argument(
+    "--queue_worker", required=False, action="store_true", help="Claim and run jobs from a work queue on a shared filesystem. Start any number of these, on any number of hosts.",
+)
+parser.add_argument(
+    "--finalize", required=False, action="store_true", help="Assemble the raw csv files from the results of the --queue_worker processes.",
+)
+parser.add_argument(
+    "--queue_dir", required=False, default=None, help="Shared dir of the work queue. Defaults to queue/ in the evaluation dir.",
+)
+parser.add_argument(
+    "--claim_timeout", required=False, type=float, default=3600, help="Seconds after which a claim that is no longer renewed is taken over by another worker.",
+)
+parser.add_argument(
+    "--profile", required=False, action="store_true", help="Record stage timings, peak RSS, atom and chain map counts of every scored sample to profile.parquet in the evaluation dir (see profile_report.py).",
+)
 args = parser.parse_args()
 
 evaluation_dir = os.path.join(args.evaluation_dir,args.algorithm_name)
@@ -31,23 +79,61 @@ evaluation_dir = os.path.join(args.evaluation_dir,args.algorithm_name)
 os.makedirs(os.path.join(evaluation_dir,'raw'), exist_ok=True)
 target_types =  args.targets
 
+profile_spool_dir = os.path.join(evaluation_dir, 'profile_spool')
+if args.profile:
+    profiling.enable(profile_spool_dir)
+
+
+
+def load_target_dfs(prediction_summary_df=None):
+    target_dfs = {}
+    for target_type in target_types:
+        target_df_path = f'{args.targets_dir}/{target_type}.csv'
+        if not os.path.exists(target_df_path):
+            print(f"target_df_path is not exists for {target_type}")
+            continue
+        target_dfs[target_type] = pd.read_csv(target_df_path)
+        if prediction_summary_df is not None:
+            target_dfs[target_type] = pd.merge(target_dfs[target_type],prediction_summary_df, on='pdb_id', how='left')
+    return target_dfs
+
+
+if args.handoff_dir is not None:
+    eval_handoff(args.handoff_dir,load_target_dfs(),evaluation_dir,args.ground_truth_dir,monomer_scorer=args.monomer_scorer,max_workers=args.max_workers,ost_workers=args.ost_workers,result_cache_path=args.result_cache,job_timeout=args.job_timeout,dockq_kdtree=args.dockq_kdtree,dockq_max_chain_maps=args.dockq_max_chain_maps,keep_structures=args.keep_handoff)
+elif args.job_graph:
+    target_dfs = load_target_dfs(pd.read_csv(f'{evaluation_dir}/prediction_reference.csv'))
+    eval_job_graph(target_dfs,evaluation_dir,args.ground_truth_dir,monomer_scorer=args.monomer_scorer,max_workers=args.max_workers,ost_workers=args.ost_workers,result_cache_path=args.result_cache,job_timeout=args.job_timeout,dockq_kdtree=args.dockq_kdtree,dockq_max_chain_maps=args.dockq_max_chain_maps,checkpoint_path=args.checkpoint)
+elif args.queue_worker:
+    target_dfs = load_target_dfs(pd.read_csv(f'{evaluation_dir}/prediction_reference.csv'))
+    run_queue_worker(target_dfs,evaluation_dir,args.ground_truth_dir,queue_dir=args.queue_dir,monomer_scorer=args.monomer_scorer,max_workers=args.max_workers,ost_workers=args.ost_workers,result_cache_path=args.result_cache,job_timeout=args.job_timeout,dockq_kdtree=args.dockq_kdtree,dockq_max_chain_maps=args.dockq_max_chain_maps,claim_timeout=args.claim_timeout)
+elif args.finalize:
+    target_dfs = load_target_dfs(pd.read_csv(f'{evaluation_dir}/prediction_reference.csv'))
+    finalize_queue(target_dfs,evaluation_dir,args.ground_truth_dir,queue_dir=args.queue_dir,monomer_scorer=args.monomer_scorer)
+else:
+    prediction_summary_path = f'{evaluation_dir}/prediction_reference.csv'
+    prediction_summary_df = pd.read_csv(prediction_summary_path)
+
+    # caculation
+    for target_type in target_types:
+        target_df_path = f'{args.targets_dir}/{target_type}.csv'
+        if not os.path.exists(target_df_path):
+            print(f"target_df_path is not exists for {target_type}")
+            continue
+        target_df = pd.read_csv(target_df_path)
 
+        target_df = pd.merge(target_df,prediction_summary_df, on='pdb_id', how='left')
 
-prediction_summary_path = f'{evaluation_dir}/prediction_reference.csv'
-prediction_summary_df = pd.read_csv(prediction_summary_path)
+        if target_type in ["monomer_dna","monomer_rna","monomer_protein"] and args.monomer_scorer == 'native':
+            eval_monomer(target_df,target_type,evaluation_dir,args.ground_truth_dir,max_workers=args.max_workers)
 
-# caculation
-for target_type in target_types:
-    target_df_path = f'{args.targets_dir}/{target_type}.csv'
-    if not os.path.exists(target_df_path):
-        print(f"target_df_path is not exists for {target_type}")
-        continue
-    target_df = pd.read_csv(target_df_path)
+        elif target_type in  ["interface_protein_protein","interface_antibody_antigen","interface_protein_peptide","interface_protein_ligand","interface_protein_dna","interface_protein_rna","monomer_dna","monomer_rna","monomer_protein"]:
+            eval_by_ost(target_df,target_type,evaluation_dir,args.ground_truth_dir,ost_workers=args.ost_workers,result_cache_path=args.result_cache,max_workers=args.max_workers,job_timeout=args.job_timeout)
 
-    target_df = pd.merge(target_df,prediction_summary_df, on='pdb_id', how='left')
+            if target_type in  ["interface_protein_dna","interface_protein_rna"]:
+                eval_by_dockqv2(target_df,target_type,evaluation_dir,args.ground_truth_dir,kdtree=args.dockq_kdtree,max_chain_maps=args.dockq_max_chain_maps)
 
-    if target_type in  ["interface_protein_protein","interface_antibody_antigen","interface_protein_peptide","interface_protein_ligand","interface_protein_dna","interface_protein_rna","monomer_dna","monomer_rna","monomer_protein"]:
-        eval_by_ost(target_df,target_type,evaluation_dir,args.ground_truth_dir)
-    
-        if target_type in  ["interface_protein_dna","interface_protein_rna"]:
-            eval_by_dockqv2(target_df,target_type,evaluation_dir,args.ground_truth_dir)
\ No newline at end of file
+# queue workers leave their records in the spool, --finalize merges them
+if args.profile and not args.queue_worker:
+    profile_path = profiling.write_profile(profile_spool_dir, os.path.join(evaluation_dir, 'profile.parquet'))
+    if profile_path is not None:
+        print(f"Profile written to {profile_path}")
@@ -6,10 +6,12 @@ import gzip
 import math
 import logging
 import itertools
+import threading
 import traceback
 from collections import Counter
 from argparse import ArgumentParser
-from functools import lru_cache, partial
+from contextlib import contextmanager
+from functools import lru_cache, partial, wraps
 
 import numpy as np
 from Bio import Align
@@ -28,6 +30,55 @@ except ImportError:
     from .operations_nocy import residue_distances, get_fnat_stats
     from .parsers import PDBParser, MMCIFParser
     from .constants import *
+from .operations_nocy import residue_distances_within_cutoff
+from .. import profiling
+
+# When set, residue distances are only computed for atom pairs within this cutoff
+# (KD-tree search) and all other residue pairs are inf. Must be >= every threshold used.
+RESIDUE_DISTANCE_CUTOFF = None
+
+# Number of sequence alignments kept by align_sequences, shared by all structures of a process
+ALIGNMENT_CACHE_SIZE = 4096
+
+# Caches of the functions taking parsed chains or residues (chain_cache). They only live
+# inside a chain_cache_scope, so no parsed structure is kept alive once its target is scored.
+_chain_caches = threading.local()
+
+
+def set_residue_distance_cutoff(cutoff):
+    global RESIDUE_DISTANCE_CUTOFF
+    RESIDUE_DISTANCE_CUTOFF = cutoff
+
+
+@contextmanager
+def chain_cache_scope():
+    """
+    Scope of the chain caches, usable as `with chain_cache_scope():` or as a decorator.
+    A nested scope shares the caches of the outer one.
+    """
+    if getattr(_chain_caches, 'caches', None) is not None:
+        yield
+        return
+    _chain_caches.caches = {}
+    try:
+        yield
+    finally:
+        _chain_caches.caches = None
+
+
+def chain_cache(function):
+    """Memoize function within the current chain_cache_scope, no caching outside of one."""
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        caches = getattr(_chain_caches, 'caches', None)
+        if caches is None:
+            return function(*args, **kwargs)
+        cache = caches.setdefault(function, {})
+        key = (args, tuple(sorted(kwargs.items())))
+        if key not in cache:
+            cache[key] = function(*args, **kwargs)
+        return cache[key]
+    return wrapper
 
 
 def parse_args():
@@ -63,6 +114,18 @@ def parse_args():
     parser.add_argument(
         "--verbose", "-v", default=False, action="store_true", help="Verbose output"
     )
+    parser.add_argument(
+        "--max_chain_maps",
+        default=None,
+        type=int,
+        help="Build chain maps chain by chain, keep only the best ones by chain centroid distances and run DockQ on them (heuristic, may miss the best mapping; off by default)",
+    )
+    parser.add_argument(
+        "--kdtree",
+        default=False,
+        action="store_true",
+        help="Only compute atom distances within the interface threshold (KD-tree search)",
+    )
     parser.add_argument(
         "--no_align",
         action="store_true",
@@ -107,7 +170,7 @@ def parse_args():
     return parser.parse_args()
 
 
-@lru_cache
+@chain_cache
 def get_aligned_residues(chainA, chainB, alignment):
     aligned_resA = []
     aligned_resB = []
@@ -130,7 +193,8 @@ def get_aligned_residues(chainA, chainB, alignment):
     return tuple(aligned_resA), tuple(aligned_resB)
 
 
-@lru_cache
+@chain_cache
+@profiling.timed('residue_distances')
 def get_residue_distances(chain1, chain2, what, all_atom=True):
     if all_atom:
         # how many atoms per aligned amino acid
@@ -160,12 +224,22 @@ def get_residue_distances(chain1, chain2, what, all_atom=True):
         n_atoms_per_res_chain1 = np.ones(model_A_atoms.shape[0]).astype(int)
         n_atoms_per_res_chain2 = np.ones(model_B_atoms.shape[0]).astype(int)
 
-    model_res_distances = residue_distances(
-        model_A_atoms, model_B_atoms, n_atoms_per_res_chain1, n_atoms_per_res_chain2
-    )
+    if RESIDUE_DISTANCE_CUTOFF is None:
+        model_res_distances = residue_distances(
+            model_A_atoms, model_B_atoms, n_atoms_per_res_chain1, n_atoms_per_res_chain2
+        )
+    else:
+        model_res_distances = residue_distances_within_cutoff(
+            model_A_atoms,
+            model_B_atoms,
+            n_atoms_per_res_chain1,
+            n_atoms_per_res_chain2,
+            RESIDUE_DISTANCE_CUTOFF,
+        )
     return model_res_distances
 
 
+@profiling.timed('dockq_kernel')
 def calc_sym_corrected_lrmsd(
     sample_chains,
     ref_chains,
@@ -217,7 +291,6 @@ def calc_sym_corrected_lrmsd(
     sample_ligand_atoms_ele = [atom.element for atom in sample_ligand.get_atoms()]
 
     ref_ligand_atoms_ids = [atom.id for atom in ref_ligand.get_atoms()]
-    ref_ligand_atoms_ele = [atom.element for atom in ref_ligand.get_atoms()]
 
     sample_ligand_atoms = np.array(
         [
@@ -245,21 +318,20 @@ def calc_sym_corrected_lrmsd(
     sample_rotated_ligand_atoms = np.dot(sample_ligand_atoms, rot) + tran
 
     sample_graph = create_graph(sample_ligand_atoms, sample_ligand_atoms_ele)
-    ref_graph = create_graph(ref_ligand_atoms, ref_ligand_atoms_ele)
+    ref_graph, automorphisms = ligand_automorphisms(ref_ligand, tuple(sample_ligand_atoms_ids))
 
     min_lrms = float("inf")
     best_mapping = None
 
-    for isomorphism in nx.vf2pp_all_isomorphisms(sample_graph, ref_graph):
-        model_i = list(isomorphism.keys())
-        native_i = list(isomorphism.values())
-
-        lrms = super_imposer._rms(
-            sample_rotated_ligand_atoms[model_i], ref_ligand_atoms[native_i]
-        )
-        if lrms < min_lrms:
-            best_mapping = isomorphism
-            min_lrms = lrms
+    # every isomorphism sample -> ref is one of them followed by an automorphism of ref
+    isomorphism = nx.vf2pp_isomorphism(sample_graph, ref_graph)
+    if isomorphism is not None:
+        model_i = np.arange(len(sample_ligand_atoms))
+        permutations = automorphisms[:, [isomorphism[i] for i in model_i]]
+        lrms = batched_ligand_rms(sample_rotated_ligand_atoms, ref_ligand_atoms, permutations)
+        best = int(np.argmin(lrms))
+        best_mapping = dict(zip(model_i.tolist(), permutations[best].tolist()))
+        min_lrms = lrms[best]
     dockq = dockq_formula(0, 0, min_lrms)
     info = {
         "DockQ": dockq,
@@ -271,6 +343,7 @@ def calc_sym_corrected_lrmsd(
 
 
 # @profile
+@profiling.timed('dockq_kernel')
 def calc_DockQ(
     sample_chains,
     ref_chains,
@@ -436,7 +509,7 @@ def dockq_formula(fnat, irms, lrms):
     ) / 3
 
 
-@lru_cache
+@profiling.timed('align_chains')
 def align_chains(model_chain, native_chain, use_numbering=False):
     """
     Function to align two PDB structures. This can be done by sequence (default) or by
@@ -467,14 +540,21 @@ def align_chains(model_chain, native_chain, use_numbering=False):
         model_sequence = model_chain.sequence
         native_sequence = native_chain.sequence
 
+    return align_sequences(model_sequence, native_sequence, "numbering" if use_numbering else "sequence")
+
+
+@lru_cache(maxsize=ALIGNMENT_CACHE_SIZE)
+def align_sequences(model_sequence, native_sequence, mode="sequence"):
+    """
+    Best global alignment of two sequences (or numbering strings, mode="numbering").
+    Keyed by the strings only, so it is shared by every model and native with the same chains.
+    """
     aligner = Align.PairwiseAligner()
     aligner.match = 5
     aligner.mismatch = 0
     aligner.open_gap_score = -4
     aligner.extend_gap_score = -0.5
-    aln = aligner.align(model_sequence, native_sequence)[0]
-    aln = aligner.align(model_sequence, native_sequence)[0]
-    return aln
+    return aligner.align(model_sequence, native_sequence)[0]
 
 
 def format_alignment(aln):
@@ -497,7 +577,7 @@ def format_alignment(aln):
     return alignment
 
 
-@lru_cache
+@chain_cache
 def list_atoms_per_residue(chain, what):
     n_atoms_per_residue = []
 
@@ -513,7 +593,7 @@ def get_interacting_pairs(distances, threshold):
     return tuple(interacting_pairs[0]), tuple(interacting_pairs[1])
 
 
-@lru_cache
+@chain_cache
 def subset_atoms(
     mod_chain,
     ref_chain,
@@ -548,7 +628,7 @@ def subset_atoms(
     return mod_atoms, ref_atoms
 
 
-@lru_cache
+@chain_cache
 def run_on_chains(
     model_chains,
     native_chains,
@@ -592,18 +672,42 @@ def create_graph(atom_list, atom_ids):
 
     G = nx.Graph()
 
-    for i, atom_i in enumerate(atom_list):
-        cr_i = COVALENT_RADIUS[atom_ids[i]]
-        for j, atom_j in enumerate(atom_list):
-            cr_j = COVALENT_RADIUS[atom_ids[j]]
-            distance = np.linalg.norm(atom_i - atom_j)
-            threshold = (cr_i + cr_j + BOND_TOLERANCE) if i != j else 1
-            if distance < threshold:  # Adjust threshold as needed
-                G.add_edge(i, j)
+    atoms = np.asarray(atom_list)
+    radii = np.asarray([COVALENT_RADIUS[atom_ids[i]] for i in range(len(atoms))])
+    distances = np.linalg.norm(atoms[:, None] - atoms[None, :], axis=-1)
+    thresholds = radii[:, None] + radii[None, :] + BOND_TOLERANCE
+    np.fill_diagonal(thresholds, 1)
+    # edges in the same (row-major) order as the pairwise loop, so the nodes are too
+    G.add_edges_from(zip(*(indices.tolist() for indices in np.nonzero(distances < thresholds))))
 
     return G
 
 
+@chain_cache
+def ligand_automorphisms(ref_ligand, atom_ids):
+    """
+    Bond graph of the atoms of ref_ligand that are in atom_ids and all its automorphisms,
+    as an (n_automorphisms, n_atoms) array. Computed once per reference ligand and target.
+    """
+    import networkx as nx
+
+    ref_ligand_atoms_ele = [atom.element for atom in ref_ligand.get_atoms()]
+    ref_ligand_atoms = np.array(
+        [atom.coord for atom in ref_ligand.get_atoms() if atom.id in atom_ids]
+    )
+    graph = create_graph(ref_ligand_atoms, ref_ligand_atoms_ele)
+    nodes = range(len(ref_ligand_atoms))
+    automorphisms = [[automorphism[i] for i in nodes] for automorphism in nx.vf2pp_all_isomorphisms(graph, graph)]
+    return graph, np.asarray(automorphisms, dtype=int).reshape(len(automorphisms), len(nodes))
+
+
+def batched_ligand_rms(sample_atoms, ref_atoms, permutations):
+    """RMS between sample_atoms and ref_atoms[permutation] for every row of permutations, at once."""
+    diff = sample_atoms[None] - ref_atoms[permutations]
+    # summed over atoms first, like SVDSuperimposer._rms
+    return np.sqrt((diff * diff).sum(axis=1).sum(axis=-1) / len(sample_atoms))
+
+
 def run_on_all_native_interfaces(
     model_structure,
     native_structure,
@@ -650,6 +754,7 @@ def run_on_all_native_interfaces(
     return result_mapping, total_dockq
 
 
+@profiling.timed('parse_cif')
 def load_PDB(path, chains=[], small_molecule=False, n_model=0):
     try:
         pdb_parser = PDBParser(QUIET=True)
@@ -826,6 +931,27 @@ Make sure that all chains in your model have a homologous chain in the native, o
     return number_of_combinations
 
 
+def to_chain_map(
+    mapping, initial_mapping, reverse_map, model_chains_to_combo, native_chains_to_combo
+):
+    chain_map = {key: value for key, value in initial_mapping.items()}
+    if reverse_map:
+        chain_map.update(
+            {
+                mapping[i]: model_chain
+                for i, model_chain in enumerate(model_chains_to_combo)
+            }
+        )
+    else:
+        chain_map.update(
+            {
+                native_chain: mapping[i]
+                for i, native_chain in enumerate(native_chains_to_combo)
+            }
+        )
+    return chain_map
+
+
 def get_all_chain_maps(
     chain_clusters,
     initial_mapping,
@@ -837,22 +963,115 @@ def get_all_chain_maps(
         *[cluster for cluster in chain_clusters.values() if cluster]
     )
     for mapping in all_mappings:
-        chain_map = {key: value for key, value in initial_mapping.items()}
-        if reverse_map:
-            chain_map.update(
-                {
-                    mapping[i]: model_chain
-                    for i, model_chain in enumerate(model_chains_to_combo)
-                }
-            )
-        else:
-            chain_map.update(
-                {
-                    native_chain: mapping[i]
-                    for i, native_chain in enumerate(native_chains_to_combo)
-                }
-            )
-        yield chain_map
+        yield to_chain_map(
+            mapping,
+            initial_mapping,
+            reverse_map,
+            model_chains_to_combo,
+            native_chains_to_combo,
+        )
+
+
+def chain_centroid(chain):
+    return np.asarray([atom.coord for atom in chain.get_atoms()]).mean(axis=0)
+
+
+@profiling.timed('prune_chain_maps')
+def prune_chain_maps(
+    model_structure,
+    native_structure,
+    chain_clusters,
+    initial_mapping,
+    reverse_map,
+    model_chains_to_combo,
+    native_chains_to_combo,
+    top_k,
+):
+    """
+    Cheap alternative to get_all_chain_maps for targets with many chain maps: the maps
+    are built one chain at a time, in the order of get_all_chain_maps, and after every
+    chain only the best partial maps (a beam of the squared cluster size) are kept, so
+    the maps are never all enumerated. A partial map is scored by how well the distances
+    between its model chain centroids match the distances between the mapped native
+    chain centroids (superposition-free centroid RMSD). This is only a heuristic, the map with the best DockQ can be pruned, so it
+    is opt-in and off by default.
+    Returns at most top_k chain maps, in the order of get_all_chain_maps.
+    """
+    # the first chains say little about the fit, so more partial maps than top_k are kept
+    beam_width = max(
+        [top_k] + [len(cluster) ** 2 for cluster in chain_clusters.values()]
+    )
+    clusters = [(key, cluster) for key, cluster in chain_clusters.items() if cluster]
+    chain_index = {}
+    for _, cluster in clusters:
+        for value in cluster:
+            chain_index.setdefault(value, len(chain_index))
+
+    centroids = {}
+
+    def centroid(structure, chain):
+        if (structure.id, chain) not in centroids:
+            centroids[structure.id, chain] = chain_centroid(structure[chain])
+        return centroids[structure.id, chain]
+
+    def pair(key, value):
+        # (native chain, model chain) of assigning value to the chain cluster key
+        return (value, key) if reverse_map else (key, value)
+
+    # the partial maps of the beam, in the order of get_all_chain_maps:
+    # cluster indices [B, n_chain], native and model centroids [B, n_pair, 3],
+    # chosen chains [B, n_chains_total] and cost [B]
+    indices = np.zeros((1, 0), dtype=int)
+    natives = np.asarray(
+        [centroid(native_structure, native) for native in initial_mapping]
+    ).reshape(1, -1, 3)
+    models = np.asarray(
+        [centroid(model_structure, model) for model in initial_mapping.values()]
+    ).reshape(1, -1, 3)
+    used = np.zeros((1, len(chain_index)), dtype=bool)
+    costs = np.zeros(1)
+    for key, cluster in clusters:
+        cluster_native = np.asarray(
+            [centroid(native_structure, pair(key, value)[0]) for value in cluster]
+        )
+        cluster_model = np.asarray(
+            [centroid(model_structure, pair(key, value)[1]) for value in cluster]
+        )
+        cluster_ids = np.asarray([chain_index[value] for value in cluster])
+        # [B, n_cluster]
+        native_distances = np.linalg.norm(
+            cluster_native[None, :, None] - natives[:, None], axis=-1
+        )
+        model_distances = np.linalg.norm(
+            cluster_model[None, :, None] - models[:, None], axis=-1
+        )
+        candidate_costs = costs[:, None] + (
+            (model_distances - native_distances) ** 2
+        ).sum(axis=-1)
+        candidate_costs[used[:, cluster_ids]] = np.inf
+        # row-major order is the order of get_all_chain_maps, the stable sort keeps it for ties
+        candidate_costs = candidate_costs.reshape(-1)
+        kept = np.argsort(candidate_costs, kind="stable")[:beam_width]
+        kept = np.sort(kept[np.isfinite(candidate_costs[kept])])
+        entry, k = np.divmod(kept, len(cluster))
+        indices = np.concatenate([indices[entry], k[:, None]], axis=-1)
+        natives = np.concatenate([natives[entry], cluster_native[k][:, None]], axis=1)
+        models = np.concatenate([models[entry], cluster_model[k][:, None]], axis=1)
+        used = used[entry]
+        used[np.arange(len(kept)), cluster_ids[k]] = True
+        costs = candidate_costs[kept]
+
+    kept = np.sort(np.argsort(costs, kind="stable")[:top_k])
+    return [
+        to_chain_map(
+            tuple(cluster[k] for (_, cluster), k in zip(clusters, indices[i])),
+            initial_mapping,
+            reverse_map,
+            model_chains_to_combo,
+            native_chains_to_combo,
+        )
+        for i in kept
+    ]
 
 
 def get_chain_map_from_dockq(result):
@@ -864,8 +1083,11 @@ def get_chain_map_from_dockq(result):
 
 
 # @profile
+@chain_cache_scope()
 def main():
     args = parse_args()
+    if args.kdtree:
+        set_residue_distance_cutoff(INTERFACE_THRESHOLD)
 
     initial_mapping, model_chains, native_chains = format_mapping(
         args.mapping, args.small_molecule
@@ -905,15 +1127,29 @@ def main():
         native_chains_to_combo,
         args.allowed_mismatches,
     )
-    chain_maps = get_all_chain_maps(
-        chain_clusters,
-        initial_mapping,
-        reverse_map,
-        model_chains_to_combo,
-        native_chains_to_combo,
-    )
-
     num_chain_combinations = count_chain_combinations(chain_clusters)
+    if args.max_chain_maps and num_chain_combinations > args.max_chain_maps:
+        chain_maps = prune_chain_maps(
+            model_structure,
+            native_structure,
+            chain_clusters,
+            initial_mapping,
+            reverse_map,
+            model_chains_to_combo,
+            native_chains_to_combo,
+            args.max_chain_maps,
+        )
+        logging.info(f"Pruned {num_chain_combinations - len(chain_maps)} chain maps")
+        num_chain_combinations = len(chain_maps)
+        chain_maps = iter(chain_maps)
+    else:
+        chain_maps = get_all_chain_maps(
+            chain_clusters,
+            initial_mapping,
+            reverse_map,
+            model_chains_to_combo,
+            native_chains_to_combo,
+        )
     # copy iterator to use later
     chain_maps, chain_maps_ = itertools.tee(chain_maps)
 
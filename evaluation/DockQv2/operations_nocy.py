@@ -8,19 +8,19 @@ def get_distances_across_chains(model_A_atoms, model_B_atoms):
     return distances
 
 
+def residue_starts(atoms_per_res):
+    return np.concatenate(([0], np.cumsum(atoms_per_res)[:-1])).astype(int)
+
+
 def atom_distances_to_residue_distances(atom_distances, atoms_per_res1, atoms_per_res2):
-    res_distances = np.zeros((len(atoms_per_res1), len(atoms_per_res2)))
-
-    cum_i_atoms = 0
-    for i, i_atoms in enumerate(atoms_per_res1):
-        cum_j_atoms = 0
-        for j, j_atoms in enumerate(atoms_per_res2):
-            res_distances[i, j] = atom_distances[
-                cum_i_atoms : cum_i_atoms + i_atoms, cum_j_atoms : cum_j_atoms + j_atoms
-            ].min()
-            cum_j_atoms += j_atoms
-        cum_i_atoms += i_atoms
-    return res_distances
+    if len(atoms_per_res1) == 0 or len(atoms_per_res2) == 0:
+        return np.zeros((len(atoms_per_res1), len(atoms_per_res2)))
+
+    # segmented min over the atoms of each residue, first along rows then along columns
+    atom_distances = atom_distances[: np.sum(atoms_per_res1), : np.sum(atoms_per_res2)]
+    res_distances = np.minimum.reduceat(atom_distances, residue_starts(atoms_per_res1), axis=0)
+    res_distances = np.minimum.reduceat(res_distances, residue_starts(atoms_per_res2), axis=1)
+    return res_distances.astype(np.float64)
 
 
 def residue_distances(
@@ -34,6 +34,36 @@ def residue_distances(
     return res_distances
 
 
+def residue_distances_within_cutoff(
+    atom_coordinates1, atom_coordinates2, atoms_per_res1, atoms_per_res2, cutoff
+):
+    """
+    Same as residue_distances, but only atom pairs closer than cutoff are computed
+    (KD-tree search). Residue pairs without any such atom pair are set to inf.
+    """
+    from scipy.spatial import cKDTree
+
+    res_distances = np.full((len(atoms_per_res1), len(atoms_per_res2)), np.inf)
+    if res_distances.size == 0:
+        return res_distances
+
+    atom_coordinates1 = atom_coordinates1[: np.sum(atoms_per_res1)]
+    atom_coordinates2 = atom_coordinates2[: np.sum(atoms_per_res2)]
+    # small margin so that float32 squared distances at the cutoff are not missed
+    pairs = cKDTree(atom_coordinates1).sparse_distance_matrix(
+        cKDTree(atom_coordinates2), cutoff + 1e-3, output_type="ndarray"
+    )
+    atoms1 = pairs["i"]
+    atoms2 = pairs["j"]
+    # squared distances computed exactly like get_distances_across_chains
+    distances = ((atom_coordinates1[atoms1] - atom_coordinates2[atoms2]) ** 2).sum(-1)
+
+    residue_index1 = np.repeat(np.arange(len(atoms_per_res1)), atoms_per_res1)
+    residue_index2 = np.repeat(np.arange(len(atoms_per_res2)), atoms_per_res2)
+    np.minimum.at(res_distances, (residue_index1[atoms1], residue_index2[atoms2]), distances)
+    return res_distances
+
+
 def get_fnat_stats(model_res_distances, native_res_distances, threshold=5.0):
     native_contacts = native_res_distances < threshold ** 2
     model_contacts = model_res_distances < threshold ** 2
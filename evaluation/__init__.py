@@ -1,2 +1,7 @@
 from .eval_by_ost import eval_by_ost
 from .eval_by_dockqv2 import eval_by_dockqv2
+from .score_target import score_target
+from .eval_monomer import eval_monomer
+from .handoff import eval_handoff
+from .job_graph import eval_job_graph
+from .work_queue import run_queue_worker, finalize_queue
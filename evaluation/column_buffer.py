@@ -0,0 +1,23 @@
+import pandas as pd
+
+
+class ColumnBuffer():
+    """Collects result records column by column, the DataFrame is built once at the end."""
+
+    def __init__(self):
+        self.columns = {}
+        self.n_rows = 0
+
+    def append(self, record):
+        for key in record:
+            if key not in self.columns:
+                self.columns[key] = [None] * self.n_rows
+        for key, column in self.columns.items():
+            column.append(record.get(key))
+        self.n_rows += 1
+
+    def __len__(self):
+        return self.n_rows
+
+    def to_frame(self):
+        return pd.DataFrame(self.columns)
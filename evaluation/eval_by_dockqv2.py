@@ -4,8 +4,13 @@ from .DockQv2.DockQ import (
     run_on_all_native_interfaces,
     group_chains,
     get_all_chain_maps,
+    prune_chain_maps,
     count_chain_combinations,
-    format_mapping
+    format_mapping,
+    get_residue_distances,
+    set_residue_distance_cutoff,
+    chain_cache_scope,
+    INTERFACE_THRESHOLD
 )
 import itertools
 from functools import partial
@@ -17,6 +22,9 @@ from multiprocessing import Pool
 import traceback
 import numpy as np
 from concurrent.futures import ProcessPoolExecutor, as_completed
+from . import profiling
+from .column_buffer import ColumnBuffer
+from .scheduler import count_cif_atoms
 
 AMINO_ACIDS = {
     'ALA', 'ARG', 'ASN', 'ASP', 'CYS',
@@ -111,7 +119,32 @@ def reformat_het(structure):
 
 
 
-def dockq(model_path, native_path, model_chains=None, native_chains=None, small_molecule=False, allowed_mismatches=0):
+def load_native(native_path, small_molecule=False):
+    """
+    Parse and reformat a native (ground truth) structure.
+    The returned structure can be shared by all predictions of the same target.
+    """
+    native_structure = load_PDB(
+        native_path, small_molecule=small_molecule
+    )
+    native_structure = reformat_het(native_structure)
+    native_structure = reformat_type(native_structure)
+    return native_structure
+
+
+# opt-in chain map pruning of the benchmark, set in the worker processes by set_dockqv2_options
+MAX_CHAIN_MAPS = None
+
+
+def set_dockqv2_options(distance_cutoff=None, max_chain_maps=None):
+    """Pool initializer: the residue distance cutoff and chain map pruning of the DockQv2 jobs."""
+    global MAX_CHAIN_MAPS
+    set_residue_distance_cutoff(distance_cutoff)
+    MAX_CHAIN_MAPS = max_chain_maps
+
+
+@chain_cache_scope()
+def dockq(model_path, native_path, model_chains=None, native_chains=None, small_molecule=False, allowed_mismatches=0, native_structure=None, max_chain_maps=None):
     """
     Calculate the DockQ scores for a predicted structure.
 
@@ -122,6 +155,8 @@ def dockq(model_path, native_path, model_chains=None, native_chains=None, small_
     - native_chains (list): A list of chain IDs in the native structure to consider. If None, all chains will be considered.
     - small_molecule (bool): Whether the structure contains a small molecule ligand. Default is False.
     - allowed_mismatches (int): The maximum number of allowed mismatches between model and native chains. Default is 0.
+    - native_structure: The already parsed native structure from load_native. If None, native_path is parsed.
+    - max_chain_maps (int): Opt-in pruning. If more chain maps are possible, only max_chain_maps of them, built chain by chain from the best partial maps by chain centroid distances (prune_chain_maps), are scored with DockQ. The screen is a heuristic and can drop the best mapping. Default is None, which scores all of them.
     """
 
     initial_mapping = {}
@@ -130,14 +165,11 @@ def dockq(model_path, native_path, model_chains=None, native_chains=None, small_
         model_path, small_molecule=small_molecule
     )
 
-    native_structure = load_PDB(
-        native_path, small_molecule=small_molecule
-    )
+    if native_structure is None:
+        native_structure = load_native(native_path, small_molecule=small_molecule)
 
-    native_structure = reformat_het(native_structure)
     model_structure = reformat_het(model_structure)
     model_structure = reformat_type(model_structure)
-    native_structure = reformat_type(native_structure)
 
     model_chains = [
         c.id for c in model_structure] if model_chains is None else model_chains
@@ -156,22 +188,42 @@ def dockq(model_path, native_path, model_chains=None, native_chains=None, small_
         nc for nc in native_chains if nc not in initial_mapping.keys()
     ]
 
-    chain_clusters, reverse_map = group_chains(
-        model_structure,
-        native_structure,
-        model_chains_to_combo,
-        native_chains_to_combo,
-        allowed_mismatches=allowed_mismatches
-    )
-    chain_maps = get_all_chain_maps(
-        chain_clusters,
-        initial_mapping,
-        reverse_map,
-        model_chains_to_combo,
-        native_chains_to_combo,
-    )
-
+    with profiling.stage('group_chains'):
+        chain_clusters, reverse_map = group_chains(
+            model_structure,
+            native_structure,
+            model_chains_to_combo,
+            native_chains_to_combo,
+            allowed_mismatches=allowed_mismatches
+        )
     num_chain_combinations = count_chain_combinations(chain_clusters)
+    num_chain_maps = num_chain_combinations
+    num_pruned_chain_maps = 0
+    if max_chain_maps and num_chain_combinations > max_chain_maps:
+        # the maps are pruned while they are built, they are never all enumerated
+        chain_maps = prune_chain_maps(
+            model_structure,
+            native_structure,
+            chain_clusters,
+            initial_mapping,
+            reverse_map,
+            model_chains_to_combo,
+            native_chains_to_combo,
+            max_chain_maps,
+        )
+        num_pruned_chain_maps = num_chain_combinations - len(chain_maps)
+        num_chain_combinations = len(chain_maps)
+        chain_maps = iter(chain_maps)
+    else:
+        chain_maps = get_all_chain_maps(
+            chain_clusters,
+            initial_mapping,
+            reverse_map,
+            model_chains_to_combo,
+            native_chains_to_combo,
+        )
+    profiling.set_value('n_chain_maps_total', num_chain_maps)
+    profiling.set_value('n_chain_maps', num_chain_combinations)
     # copy iterator to use later
     chain_maps, chain_maps_ = itertools.tee(chain_maps)
 
@@ -207,11 +259,13 @@ def dockq(model_path, native_path, model_chains=None, native_chains=None, small_
     info["best_result"] = best_result
     info["GlobalDockQ"] = best_dockq / len(best_result)
     info["best_mapping"] = best_mapping
+    info["num_chain_maps"] = num_chain_maps
+    info["num_pruned_chain_maps"] = num_pruned_chain_maps
 
     return info
 
 
-def process_single_case(args):
+def process_single_case(args, native_structure=None):
     
     row, ground_truth_path, detail_path, mode= args
 
@@ -239,44 +293,91 @@ def process_single_case(args):
     else:
         small_molecule = False
 
-    try:
-        info = dockq(
-            model_path=prediction_path,
-            native_path=native_path,
-            native_chains=[interface_chain_id_1, interface_chain_id_2],
-            small_molecule=small_molecule,
-            allowed_mismatches=4
-        )
-
-        if info is None:
+    with profiling.sample(tool='dockqv2', pdb_id=pdb_id, seed=seed, sample=sample, mode=mode,
+                          interface_chain_id_1=interface_chain_id_1, interface_chain_id_2=interface_chain_id_2):
+        try:
+            if profiling.active():
+                profiling.set_value('n_atoms_native', count_cif_atoms(native_path))
+                profiling.set_value('n_atoms_model', count_cif_atoms(prediction_path))
+            info = dockq(
+                model_path=prediction_path,
+                native_path=native_path,
+                native_chains=[interface_chain_id_1, interface_chain_id_2],
+                small_molecule=small_molecule,
+                allowed_mismatches=4,
+                native_structure=native_structure,
+                max_chain_maps=MAX_CHAIN_MAPS
+            )
+
+            if info is None:
+                return None
+            else:
+                json.dump(info, open(output_path, 'w'), cls=NumpyEncoder)
+
+            
+            key = list(info['best_result'].keys())[0]
+            best_result = info["best_result"][key]
+            
+            result.update({
+                'lrmsd': best_result["LRMSD"],
+                'irmsd': best_result["iRMSD"],
+                'dockq_score': best_result["DockQ"]
+            })
+            
+            return result
+            
+        except BaseException as e:
+            print(f"Error when calculating dockq for {pdb_id} with seed {seed} and sample {sample}")
+            print(traceback.format_exc())
             return None
-        else:
-            json.dump(info, open(output_path, 'w'), cls=NumpyEncoder)
-
-        
-        key = list(info['best_result'].keys())[0]
-        best_result = info["best_result"][key]
-        
-        result.update({
-            'lrmsd': best_result["LRMSD"],
-            'irmsd': best_result["iRMSD"],
-            'dockq_score': best_result["DockQ"]
-        })
-        
-        return result
-        
-    except BaseException as e:
-        print(f"Error when calculating dockq for {pdb_id} with seed {seed} and sample {sample}")
-        print(traceback.format_exc())
-        return None
-
-
-
 
 
+@chain_cache_scope()
+def process_target_cases(args):
+    """
+    Score all predictions of one target. The native is parsed once, and its
+    residue distances for each requested interface are computed once and shared
+    (through the get_residue_distances cache) by every prediction. The chain caches
+    are dropped when the target is done.
+    """
+    rows, ground_truth_path, detail_path, mode = args
 
+    pdb_id = rows[0]["pdb_id"]
+    native_path = os.path.join(ground_truth_path, f'{pdb_id}.cif')
+    small_molecule = mode == 'ligand'
+
+    # the shared native work, profiled as a record of its own
+    with profiling.sample(tool='dockqv2_native', pdb_id=pdb_id, mode=mode):
+        try:
+            native_structure = load_native(native_path, small_molecule=small_molecule)
+            for chain_pair in set((row["interface_chain_id_1"], row["interface_chain_id_2"]) for row in rows):
+                if chain_pair[0] in native_structure and chain_pair[1] in native_structure:
+                    get_residue_distances(native_structure[chain_pair[0]], native_structure[chain_pair[1]], "ref")
+        except BaseException as e:
+            print(f"Error when loading native structure for {pdb_id}")
+            print(traceback.format_exc())
+            return []
 
-def eval_by_dockqv2(target_df,interface_type,evaluation_dir,ground_truth_dir,max_workers = 32):
+    results = []
+    for row in rows:
+        try:
+            result = process_single_case((row, ground_truth_path, detail_path, mode), native_structure=native_structure)
+        except Exception as e:
+            print(f"Error occurred for {pdb_id} with seed {row['seed']} and sample {row['sample']}")
+            print(traceback.format_exc())
+            continue
+        if result is not None:
+            results.append(result)
+    return results
+
+
+def eval_by_dockqv2(target_df,interface_type,evaluation_dir,ground_truth_dir,max_workers = 32,kdtree = False,max_chain_maps = None):
+    """
+    Score every prediction in target_df with DockQv2.
+    With kdtree=True residue distances are only computed for atom pairs within the
+    interface threshold, which gives the same fnat/iRMSD/LRMSD without dense distance matrices.
+    With max_chain_maps, targets with more chain maps only score that many (see dockq).
+    """
     
     exported_path = evaluation_dir
     detail_path = os.path.join(exported_path, 'detail')
@@ -288,26 +389,29 @@ def eval_by_dockqv2(target_df,interface_type,evaluation_dir,ground_truth_dir,max
     elif interface_type == "ligand":
         mode = "ligand"
     
+    # one task per target, so the native is only parsed once for all its predictions
     tasks = []
-    for index, row in target_df.iterrows():
+    for pdb_id, group_df in target_df.groupby('pdb_id', sort=False):
         tasks.append((
-                row,
+                group_df.to_dict('records'),
                 ground_truth_dir,
                 detail_path,
                 mode
             ))
     
     
-    results = []
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+    results = ColumnBuffer()
+    distance_cutoff = INTERFACE_THRESHOLD if kdtree else None
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=set_dockqv2_options, initargs=(distance_cutoff, max_chain_maps)) as executor:
 
-        future_to_task = {executor.submit(process_single_case, task): task for task in tasks}
+        future_to_task = {executor.submit(process_target_cases, task): task for task in tasks}
 
         for future in tqdm(as_completed(future_to_task), total=len(tasks)):
             try:
                 result = future.result(timeout=20)
-                if result is not None:  
-                    results.append(result)
+                for record in result:
+                    if isinstance(record, dict):
+                        results.append(record)
             except TimeoutError:
                 print("this took too long...")
                 task = future_to_task[future]
@@ -319,5 +423,5 @@ def eval_by_dockqv2(target_df,interface_type,evaluation_dir,ground_truth_dir,max
                 future.cancel()
 
     print(f"Total results for {interface_type}: {len(results)}")
-    df = pd.DataFrame(results)
+    df = results.to_frame()
     df.to_csv(os.path.join(evaluation_dir,'raw',f"{interface_type}_dockqv2.csv"), index=False)
\ No newline at end of file
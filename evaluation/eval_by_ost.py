@@ -15,25 +15,43 @@ import traceback
 import json
 import os
 
+from . import profiling
+from .ost_worker_pool import OSTWorkerPool
+from .result_cache import ResultCache, get_ost_version
+from .column_buffer import ColumnBuffer
+from .scheduler import available_workers, count_cif_atoms, order_largest_first, run_command
+
+OST_COMPARE_LIGAND_STRUCTURE_FLAGS = [
+    "--fault-tolerant",
+    "--lddt-pli", "--rmsd",
+]
+
+OST_COMPARE_STRUCTURE_FLAGS = [
+    "--fault-tolerant",
+    "--min-pep-length", "4",
+    "--min-nuc-length", "4",
+    "--lddt", "--rigid-scores", "--tm-score", "--dockq",
+]
+
 OST_COMPARE_LIGAND_STRUCTURE = r"""
 ost compare-ligand-structures \
 -m {model_file} \
 -r {reference_file} \
---fault-tolerant \
---lddt-pli --rmsd \
--o {output_path}
-"""
+-o {output_path} \
+""" + " ".join(OST_COMPARE_LIGAND_STRUCTURE_FLAGS)
 
 OST_COMPARE_STRUCTURE = r"""
     ost compare-structures \
         -m {model_file} \
         -r {reference_file} \
         -o {output_path} \
-        --fault-tolerant \
-        --min-pep-length 4 \
-        --min-nuc-length 4 \
-        --lddt --rigid-scores --tm-score --dockq \
-"""
+""" + " ".join(OST_COMPARE_STRUCTURE_FLAGS)
+
+# mode -> (ost action, flags)
+OST_ACTIONS = {
+    'ligand': ('compare-ligand-structures', OST_COMPARE_LIGAND_STRUCTURE_FLAGS),
+    'structure': ('compare-structures', OST_COMPARE_STRUCTURE_FLAGS),
+}
 
 def get_structure_value(output_path,native_chain_id_1,native_chain_id_2):
 
@@ -100,36 +118,34 @@ def evaluate_structure(
     reference,
     outdir: str,
     executable: str = "/bin/bash",
-    mode = 'ligand' # all, structure, ligand
-) -> None:
-    """Evaluate the structure."""
+    mode = 'ligand', # all, structure, ligand
+    worker_pool: OSTWorkerPool = None,
+    timeout: float = None,
+) -> dict:
+    """
+    Evaluate the structure. Runs on a resident ost worker if worker_pool is given.
+    A job running longer than timeout seconds is killed.
+    Returns the job record (returncode, wall_time, peak_rss_mb, timed_out).
+    """
+    if worker_pool is not None:
+        action, flags = OST_ACTIONS[mode]
+        return worker_pool.run(action, pred, reference, outdir, flags, timeout=timeout)
+
     if mode == 'ligand':
-        result = subprocess.run(
-            OST_COMPARE_LIGAND_STRUCTURE.format(
-                model_file=str(pred),
-                reference_file=str(reference),
-                output_path=os.path.join(outdir),
-                ),
-                shell=True,  # noqa: S602
-                check=False,
-                executable=executable,
-                capture_output=True,
-            )
+        command = OST_COMPARE_LIGAND_STRUCTURE
     elif mode == 'structure':
-        result = subprocess.run(
-            OST_COMPARE_STRUCTURE.format(
-                model_file=str(pred),
-                reference_file=str(reference),
-                output_path=os.path.join(outdir),
-                ),
-                shell=True,  # noqa: S602
-                check=False,
-                executable=executable,
-                capture_output=True,
-            )
-    return result
-
-def ost_evaluation(args):
+        command = OST_COMPARE_STRUCTURE
+    return run_command(
+        command.format(
+            model_file=str(pred),
+            reference_file=str(reference),
+            output_path=os.path.join(outdir),
+        ),
+        timeout=timeout,
+        executable=executable,
+    )
+
+def ost_evaluation(args, worker_pool=None, result_cache=None, timeout=None):
     row, ground_truth_path, detail_path, mode= args
 
     pdb_id = row["pdb_id"]
@@ -138,7 +154,7 @@ def ost_evaluation(args):
     prediction_path = row["prediction_path"]
 
     output_path = f'{detail_path}/{pdb_id}_{seed}_{sample}_{mode}_ost.json'
-    if os.path.exists(output_path):
+    if result_cache is None and os.path.exists(output_path):
         return "exist"
 
     if not os.path.exists(prediction_path):
@@ -146,18 +162,49 @@ def ost_evaluation(args):
         return "prediction_path is None"
     
     native_path = os.path.join(ground_truth_path, f'{pdb_id}.cif')
-    
-    try:
-        evaluate_structure(
-            pred = prediction_path,
-            reference = native_path,
-            outdir = output_path,
-            mode = mode
-        )
-    except BaseException as e:
-        print(f"Error when calculating dockq for {pdb_id} with seed {seed} and sample {sample}")
-        print(traceback.format_exc())
-        return "Error when calculating dockq"
+
+    with profiling.sample(tool='ost', pdb_id=pdb_id, seed=seed, sample=sample, mode=mode):
+        try:
+            if profiling.active():
+                profiling.set_value('n_atoms_native', count_cif_atoms(native_path))
+                profiling.set_value('n_atoms_model', count_cif_atoms(prediction_path))
+            if result_cache is not None:
+                action, flags = OST_ACTIONS[mode]
+                with profiling.stage('result_cache'):
+                    cache_key, cache_fields = result_cache.make_key(prediction_path, native_path, mode, [action, *flags], get_ost_version())
+                    cached_output = result_cache.get(cache_key)
+                if cached_output is not None:
+                    with open(output_path, 'w') as f:
+                        f.write(cached_output)
+                    return "cached"
+                # never keep a stale output if ost fails this time
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+
+            with profiling.stage('ost'):
+                job = evaluate_structure(
+                    pred = prediction_path,
+                    reference = native_path,
+                    outdir = output_path,
+                    mode = mode,
+                    worker_pool = worker_pool,
+                    timeout = timeout
+                )
+            profiling.set_value('ost_peak_rss_mb', job['peak_rss_mb'])
+            profiling.set_value('timed_out', job['timed_out'])
+            if job["timed_out"]:
+                print(f"Timeout when calculating ost for {pdb_id} with seed {seed} and sample {sample}")
+
+            if result_cache is not None and os.path.exists(output_path):
+                with open(output_path, 'r') as f:
+                    output = f.read()
+                json.loads(output)
+                result_cache.put(cache_key, cache_fields, output)
+            return job
+        except BaseException as e:
+            print(f"Error when calculating dockq for {pdb_id} with seed {seed} and sample {sample}")
+            print(traceback.format_exc())
+            return "Error when calculating dockq"
 
 def ost_get_result(args):
     
@@ -206,7 +253,8 @@ def ost_get_result(args):
                 'lddt':lddt,
                 'tm_score':tm_score,
                 'gdt_ts':gdt_ts,
-                'rmsd':rmsd
+                'rmsd':rmsd,
+                'scorer':'ost'
             })
 
         return result
@@ -215,69 +263,99 @@ def ost_get_result(args):
         print(traceback.format_exc())
         return None
 
+def ost_score(args, worker_pool=None, result_cache=None, timeout=None):
+    """
+    Run (or reuse) the ost evaluation of one prediction.
+    Returns its parsed metric record and its job record (None if ost did not run).
+    """
+    job = ost_job_record(args, ost_evaluation(args, worker_pool, result_cache, timeout))
+    return ost_get_result(args), job
 
 
-def eval_by_ost(target_df,target_type,evaluation_dir,ground_truth_dir,max_workers = 64):
+def ost_job_record(args, job):
+    """The job record of ost_evaluation with the prediction it belongs to, None if ost did not run."""
+    row, ground_truth_path, detail_path, mode = args
+    if not isinstance(job, dict):
+        return None
+    return {
+        'pdb_id': row['pdb_id'],
+        'seed': row['seed'],
+        'sample': row['sample'],
+        'mode': mode,
+        'n_atoms': count_cif_atoms(os.path.join(ground_truth_path, f"{row['pdb_id']}.cif")),
+        **job,
+    }
 
-    detail_path = os.path.join(evaluation_dir, 'detail')
-    if not os.path.exists(detail_path):
-        os.makedirs(detail_path)
 
+def ost_mode(target_type):
     mode = ''
-    
     if target_type in ["interface_protein_protein","interface_antibody_antigen","interface_protein_peptide","interface_protein_dna","interface_protein_rna","monomer_dna","monomer_rna","monomer_protein"]:
         mode = "structure"
     elif target_type == "interface_protein_ligand":
         mode = "ligand"
+    return mode
+
+
+def eval_by_ost(target_df,target_type,evaluation_dir,ground_truth_dir,max_workers = None,ost_workers = 0,result_cache_path = None,job_timeout = 600):
+    """
+    Score every prediction in target_df with OpenStructure.
+    With ost_workers > 0 the jobs run on that many resident ost processes instead of
+    launching `ost` once per sample.
+    With result_cache_path, outputs are reused only if the prediction, ground truth, flags
+    and ost version are unchanged, instead of whenever the output json exists.
+    max_workers defaults to what the available cores and memory allow. Jobs run largest
+    target first, every job is killed after job_timeout seconds, and the wall time and
+    peak RSS of every job are written to raw/{target_type}_ost_jobs.csv.
+    """
+
+    detail_path = os.path.join(evaluation_dir, 'detail')
+    if not os.path.exists(detail_path):
+        os.makedirs(detail_path)
+
+    mode = ost_mode(target_type)
     
-    tasks = []
-    for index, row in target_df.iterrows():
-        tasks.append((
-                row,
-                ground_truth_dir,
-                detail_path,
-                mode
-            ))
+    tasks = [
+        (row, ground_truth_dir, detail_path, mode)
+        for row in target_df.to_dict('records')
+    ]
+    # largest complexes first, so they do not straggle at the tail
+    tasks = order_largest_first(tasks, lambda task: count_cif_atoms(os.path.join(ground_truth_dir, f"{task[0]['pdb_id']}.cif")))
+
+    if max_workers is None:
+        max_workers = available_workers()
     
-    results_ost = []
-    # evaluation by ost
+    result_cache = ResultCache(result_cache_path) if result_cache_path else None
+
+    worker_pool = None
+    if ost_workers > 0:
+        worker_pool = OSTWorkerPool(ost_workers)
+        max_workers = ost_workers
+
+    # evaluation by ost, each finished task directly yields its parsed record
+    # the threads only wait on ost subprocesses/workers, which enforce the job timeout
+    results = ColumnBuffer()
+    jobs = ColumnBuffer()
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
 
-            future_to_task = {executor.submit(ost_evaluation , task): task for task in tasks}
+            future_to_task = {executor.submit(ost_score, task, worker_pool, result_cache, job_timeout): task for task in tasks}
             for future in tqdm(as_completed(future_to_task), total=len(tasks)):
                 try:
-                    result = future.result(timeout=20)
-                    if result is not None:
-                        results_ost.append(result)
-                except TimeoutError:
-                    print("this took too long...")
-                    task = future_to_task[future]
-                    future.cancel()
+                    result, job = future.result()
+                    if isinstance(result, dict):
+                        results.append(result)
+                    if job is not None:
+                        jobs.append(job)
                 except Exception as e:
                     task = future_to_task[future]
                     print(f"Error occurred for task: {task}")
                     print(traceback.format_exc())
                     future.cancel()
-    
-    results = []
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_task = {executor.submit(ost_get_result, task): task for task in tasks}
-
-        for future in tqdm(as_completed(future_to_task), total=len(tasks)):
-            try:
-                result = future.result(timeout=20)
-                if result is not None:  
-                    results.append(result)
-            except TimeoutError:
-                print("this took too long...")
-                task = future_to_task[future]
-                future.cancel()#
-            except Exception as e:
-                task = future_to_task[future]
-                print(f"Error occurred for task: {task}")
-                print(traceback.format_exc())
-                future.cancel()
+
+    if worker_pool is not None:
+        worker_pool.close()
 
     print(f"Total results for {target_type}: {len(results)}")
-    df = pd.DataFrame(results)
+    df = results.to_frame()
     df.to_csv(os.path.join(evaluation_dir,'raw',f"{target_type}_ost.csv"), index=False)
+    if len(jobs):
+        jobs.to_frame().to_csv(os.path.join(evaluation_dir,'raw',f"{target_type}_ost_jobs.csv"), index=False)
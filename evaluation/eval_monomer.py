@@ -0,0 +1,367 @@
+"""
+In-process scoring of monomer targets, without an OpenStructure subprocess per sample.
+
+Atoms of the model and the reference are matched by (chain, residue number, atom name),
+the predictions of a target are stacked into (n_models, n_atoms, 3) arrays and scored
+together with NumPy kernels that follow the `ost compare-structures` definitions:
+- lddt: all-atom lDDT over reference pairs within 15 A, with symmetric side chain
+  atom names resolved per residue
+- rmsd: CA (protein) / C3' (nucleotide) RMSD after superposition
+- gdt_ts: GDT-TS over CA / C3' with a superposition search per distance cutoff
+- tm_score: TM-score over CA / C3' for the residue correspondence, normalized by the
+  reference length (OST runs a structural alignment with USalign instead)
+Stereochemistry checks of the model are not done.
+"""
+
+import os
+import traceback
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from Bio.PDB.MMCIF2Dict import MMCIF2Dict
+from scipy.spatial import cKDTree
+from tqdm import tqdm
+
+from .column_buffer import ColumnBuffer
+from .scheduler import available_workers, count_cif_atoms, order_largest_first
+from .score_target import LDDT_INCLUSION_RADIUS, LDDT_THRESHOLDS
+
+REPRESENTATIVE_ATOMS = ("CA", "C3'")
+GDT_THRESHOLDS = (1.0, 2.0, 4.0, 8.0)
+GDT_WINDOW_SIZE = 7
+GDT_MAX_WINDOWS = 100
+SUPERPOSITION_ITERATIONS = 20
+
+SYMMETRIC_ATOMS = {
+    "ARG": [("NH1", "NH2")],
+    "ASP": [("OD1", "OD2")],
+    "GLU": [("OE1", "OE2")],
+    "LEU": [("CD1", "CD2")],
+    "PHE": [("CD1", "CD2"), ("CE1", "CE2")],
+    "TYR": [("CD1", "CD2"), ("CE1", "CE2")],
+    "VAL": [("CG1", "CG2")],
+}
+
+
+def load_polymer_chains(path):
+    """
+    Polymer residues of a mmCIF file as {label_asym_id: {label_seq_id: (comp_id, {atom name: coord})}}.
+    First model and first alternative location only, no hydrogens, and only residues
+    with a CA or C3' atom (capping groups and ligands are left out).
+    """
+    data = MMCIF2Dict(path)
+    columns = {
+        key: data[f"_atom_site.{key}"]
+        for key in ["type_symbol", "label_atom_id", "label_alt_id", "label_comp_id",
+                    "label_asym_id", "label_seq_id", "Cartn_x", "Cartn_y", "Cartn_z"]
+    }
+    model_num = data.get("_atom_site.pdbx_PDB_model_num")
+
+    chains = defaultdict(dict)
+    for i in range(len(columns["label_atom_id"])):
+        if model_num is not None and model_num[i] != model_num[0]:
+            continue
+        if columns["type_symbol"][i] in ("H", "D") or columns["label_alt_id"][i] not in (".", "?", "A"):
+            continue
+        seq_id = columns["label_seq_id"][i]
+        if seq_id in (".", "?"):
+            continue
+        residue = chains[columns["label_asym_id"][i]].setdefault(int(seq_id), (columns["label_comp_id"][i], {}))
+        residue[1].setdefault(
+            columns["label_atom_id"][i],
+            (float(columns["Cartn_x"][i]), float(columns["Cartn_y"][i]), float(columns["Cartn_z"][i])),
+        )
+
+    return {
+        chain_id: {
+            seq_id: residue for seq_id, residue in sorted(residues.items())
+            if any(atom in residue[1] for atom in REPRESENTATIVE_ATOMS)
+        }
+        for chain_id, residues in chains.items()
+    }
+
+
+def map_model_chain(model_chains, native_residues):
+    """Model chain sharing the most (residue number, residue name) with the native chain."""
+    def matches(residues):
+        return sum(
+            1 for seq_id, (comp_id, _) in residues.items()
+            if seq_id in native_residues and native_residues[seq_id][0] == comp_id
+        )
+    if not model_chains:
+        return None
+    return max(model_chains, key=lambda chain_id: matches(model_chains[chain_id]))
+
+
+class NativeLayout():
+    """Atom order of the native chain that all models are mapped onto."""
+
+    def __init__(self, native_residues):
+        self.keys = [
+            (seq_id, atom) for seq_id, (_, atoms) in native_residues.items() for atom in atoms
+        ]
+        self.index = {key: i for i, key in enumerate(self.keys)}
+        self.coords = np.asarray(
+            [native_residues[seq_id][1][atom] for seq_id, atom in self.keys], dtype=float
+        )
+        self.residue_index = np.asarray([seq_id for seq_id, _ in self.keys])
+        self.representative = np.asarray([
+            next(self.index[(seq_id, atom)] for atom in REPRESENTATIVE_ATOMS if atom in atoms)
+            for seq_id, (_, atoms) in native_residues.items()
+        ])
+        self.symmetric_groups = [
+            [(self.index[(seq_id, a)], self.index[(seq_id, b)]) for a, b in pairs
+             if (seq_id, a) in self.index and (seq_id, b) in self.index]
+            for seq_id, (comp_id, _) in native_residues.items()
+            for pairs in [SYMMETRIC_ATOMS.get(comp_id, [])]
+        ]
+        self.symmetric_groups = [group for group in self.symmetric_groups if group]
+
+    def model_coords(self, model_residues):
+        """Model coordinates in native atom order, NaN where the model has no such atom."""
+        coords = np.full((len(self.keys), 3), np.nan)
+        for i, (seq_id, atom) in enumerate(self.keys):
+            atoms = model_residues.get(seq_id, (None, {}))[1]
+            if atom in atoms:
+                coords[i] = atoms[atom]
+        return coords
+
+
+def weighted_superpose(mobile, target, weights):
+    """
+    Kabsch superposition of every mobile[k] (n, P, 3) onto target (P, 3), fitting only
+    the positions with weights[k] (n, P) > 0. Returns rotations (n, 3, 3) and
+    translations (n, 3) for `x @ rot + tran`.
+    """
+    weights = weights / np.maximum(weights.sum(-1, keepdims=True), 1e-12)
+    mobile = np.nan_to_num(mobile)
+    mobile_center = np.einsum("np,npi->ni", weights, mobile)
+    target_center = weights @ target
+    mobile_c = mobile - mobile_center[:, None]
+    target_c = target[None] - target_center[:, None]
+
+    u, _, vt = np.linalg.svd(np.einsum("np,npi,npj->nij", weights, mobile_c, target_c))
+    d = np.sign(np.linalg.det(np.matmul(u, vt)))
+    u[:, :, 2] *= d[:, None]
+    rot = np.matmul(u, vt)
+    tran = target_center - np.einsum("ni,nij->nj", mobile_center, rot)
+    return rot, tran
+
+
+def superposed_distances(mobile, target, weights):
+    rot, tran = weighted_superpose(mobile, target, weights)
+    return np.linalg.norm(np.matmul(mobile, rot) + tran[:, None] - target, axis=-1)
+
+
+def resolve_symmetric_atoms(model, native, pairs, layout):
+    """Swap symmetric atom names of a residue wherever that preserves more distances."""
+    model = model.copy()
+    for group in layout.symmetric_groups:
+        atoms = np.asarray(group).ravel()
+        residue_pairs = pairs[np.isin(pairs, atoms).any(axis=1)]
+        native_distances = np.linalg.norm(native[residue_pairs[:, 0]] - native[residue_pairs[:, 1]], axis=-1)
+
+        swapped = model.copy()
+        for a, b in group:
+            swapped[:, [a, b]] = model[:, [b, a]]
+
+        def preserved(coords):
+            distances = np.linalg.norm(coords[:, residue_pairs[:, 0]] - coords[:, residue_pairs[:, 1]], axis=-1)
+            difference = np.abs(distances - native_distances)
+            return sum((difference < threshold).sum(-1) for threshold in LDDT_THRESHOLDS)
+
+        use_swapped = preserved(swapped) > preserved(model)
+        model[use_swapped] = swapped[use_swapped]
+    return model
+
+
+def batched_lddt(model, layout):
+    """All-atom lDDT of every model (n, N, 3); atoms missing in a model count as not preserved."""
+    native = layout.coords
+    pairs = cKDTree(native).query_pairs(LDDT_INCLUSION_RADIUS, output_type="ndarray")
+    if len(pairs) == 0:
+        return np.full(model.shape[0], np.nan)
+    model = resolve_symmetric_atoms(model, native, pairs, layout)
+
+    native_distances = np.linalg.norm(native[pairs[:, 0]] - native[pairs[:, 1]], axis=-1)
+    model_distances = np.linalg.norm(model[:, pairs[:, 0]] - model[:, pairs[:, 1]], axis=-1)
+    difference = np.abs(model_distances - native_distances)
+    preserved = np.mean([difference < threshold for threshold in LDDT_THRESHOLDS], axis=0)
+    return preserved.mean(axis=-1)
+
+
+def iterate_superposition(model, native, valid, selection, select, score, best):
+    """
+    Superpose on selection, rescore, reselect with select(distances) and repeat until
+    the selection converges. Returns the best score per model.
+    """
+    for _ in range(SUPERPOSITION_ITERATIONS):
+        distances = superposed_distances(model, native, selection.astype(float))
+        best = np.maximum(best, score(distances))
+        # keep the last selection for models where fewer than 3 positions would be left
+        new_selection = select(distances) & valid
+        new_selection = np.where(new_selection.sum(-1, keepdims=True) >= 3, new_selection, selection)
+        if np.array_equal(new_selection, selection):
+            break
+        selection = new_selection
+    return best
+
+
+def seed_windows(valid, length, max_windows):
+    n_positions = valid.shape[1]
+    length = min(length, n_positions)
+    step = max(1, (n_positions - length + 1) // max_windows)
+    for start in range(0, n_positions - length + 1, step):
+        window = np.zeros_like(valid)
+        window[:, start:start + length] = True
+        yield window & valid
+
+
+def batched_gdt_ts(model, native, valid):
+    """GDT-TS of every model (n, P, 3), searching superpositions from sliding seed windows."""
+    scores = []
+    for threshold in GDT_THRESHOLDS:
+        best = np.zeros(model.shape[0])
+        for window in seed_windows(valid, GDT_WINDOW_SIZE, GDT_MAX_WINDOWS):
+            best = iterate_superposition(
+                model, native, valid, window,
+                select=lambda distances: distances < threshold,
+                score=lambda distances: (distances < threshold).sum(-1),
+                best=best,
+            )
+        scores.append(best / native.shape[0])
+    return np.mean(scores, axis=0)
+
+
+def tm_d0(length):
+    return max(0.5, 1.24 * np.cbrt(length - 15) - 1.8) if length > 21 else 0.5
+
+
+def batched_tm_score(model, native, valid):
+    """TM-score of every model (n, P, 3), searching superpositions as the TM-score program does."""
+    length = native.shape[0]
+    d0 = tm_d0(length)
+    d0_search = min(max(d0, 4.5), 8.0)
+    best = np.zeros(model.shape[0])
+
+    fragment = length
+    while True:
+        for window in seed_windows(valid, fragment, length):
+            best = iterate_superposition(
+                model, native, valid, window,
+                select=lambda distances: distances < d0_search,
+                score=lambda distances: np.nansum(1 / (1 + (distances / d0) ** 2), axis=-1) / length,
+                best=best,
+            )
+        if fragment // 2 < 4:
+            break
+        fragment //= 2
+    return best
+
+
+def score_monomer(native_path, chain_id, prediction_paths):
+    """
+    Score all predictions of one monomer target against chain chain_id of its native.
+    Returns one record per prediction with lddt, tm_score, gdt_ts and rmsd
+    (rounded to 3 decimals, as in the OpenStructure output), or None metrics
+    if the prediction could not be mapped.
+    """
+    native_residues = load_polymer_chains(native_path)[chain_id]
+    layout = NativeLayout(native_residues)
+
+    models = []
+    for prediction_path in prediction_paths:
+        model_chains = load_polymer_chains(prediction_path)
+        model_chain = map_model_chain(model_chains, native_residues)
+        models.append(None if model_chain is None else layout.model_coords(model_chains[model_chain]))
+
+    records = [
+        {"prediction_path": path, "lddt": None, "tm_score": None, "gdt_ts": None, "rmsd": None}
+        for path in prediction_paths
+    ]
+    mapped = [k for k, coords in enumerate(models) if coords is not None]
+    if not mapped:
+        return records
+
+    model = np.stack([models[k] for k in mapped])
+    native_representative = layout.coords[layout.representative]
+    model_representative = model[:, layout.representative]
+    valid = ~np.isnan(model_representative).any(-1)
+
+    lddt = batched_lddt(model, layout)
+    distances = superposed_distances(model_representative, native_representative, valid.astype(float))
+    rmsd = np.sqrt(np.nanmean(np.where(valid, distances, np.nan) ** 2, axis=-1))
+    gdt_ts = batched_gdt_ts(np.nan_to_num(model_representative), native_representative, valid)
+    tm_score = batched_tm_score(np.nan_to_num(model_representative), native_representative, valid)
+
+    for i, k in enumerate(mapped):
+        records[k].update({
+            "lddt": round(float(lddt[i]), 3),
+            "tm_score": round(float(tm_score[i]), 3),
+            "gdt_ts": round(float(gdt_ts[i]), 3),
+            "rmsd": round(float(rmsd[i]), 3),
+        })
+    return records
+
+
+def process_target(args):
+    rows, ground_truth_dir = args
+    pdb_id = rows[0]["pdb_id"]
+    rows = [row for row in rows if isinstance(row.get("prediction_path"), str) and os.path.exists(row["prediction_path"])]
+    if not rows:
+        print(f"prediction_path is None for {pdb_id}")
+        return []
+    try:
+        scores = score_monomer(
+            os.path.join(ground_truth_dir, f"{pdb_id}.cif"),
+            rows[0]["chain_id"],
+            [row["prediction_path"] for row in rows],
+        )
+    except Exception:
+        print(f"Error when scoring {pdb_id}")
+        print(traceback.format_exc())
+        return []
+
+    results = []
+    for row, score in zip(rows, scores):
+        results.append({
+            **row,
+            'dockq_score': None,
+            'irmsd': None,
+            'lrmsd': None,
+            'len_dockq': 0,
+            'lddt': score['lddt'],
+            'tm_score': score['tm_score'],
+            'gdt_ts': score['gdt_ts'],
+            'rmsd': score['rmsd'],
+            'scorer': 'native',
+        })
+    return results
+
+
+def eval_monomer(target_df, target_type, evaluation_dir, ground_truth_dir, max_workers=None):
+    """
+    Score the monomer predictions in target_df in-process, one task per target.
+    Writes raw/{target_type}_ost.csv with the columns of eval_by_ost, so the summary
+    does not depend on which backend scored the monomers. The scores are close to but
+    not identical with OpenStructure's (TM-score up to ~0.006 lower), the scorer column
+    records which backend scored each row.
+    """
+    groups = [group.to_dict('records') for _, group in target_df.groupby('pdb_id', sort=False)]
+    tasks = [(rows, ground_truth_dir) for rows in groups]
+    tasks = order_largest_first(tasks, lambda task: count_cif_atoms(os.path.join(ground_truth_dir, f"{task[0][0]['pdb_id']}.cif")))
+
+    if max_workers is None:
+        max_workers = available_workers()
+
+    results = ColumnBuffer()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(process_target, task) for task in tasks]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            for result in future.result():
+                results.append(result)
+
+    print(f"Total results for {target_type}: {len(results)}")
+    df = results.to_frame()
+    df.to_csv(os.path.join(evaluation_dir, 'raw', f"{target_type}_ost.csv"), index=False)
@@ -0,0 +1,172 @@
+"""
+Handoff of postprocessed predictions from an algorithm's postprocess.py to evaluate.py.
+
+With --handoff_dir the postprocessor copies the postprocessed CIFs of each target to
+{handoff_dir}/{pdb_id}/ (normally on a tmpfs such as /dev/shm) and publishes the target
+by atomically writing {handoff_dir}/ready/{pdb_id}.csv with its prediction_reference.csv
+rows, pointing at the copies. After the last target it creates {handoff_dir}/done.
+The postprocessed CIFs next to the predictions, which prediction_reference.csv lists, are kept.
+
+eval_handoff scores every target as soon as it is published, while later targets are
+still being postprocessed, and removes its structures once all their jobs finished.
+"""
+
+import glob
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from multiprocessing import Pool
+
+import pandas as pd
+from tqdm import tqdm
+
+from .DockQv2.DockQ import INTERFACE_THRESHOLD
+from .column_buffer import ColumnBuffer
+from .eval_by_dockqv2 import process_target_cases, set_dockqv2_options
+from .eval_by_ost import ost_mode, ost_score
+from .eval_monomer import process_target
+from .ost_worker_pool import OSTWorkerPool
+from .result_cache import ResultCache
+from .scheduler import available_workers
+
+READY_DIR = "ready"
+DONE_FILE = "done"
+
+MONOMER_TYPES = ["monomer_dna", "monomer_rna", "monomer_protein"]
+DOCKQV2_TYPES = ["interface_protein_dna", "interface_protein_rna"]
+
+
+def follow_targets(handoff_dir, poll_interval=1.0):
+    """Yield the prediction rows (DataFrame) of every published target, until the postprocessor is done."""
+    ready_dir = os.path.join(handoff_dir, READY_DIR)
+    seen = set()
+    while True:
+        # checked before listing, so no target published before `done` is missed
+        done = os.path.exists(os.path.join(handoff_dir, DONE_FILE))
+        paths = [path for path in glob.glob(os.path.join(ready_dir, "*.csv")) if path not in seen]
+        for path in sorted(paths, key=os.path.getmtime):
+            seen.add(path)
+            yield pd.read_csv(path)
+        if done and not paths:
+            return
+        if not paths:
+            time.sleep(poll_interval)
+
+
+class StructureCleanup():
+    """Removes the handoff structures of a target once all its jobs finished."""
+
+    def __init__(self):
+        self.pending = {}
+        self.paths = {}
+        self.lock = threading.Lock()
+
+    def add(self, pdb_id, prediction_paths, futures):
+        with self.lock:
+            # one extra count released below, so a target without jobs is removed right away
+            self.pending[pdb_id] = self.pending.get(pdb_id, 0) + len(futures) + 1
+            self.paths.setdefault(pdb_id, set()).update(prediction_paths)
+        for future in futures:
+            future.add_done_callback(lambda _, pdb_id=pdb_id: self.finish(pdb_id))
+        self.finish(pdb_id)
+
+    def finish(self, pdb_id):
+        with self.lock:
+            self.pending[pdb_id] -= 1
+            if self.pending[pdb_id] > 0:
+                return
+            paths = self.paths.pop(pdb_id)
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        for directory in set(os.path.dirname(path) for path in paths):
+            if os.path.isdir(directory) and not os.listdir(directory):
+                os.rmdir(directory)
+
+
+def eval_handoff(handoff_dir,target_dfs,evaluation_dir,ground_truth_dir,monomer_scorer = 'ost',max_workers = None,ost_workers = 0,result_cache_path = None,job_timeout = 600,dockq_kdtree = False,dockq_max_chain_maps = None,keep_structures = False,poll_interval = 1.0):
+    """
+    Score the targets of target_dfs (target type -> target DataFrame) as the postprocessor
+    publishes their predictions into handoff_dir.
+    Runs the same jobs as evaluate.py (eval_by_ost, eval_by_dockqv2, eval_monomer) and writes
+    the same raw/{target_type}_ost.csv, _ost_jobs.csv and _dockqv2.csv files.
+    The structures of a scored target are removed unless keep_structures is set.
+    """
+    target_dfs = {target_type: target_df for target_type, target_df in target_dfs.items() if ost_mode(target_type)}
+    detail_path = os.path.join(evaluation_dir, 'detail')
+    os.makedirs(detail_path, exist_ok=True)
+
+    if max_workers is None:
+        max_workers = available_workers()
+    result_cache = ResultCache(result_cache_path) if result_cache_path else None
+    worker_pool = OSTWorkerPool(ost_workers) if ost_workers > 0 else None
+    cleanup = None if keep_structures else StructureCleanup()
+
+    # (target_type, kind, future), kind is 'ost', 'monomer' or 'dockqv2'
+    submitted = []
+    distance_cutoff = INTERFACE_THRESHOLD if dockq_kdtree else None
+    # DockQv2 and monomer jobs are handed from a thread to a process, all processes are forked
+    # here before any thread runs
+    with Pool(max_workers, initializer=set_dockqv2_options, initargs=(distance_cutoff, dockq_max_chain_maps)) as process_pool, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        for prediction_df in follow_targets(handoff_dir, poll_interval):
+            pdb_ids = set(prediction_df['pdb_id'])
+            target_futures = []
+            for target_type, target_df in target_dfs.items():
+                target_rows = target_df[target_df['pdb_id'].isin(pdb_ids)]
+                if len(target_rows) == 0:
+                    continue
+                rows = pd.merge(target_rows, prediction_df, on='pdb_id', how='left').to_dict('records')
+
+                if target_type in MONOMER_TYPES and monomer_scorer == 'native':
+                    futures = [('monomer', executor.submit(process_pool.apply, process_target, ((rows, ground_truth_dir),)))]
+                else:
+                    mode = ost_mode(target_type)
+                    futures = [
+                        ('ost', executor.submit(ost_score, (row, ground_truth_dir, detail_path, mode), worker_pool, result_cache, job_timeout))
+                        for row in rows
+                    ]
+                    if target_type in DOCKQV2_TYPES:
+                        futures.append(('dockqv2', executor.submit(process_pool.apply, process_target_cases, ((rows, ground_truth_dir, detail_path, 'structure'),))))
+                submitted.extend((target_type, kind, future) for kind, future in futures)
+                target_futures.extend(future for _, future in futures)
+
+            if cleanup is not None:
+                cleanup.add(prediction_df['pdb_id'].iloc[0], prediction_df['prediction_path'].tolist(), target_futures)
+
+        results = {
+            target_type: {'ost': ColumnBuffer(), 'jobs': ColumnBuffer(), 'dockqv2': ColumnBuffer()}
+            for target_type in target_dfs
+        }
+        future_to_job = {future: (target_type, kind) for target_type, kind, future in submitted}
+        for future in tqdm(as_completed(future_to_job), total=len(future_to_job)):
+            target_type, kind = future_to_job[future]
+            buffers = results[target_type]
+            try:
+                if kind == 'ost':
+                    result, job = future.result()
+                    if isinstance(result, dict):
+                        buffers['ost'].append(result)
+                    if job is not None:
+                        buffers['jobs'].append(job)
+                else:
+                    for record in future.result():
+                        if isinstance(record, dict):
+                            buffers['ost' if kind == 'monomer' else 'dockqv2'].append(record)
+            except Exception as e:
+                print(f"Error occurred for a {kind} job of {target_type}")
+                print(traceback.format_exc())
+
+    if worker_pool is not None:
+        worker_pool.close()
+
+    for target_type, buffers in results.items():
+        print(f"Total results for {target_type}: {len(buffers['ost'])}")
+        buffers['ost'].to_frame().to_csv(os.path.join(evaluation_dir, 'raw', f"{target_type}_ost.csv"), index=False)
+        if len(buffers['jobs']):
+            buffers['jobs'].to_frame().to_csv(os.path.join(evaluation_dir, 'raw', f"{target_type}_ost_jobs.csv"), index=False)
+        if target_type in DOCKQV2_TYPES:
+            buffers['dockqv2'].to_frame().to_csv(os.path.join(evaluation_dir, 'raw', f"{target_type}_dockqv2.csv"), index=False)
@@ -0,0 +1,258 @@
+"""
+All target types of an evaluation as one job graph.
+
+Every (prediction, reference, mode) OST run, every DockQv2 target and every native monomer
+target is a single job, even if several target types need it (e.g. a complex that is in
+interface_protein_dna.csv and monomer_protein.csv). All jobs share one pool of max_workers
+slots, largest first, so OST and DockQv2 jobs interleave and no pool drains on its own.
+
+Finished jobs are appended to a checkpoint file. A rerun skips the jobs whose inputs did not
+change since, and the raw/{target_type}_*.csv files are assembled from all jobs at the end.
+"""
+
+import json
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from multiprocessing import Pool
+
+import numpy as np
+from tqdm import tqdm
+
+from .DockQv2.DockQ import INTERFACE_THRESHOLD
+from .column_buffer import ColumnBuffer
+from .eval_by_dockqv2 import NumpyEncoder, process_target_cases, set_dockqv2_options
+from .eval_by_ost import ost_evaluation, ost_get_result, ost_job_record, ost_mode
+from .eval_monomer import process_target
+from .ost_worker_pool import OSTWorkerPool
+from .result_cache import ResultCache
+from .scheduler import available_workers, count_cif_atoms, order_largest_first
+
+MONOMER_TYPES = ["monomer_dna", "monomer_rna", "monomer_protein"]
+DOCKQV2_TYPES = ["interface_protein_dna", "interface_protein_rna"]
+
+DOCKQV2_METRICS = ['lrmsd', 'irmsd', 'dockq_score']
+MONOMER_METRICS = ['dockq_score', 'irmsd', 'lrmsd', 'len_dockq', 'lddt', 'tm_score', 'gdt_ts', 'rmsd', 'scorer']
+
+
+def file_stamp(path):
+    """mtime and size of a file, so a checkpointed job is rerun when one of its inputs changed."""
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError, ValueError):
+        return None
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def has_prediction(row):
+    return isinstance(row.get("prediction_path"), str) and os.path.exists(row["prediction_path"])
+
+
+def ost_output_path(args):
+    row, ground_truth_path, detail_path, mode = args
+    return f"{detail_path}/{row['pdb_id']}_{row['seed']}_{row['sample']}_{mode}_ost.json"
+
+
+class CheckpointEncoder(NumpyEncoder):
+    def default(self, obj):
+        if isinstance(obj, np.float32):
+            # shortest repr, so the csv files show the same digits as the float32 scores
+            return float(str(obj))
+        return super().default(obj)
+
+
+class Checkpoint():
+    """Append-only JSON lines file of finished jobs: key, stamp of its inputs, records and job record."""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        if not os.path.exists(path):
+            return
+        with open(path, 'r') as f:
+            text = f.read()
+        for line in text.splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line of an interrupted run
+                continue
+            self.entries[entry['key']] = entry
+        if text and not text.endswith('\n'):
+            with open(path, 'a') as f:
+                f.write('\n')
+
+    def get(self, key, stamp):
+        entry = self.entries.get(key)
+        if entry is None or entry['stamp'] != stamp:
+            return None
+        return entry
+
+    def put(self, key, stamp, records, job):
+        line = json.dumps({'key': key, 'stamp': stamp, 'records': records, 'job': job}, cls=CheckpointEncoder)
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.entries[key] = json.loads(line)
+
+
+def build_jobs(target_dfs, ground_truth_dir, detail_path, monomer_scorer='ost'):
+    """
+    target_dfs: target type -> target rows merged with prediction_reference.csv.
+    Returns the deduplicated jobs (key -> dict with kind, args, stamp and size) and, per
+    target type, its rows with the keys of the jobs they depend on.
+    """
+    jobs = {}
+    target_rows = {}
+    # DockQv2 and native monomer jobs score all predictions of a target at once
+    grouped = {}
+    for target_type, target_df in target_dfs.items():
+        mode = ost_mode(target_type)
+        rows = []
+        for row in target_df.to_dict('records'):
+            pdb_id = row['pdb_id']
+            keys = {}
+            if target_type in MONOMER_TYPES and monomer_scorer == 'native':
+                keys['monomer'] = f"monomer|{pdb_id}|{row['chain_id']}"
+                grouped.setdefault(keys['monomer'], {})[row['prediction_path']] = row
+            else:
+                if has_prediction(row):
+                    args = (row, ground_truth_dir, detail_path, mode)
+                    keys['ost'] = f"ost|{row['prediction_path']}|{pdb_id}|{mode}"
+                    jobs.setdefault(keys['ost'], {'kind': 'ost', 'pdb_id': pdb_id, 'args': args, 'predictions': [row['prediction_path']]})
+                if target_type in DOCKQV2_TYPES:
+                    keys['dockqv2'] = f"dockqv2|{pdb_id}"
+                    interface = (row['prediction_path'], row['interface_chain_id_1'], row['interface_chain_id_2'])
+                    grouped.setdefault(keys['dockqv2'], {}).setdefault(interface, row)
+            rows.append((row, keys))
+        target_rows[target_type] = rows
+
+    for key, rows in grouped.items():
+        kind, pdb_id = key.split('|')[:2]
+        rows = [row for row in rows.values() if has_prediction(row)]
+        if kind == 'dockqv2':
+            args = (rows, ground_truth_dir, detail_path, 'structure')
+        else:
+            args = (rows, ground_truth_dir)
+        jobs[key] = {'kind': kind, 'pdb_id': pdb_id, 'args': args, 'predictions': sorted(set(row['prediction_path'] for row in rows))}
+
+    for key, job in jobs.items():
+        native_path = os.path.join(ground_truth_dir, f"{job['pdb_id']}.cif")
+        job['key'] = key
+        job['stamp'] = "|".join(str(file_stamp(path)) for path in [native_path, *job['predictions']])
+        job['size'] = count_cif_atoms(native_path) * len(job['predictions'])
+    return jobs, target_rows
+
+
+def run_job(job, process_pool, worker_pool=None, result_cache=None, timeout=None):
+    """Run one job. Returns its records, its job record and whether it can be checkpointed."""
+    if job['kind'] == 'ost':
+        job_record = ost_job_record(job['args'], ost_evaluation(job['args'], worker_pool, result_cache, timeout))
+        # the parsed ost output is read back from detail/ when the csv files are assembled
+        return [], job_record, os.path.exists(ost_output_path(job['args']))
+    function = process_target_cases if job['kind'] == 'dockqv2' else process_target
+    records = process_pool.apply(function, (job['args'],))
+    return [record for record in records if isinstance(record, dict)], None, True
+
+
+def assemble_target(target_type, rows, finished, evaluation_dir, ground_truth_dir, detail_path):
+    """Write the raw csv files of one target type from the finished jobs (key -> checkpoint entry)."""
+    mode = ost_mode(target_type)
+    results = ColumnBuffer()
+    job_records = ColumnBuffer()
+    dockqv2_results = ColumnBuffer()
+    indexed = {}
+    for row, keys in rows:
+        if 'monomer' in keys:
+            if keys['monomer'] not in indexed:
+                indexed[keys['monomer']] = {record['prediction_path']: record for record in finished.get(keys['monomer'], {'records': []})['records']}
+            record = indexed[keys['monomer']].get(row['prediction_path'])
+            if record is not None:
+                results.append({**row, **{metric: record.get(metric) for metric in MONOMER_METRICS}})
+            continue
+
+        if has_prediction(row):
+            result = ost_get_result((row, ground_truth_dir, detail_path, mode))
+            if isinstance(result, dict):
+                results.append(result)
+            entry = finished.get(keys.get('ost'))
+            if entry is not None and entry['job'] is not None:
+                job_records.append(entry['job'])
+
+        if 'dockqv2' in keys:
+            if keys['dockqv2'] not in indexed:
+                indexed[keys['dockqv2']] = {
+                    (record['prediction_path'], record['interface_chain_id_1'], record['interface_chain_id_2']): record
+                    for record in finished.get(keys['dockqv2'], {'records': []})['records']
+                }
+            record = indexed[keys['dockqv2']].get((row['prediction_path'], row['interface_chain_id_1'], row['interface_chain_id_2']))
+            if record is not None:
+                dockqv2_results.append({**row, **{metric: record.get(metric) for metric in DOCKQV2_METRICS}})
+
+    print(f"Total results for {target_type}: {len(results)}")
+    results.to_frame().to_csv(os.path.join(evaluation_dir, 'raw', f"{target_type}_ost.csv"), index=False)
+    if len(job_records):
+        job_records.to_frame().to_csv(os.path.join(evaluation_dir, 'raw', f"{target_type}_ost_jobs.csv"), index=False)
+    if target_type in DOCKQV2_TYPES:
+        dockqv2_results.to_frame().to_csv(os.path.join(evaluation_dir, 'raw', f"{target_type}_dockqv2.csv"), index=False)
+
+
+def eval_job_graph(target_dfs,evaluation_dir,ground_truth_dir,monomer_scorer = 'ost',max_workers = None,ost_workers = 0,result_cache_path = None,job_timeout = 600,dockq_kdtree = False,dockq_max_chain_maps = None,checkpoint_path = None):
+    """
+    Score all target types (target type -> target rows merged with prediction_reference.csv)
+    as one deduplicated job graph, with the jobs of evaluate.py (eval_by_ost, eval_by_dockqv2,
+    eval_monomer) and the same raw csv files.
+    checkpoint_path defaults to {evaluation_dir}/job_graph_checkpoint.jsonl.
+    """
+    target_dfs = {target_type: target_df for target_type, target_df in target_dfs.items() if ost_mode(target_type)}
+    detail_path = os.path.join(evaluation_dir, 'detail')
+    os.makedirs(detail_path, exist_ok=True)
+
+    jobs, target_rows = build_jobs(target_dfs, ground_truth_dir, detail_path, monomer_scorer)
+    checkpoint = Checkpoint(checkpoint_path or os.path.join(evaluation_dir, 'job_graph_checkpoint.jsonl'))
+    finished = {}
+    pending = []
+    for key, job in jobs.items():
+        entry = checkpoint.get(key, job['stamp'])
+        if entry is not None and (job['kind'] != 'ost' or os.path.exists(ost_output_path(job['args']))):
+            finished[key] = entry
+        else:
+            pending.append(job)
+    n_rows = sum(len(rows) for rows in target_rows.values())
+    print(f"{len(jobs)} jobs for {n_rows} target rows, {len(finished)} already done")
+
+    if max_workers is None:
+        max_workers = available_workers()
+    result_cache = ResultCache(result_cache_path) if result_cache_path else None
+    worker_pool = OSTWorkerPool(ost_workers) if ost_workers > 0 else None
+
+    # the threads are the slots of the pool, DockQv2 and monomer jobs hand their work to a process.
+    # The processes are all forked here, before any thread runs.
+    distance_cutoff = INTERFACE_THRESHOLD if dockq_kdtree else None
+    with Pool(max_workers, initializer=set_dockqv2_options, initargs=(distance_cutoff, dockq_max_chain_maps)) as process_pool, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_job = {
+            executor.submit(run_job, job, process_pool, worker_pool, result_cache, job_timeout): job
+            for job in order_largest_first(pending, lambda job: job['size'])
+        }
+        for future in tqdm(as_completed(future_to_job), total=len(future_to_job)):
+            job = future_to_job[future]
+            try:
+                records, job_record, done = future.result()
+            except Exception as e:
+                print(f"Error occurred for job: {job['key']}")
+                print(traceback.format_exc())
+                continue
+            if done:
+                checkpoint.put(job['key'], job['stamp'], records, job_record)
+                finished[job['key']] = checkpoint.entries[job['key']]
+
+    if worker_pool is not None:
+        worker_pool.close()
+
+    for target_type, rows in target_rows.items():
+        assemble_target(target_type, rows, finished, evaluation_dir, ground_truth_dir, detail_path)
@@ -0,0 +1,130 @@
+"""
+Resident OpenStructure worker. Started as `ost ost_worker.py` by OSTWorkerPool.
+
+Each line on stdin is a JSON job {"action", "model", "reference", "output", "flags"}.
+The matching `ost <action>` script is run in-process, so the OST runtime is only
+loaded once per worker, and recently used reference structures are kept in memory.
+One JSON line {"returncode", "error", "peak_rss_mb"} is written back per job.
+"""
+
+import argparse
+import json
+import os
+import runpy
+import sys
+import traceback
+from collections import OrderedDict
+
+import ost
+from ost import io, mol
+
+
+def get_action_dir():
+    if os.environ.get("OST_ACTION_DIR"):
+        return os.environ["OST_ACTION_DIR"]
+    # <OST_ROOT>/share/openstructure -> <OST_ROOT>/libexec/openstructure
+    ost_root = os.path.dirname(os.path.dirname(ost.GetSharedDataPath()))
+    return os.path.join(ost_root, "libexec", "openstructure")
+
+
+def copy_loaded(result):
+    # actions modify the loaded entity in place, hand out copies of the cached one
+    if isinstance(result, tuple):
+        return tuple(copy_loaded(item) for item in result)
+    if isinstance(result, mol.EntityHandle):
+        return result.Copy()
+    return result
+
+
+class ReferenceCache():
+    """LRU cache around io.LoadMMCIF/io.LoadPDB, restricted to reference files."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.references = set()
+        self.cache = OrderedDict()
+        self.loaders = {"LoadMMCIF": io.LoadMMCIF, "LoadPDB": io.LoadPDB}
+        for name, loader in self.loaders.items():
+            setattr(io, name, self.wrap(loader))
+
+    def wrap(self, loader):
+        def cached_loader(filename, *args, **kwargs):
+            path = os.path.abspath(filename) if isinstance(filename, str) else None
+            if self.max_size <= 0 or path not in self.references or not os.path.exists(path):
+                return loader(filename, *args, **kwargs)
+            key = (loader.__name__, path, os.path.getmtime(path), args, tuple(sorted(kwargs.items())))
+            if key in self.cache:
+                self.cache.move_to_end(key)
+            else:
+                self.cache[key] = loader(filename, *args, **kwargs)
+                while len(self.cache) > self.max_size:
+                    self.cache.popitem(last=False)
+            return copy_loaded(self.cache[key])
+        return cached_loader
+
+    def set_reference(self, reference):
+        self.references = {os.path.abspath(reference)}
+
+
+def reset_peak_rss():
+    # writing 5 to clear_refs resets VmHWM to the current RSS (Linux >= 4.0)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def read_peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def run_job(job, action_dir, reference_cache):
+    script = os.path.join(action_dir, f"ost-{job['action']}")
+    reference_cache.set_reference(job["reference"])
+    sys.argv = [script, "-m", job["model"], "-r", job["reference"], "-o", job["output"], *job["flags"]]
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            return {"returncode": e.code if isinstance(e.code, int) else 1, "error": str(e.code)}
+    return {"returncode": 0, "error": None}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reference_cache_size", type=int, default=8)
+    args = parser.parse_args()
+
+    # keep the real stdout for the protocol, everything the actions print goes to stderr
+    protocol = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    action_dir = get_action_dir()
+    reference_cache = ReferenceCache(args.reference_cache_size)
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        # peak RSS of this job: the worker's RSS when it starts (OST runtime, cached
+        # references) plus what the job allocates, None if VmHWM can not be reset
+        measured = reset_peak_rss()
+        try:
+            response = run_job(json.loads(line), action_dir, reference_cache)
+        except BaseException:
+            response = {"returncode": 1, "error": traceback.format_exc()}
+        response["peak_rss_mb"] = read_peak_rss_mb() if measured else None
+        protocol.write(json.dumps(response) + "\n")
+        protocol.flush()
+
+
+if __name__ == "__main__":
+    main()
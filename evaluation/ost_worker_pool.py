@@ -0,0 +1,109 @@
+import json
+import os
+import queue
+import select
+import subprocess
+import time
+
+OST_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ost_worker.py")
+
+
+class OSTWorker():
+    """One resident `ost ost_worker.py` process, talking JSON lines over its stdin/stdout."""
+
+    def __init__(self, executable="ost", reference_cache_size=8):
+        self.command = [executable, OST_WORKER_SCRIPT, "--reference_cache_size", str(reference_cache_size)]
+        self.process = None
+        self.start()
+
+    def start(self):
+        self.process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            bufsize=1,
+        )
+
+    def run(self, job, timeout=None):
+        if self.process.poll() is not None:
+            self.start()
+        try:
+            self.process.stdin.write(json.dumps(job) + "\n")
+            self.process.stdin.flush()
+            ready, _, _ = select.select([self.process.stdout], [], [], timeout)
+            line = self.process.stdout.readline() if ready else None
+        except (BrokenPipeError, OSError):
+            line = ""
+        if line is None:
+            self.kill()
+            self.start()
+            return {"returncode": -9, "error": "ost worker timed out", "timed_out": True}
+        if not line:
+            # the worker died on this job (e.g. a crash inside OST), replace it
+            self.close()
+            self.start()
+            return {"returncode": -1, "error": "ost worker exited"}
+        return json.loads(line)
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+
+    def close(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+
+
+class OSTWorkerPool():
+    """
+    Pool of resident OpenStructure workers.
+
+    `run` can be called from many threads, each call blocks until a worker is free
+    and returns the same job record as scheduler.run_command. A job running longer
+    than timeout kills and restarts its worker.
+    """
+
+    def __init__(self, n_workers, executable="ost", reference_cache_size=8):
+        self.workers = [OSTWorker(executable, reference_cache_size) for _ in range(n_workers)]
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def run(self, action, model_file, reference_file, output_path, flags, timeout=None):
+        job = {
+            "action": action,
+            "model": str(model_file),
+            "reference": str(reference_file),
+            "output": str(output_path),
+            "flags": list(flags),
+        }
+        worker = self.idle.get()
+        start = time.time()
+        try:
+            response = worker.run(job, timeout)
+        finally:
+            self.idle.put(worker)
+        return {
+            "returncode": response["returncode"],
+            "wall_time": time.time() - start,
+            "peak_rss_mb": response.get("peak_rss_mb"),
+            "timed_out": response.get("timed_out", False),
+        }
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
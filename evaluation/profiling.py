@@ -0,0 +1,163 @@
+"""
+Per-sample profiling of the evaluation (evaluate.py --profile).
+
+`sample(...)` opens one record per scored prediction, `stage(name)` (or a function decorated
+with `timed(name)`) adds the time spent in a stage to the open record of the current thread,
+and `count(name, value)` adds counters such as atoms or chain maps. Stage times are exclusive: time spent in a nested stage is only
+counted for the nested one, so the stages of a record add up to at most its total_s.
+
+peak_rss_mb is the peak RSS (VmHWM) of the process while the record was open: VmHWM is reset
+through /proc/self/clear_refs when a record opens and no other record of the process is open, so
+it is exact for the one-sample-at-a-time pool workers and covers the overlapping records of
+concurrent threads. ost rows also get ost_peak_rss_mb, the peak RSS of the ost job itself.
+
+Every process appends its finished records to {spool_dir}/{host}_{pid}.jsonl, which also
+works for forked pool workers and queue workers on other hosts. write_profile merges the
+spool files into profile.parquet. Without `enable`, all of this is a no-op.
+"""
+
+import glob
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import pandas as pd
+
+from .scheduler import read_peak_rss_kb
+
+SPOOL_DIR = None
+_local = threading.local()
+_write_lock = threading.Lock()
+_rss_lock = threading.Lock()
+# [records open in this process, whether VmHWM was reset when the first one opened]
+_rss_window = [0, False]
+
+
+def enable(spool_dir):
+    global SPOOL_DIR
+    os.makedirs(spool_dir, exist_ok=True)
+    SPOOL_DIR = spool_dir
+
+
+def active():
+    return SPOOL_DIR is not None and getattr(_local, 'record', None) is not None
+
+
+def reset_peak_rss():
+    # writing 5 to clear_refs resets VmHWM to the current RSS (Linux >= 4.0)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def open_rss_window():
+    with _rss_lock:
+        if _rss_window[0] == 0:
+            _rss_window[1] = reset_peak_rss()
+        _rss_window[0] += 1
+
+
+def close_rss_window():
+    """Peak RSS of the process since the window opened, None if VmHWM could not be reset."""
+    with _rss_lock:
+        _rss_window[0] -= 1
+        peak_rss_kb = read_peak_rss_kb() if _rss_window[1] else None
+    return peak_rss_kb / 1024 if peak_rss_kb is not None else None
+
+
+@contextmanager
+def sample(**fields):
+    """Profile one scored prediction, fields (pdb_id, seed, sample, ...) identify it."""
+    if SPOOL_DIR is None:
+        yield None
+        return
+    record = {**fields, 'host': socket.gethostname(), 'pid': os.getpid()}
+    outer, outer_stack = getattr(_local, 'record', None), getattr(_local, 'stack', None)
+    _local.record, _local.stack = record, []
+    open_rss_window()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['total_s'] = time.perf_counter() - start
+        record['peak_rss_mb'] = close_rss_window()
+        _local.record, _local.stack = outer, outer_stack
+        line = json.dumps(record, default=lambda obj: obj.item() if hasattr(obj, "item") else str(obj))
+        with _write_lock:
+            with open(os.path.join(SPOOL_DIR, f"{socket.gethostname()}_{os.getpid()}.jsonl"), 'a') as f:
+                f.write(line + '\n')
+
+
+@contextmanager
+def stage(name):
+    """Time a stage of the open sample record, if any."""
+    if not active():
+        yield
+        return
+    record, stack = _local.record, _local.stack
+    # [time spent in nested stages]
+    stack.append([0.0])
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = stack.pop()[0]
+        if stack:
+            stack[-1][0] += elapsed
+        record[f'{name}_s'] = record.get(f'{name}_s', 0.0) + elapsed - nested
+
+
+def timed(name):
+    """Decorator, times every call of the function as stage name."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not active():
+                return function(*args, **kwargs)
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value):
+    if active():
+        _local.record[name] = _local.record.get(name, 0) + value
+
+
+def set_value(name, value):
+    if active():
+        _local.record[name] = value
+
+
+def write_profile(spool_dir, profile_path):
+    """
+    Merge the spool files into profile_path (parquet). Falls back to a csv next to it if no
+    parquet engine (pyarrow) is installed. Returns the path written, None without records.
+    """
+    records = []
+    for path in glob.glob(os.path.join(spool_dir, '*.jsonl')):
+        with open(path, 'r') as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    shutil.rmtree(spool_dir, ignore_errors=True)
+    if not records:
+        return None
+    df = pd.DataFrame(records)
+    stage_columns = sorted(column for column in df.columns if column.endswith('_s') and column != 'total_s')
+    df[stage_columns] = df[stage_columns].fillna(0.0)
+    try:
+        df.to_parquet(profile_path, index=False)
+    except ImportError:
+        profile_path = os.path.splitext(profile_path)[0] + '.csv'
+        print(f"No parquet engine installed, writing the profile to {profile_path}")
+        df.to_csv(profile_path, index=False)
+    return profile_path
@@ -0,0 +1,114 @@
+import hashlib
+import os
+import sqlite3
+import subprocess
+import tempfile
+import threading
+from functools import lru_cache
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    model_sha TEXT,
+    reference_sha TEXT,
+    mode TEXT,
+    flags TEXT,
+    tool_version TEXT,
+    output TEXT
+)
+"""
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+@lru_cache(maxsize=4096)
+def _cached_file_sha256(path, mtime_ns, size):
+    return file_sha256(path)
+
+
+def cached_file_sha256(path):
+    """sha256 of a file, only recomputed when its mtime or size changes."""
+    stat = os.stat(path)
+    return _cached_file_sha256(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache
+def get_ost_version(executable="ost"):
+    with tempfile.NamedTemporaryFile("w", suffix=".py", delete=False) as f:
+        f.write("import ost\nprint(ost.VERSION)\n")
+        script = f.name
+    try:
+        result = subprocess.run([executable, script], capture_output=True, text=True, check=False)
+        version = result.stdout.strip().splitlines()
+        return f"ost {version[-1]}" if result.returncode == 0 and version else "ost unknown"
+    except OSError:
+        return "ost unknown"
+    finally:
+        os.remove(script)
+
+
+class ResultCache():
+    """
+    Content-addressed cache of evaluation outputs in a SQLite file.
+
+    Entries are keyed by (sha256 of model file, sha256 of reference file, mode, flags, tool version),
+    so a changed prediction, ground truth, flag set or tool version is always rescored.
+    Safe to share between threads and processes.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        # one connection per process, sqlite connections must not cross fork()
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(CREATE_TABLE)
+            self._connection.commit()
+            self._pid = os.getpid()
+        return self._connection
+
+    def make_key(self, model_path, reference_path, mode, flags, tool_version):
+        model_sha = cached_file_sha256(model_path)
+        reference_sha = cached_file_sha256(reference_path)
+        flags = " ".join(flags)
+        key = hashlib.sha256(
+            "\0".join([model_sha, reference_sha, mode, flags, tool_version]).encode()
+        ).hexdigest()
+        return key, (model_sha, reference_sha, mode, flags, tool_version)
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT output FROM results WHERE key = ?", (key,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, key, fields, output):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, *fields, output),
+            )
+            self.connection.commit()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["lock"] = None
+        state["_connection"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
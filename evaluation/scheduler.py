@@ -0,0 +1,126 @@
+"""
+Helpers to schedule heavy evaluation subprocesses: concurrency sized to the machine,
+hard per-job timeouts, largest-first ordering and per-job wall time / peak RSS.
+"""
+
+import os
+import signal
+import subprocess
+import time
+from functools import lru_cache
+
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_memory_gb():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024 ** 2
+    except OSError:
+        pass
+    return None
+
+
+def available_workers(memory_per_job_gb=4.0):
+    """Number of concurrent jobs the available cores and memory allow."""
+    workers = available_cores()
+    memory_gb = available_memory_gb()
+    if memory_gb is not None:
+        workers = min(workers, int(memory_gb // memory_per_job_gb))
+    return max(1, workers)
+
+
+@lru_cache(maxsize=None)
+def count_cif_atoms(path):
+    """Number of atom_site records of a CIF/PDB file, 0 if it can not be read."""
+    n_atoms = 0
+    try:
+        with open(path, "rb") as f:
+            for line in f:
+                if line.startswith((b"ATOM", b"HETATM")):
+                    n_atoms += 1
+    except OSError:
+        pass
+    return n_atoms
+
+
+def read_peak_rss_kb(pid="self"):
+    """Peak RSS (VmHWM, KB) of a live process, None if it is gone or /proc is not available."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def process_tree(pid):
+    """pid and its live descendants."""
+    pids = [pid]
+    for parent in pids:
+        try:
+            for task in os.listdir(f"/proc/{parent}/task"):
+                with open(f"/proc/{parent}/task/{task}/children") as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def order_largest_first(tasks, size):
+    """Sort tasks by size(task), largest first, so big jobs do not straggle at the tail."""
+    return sorted(tasks, key=size, reverse=True)
+
+
+def run_command(command, timeout=None, executable="/bin/bash"):
+    """
+    Run a shell command with a hard timeout. On timeout the whole process group is killed.
+    Returns a dict with returncode, wall_time (s), peak_rss_mb and timed_out.
+
+    peak_rss_mb is the largest summed VmHWM of the command's process tree, sampled every 50 ms
+    (None if it could not be read). Unlike the ru_maxrss of wait4 it does not count the RSS of
+    this process, which the child inherits at fork.
+    """
+    start = time.time()
+    process = subprocess.Popen(
+        command,
+        shell=True,  # noqa: S602
+        executable=executable,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    timed_out = False
+    peak_rss_kb = None
+    while True:
+        # Popen returns after the exec, so the tree no longer shares this process's memory
+        rss_kb = [read_peak_rss_kb(pid) for pid in process_tree(process.pid)]
+        rss_kb = [kb for kb in rss_kb if kb is not None]
+        if rss_kb:
+            peak_rss_kb = max(peak_rss_kb or 0, sum(rss_kb))
+        pid, status = os.waitpid(process.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        if timeout is not None and time.time() - start > timeout:
+            timed_out = True
+            os.killpg(process.pid, signal.SIGKILL)
+            pid, status = os.waitpid(process.pid, 0)
+            break
+        time.sleep(0.05)
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    return {
+        "returncode": process.returncode,
+        "wall_time": time.time() - start,
+        "peak_rss_mb": peak_rss_kb / 1024 if peak_rss_kb is not None else None,
+        "timed_out": timed_out,
+    }
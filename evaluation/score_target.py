@@ -0,0 +1,302 @@
+"""
+Batched scoring of many predictions of one target against the same native.
+
+The native is parsed once, every model chain is aligned to the native chains once
+per unique (model sequence, native sequence) pair, and the aligned coordinates of
+all models are stacked into (n_models, n_atoms, 3) arrays so that fnat, iRMSD,
+LRMSD and DockQ (DockQv2 definitions) and lDDT are computed for all models at once.
+"""
+
+import itertools
+from collections import defaultdict
+
+import numpy as np
+
+from .DockQv2.DockQ import (
+    load_PDB,
+    align_chains,
+    format_alignment,
+    get_aligned_residues,
+    get_residue_distances,
+    get_interacting_pairs,
+    list_atoms_per_residue,
+    subset_atoms,
+    chain_cache_scope,
+    dockq_formula,
+    BACKBONE_ATOMS,
+    FNAT_THRESHOLD,
+    INTERFACE_THRESHOLD,
+)
+from .eval_by_dockqv2 import load_native, reformat_het, reformat_type
+
+LDDT_INCLUSION_RADIUS = 15.0
+LDDT_THRESHOLDS = (0.5, 1.0, 2.0, 4.0)
+
+
+class AlignmentCache():
+    """Sequence alignments keyed by (model sequence, native sequence)."""
+
+    def __init__(self):
+        self.alignments = {}
+
+    def get(self, model_chain, native_chain):
+        key = (model_chain.sequence, native_chain.sequence)
+        if key not in self.alignments:
+            alignment = format_alignment(align_chains(model_chain, native_chain))
+            self.alignments[key] = tuple(alignment.values())
+        return self.alignments[key]
+
+
+def batched_superpose(mobile, target):
+    """
+    Kabsch superposition of every mobile[k] (n, P, 3) onto target (P, 3).
+    Returns rotations (n, 3, 3) and translations (n, 3) for `x @ rot + tran`, and the RMSDs (n,).
+    """
+    mobile_center = mobile.mean(axis=1)
+    target_center = target.mean(axis=0)
+    mobile_c = mobile - mobile_center[:, None]
+    target_c = target - target_center
+
+    u, _, vt = np.linalg.svd(np.einsum("npi,pj->nij", mobile_c, target_c))
+    d = np.sign(np.linalg.det(np.matmul(u, vt)))
+    u[:, :, 2] *= d[:, None]
+    rot = np.matmul(u, vt)
+    tran = target_center - np.einsum("ni,nij->nj", mobile_center, rot)
+
+    aligned = np.matmul(mobile, rot) + tran[:, None]
+    rmsd = np.sqrt(((aligned - target) ** 2).sum(-1).mean(-1))
+    return rot, tran, rmsd
+
+
+def batched_rmsd(model, native):
+    return np.sqrt(((model - native) ** 2).sum(-1).mean(-1))
+
+
+def batched_lddt(model, native, residue_index):
+    """
+    All-atom lDDT of every model (n, N, 3) against native (N, 3).
+    Atoms missing in a model are NaN and count as not preserved.
+    """
+    from scipy.spatial import cKDTree
+
+    pairs = cKDTree(native).query_pairs(LDDT_INCLUSION_RADIUS, output_type="ndarray")
+    pairs = pairs[residue_index[pairs[:, 0]] != residue_index[pairs[:, 1]]]
+    if len(pairs) == 0:
+        return np.full(model.shape[0], np.nan)
+
+    native_distances = np.linalg.norm(native[pairs[:, 0]] - native[pairs[:, 1]], axis=-1)
+    model_distances = np.linalg.norm(model[:, pairs[:, 0]] - model[:, pairs[:, 1]], axis=-1)
+    difference = np.abs(model_distances - native_distances)
+    preserved = np.mean([difference < threshold for threshold in LDDT_THRESHOLDS], axis=0)
+    return preserved.mean(axis=-1)
+
+
+def get_candidate_chains(model_structure, native_chain, alignment_cache, allowed_mismatches):
+    candidates = []
+    for model_chain in model_structure:
+        if model_chain.is_het or native_chain.is_het or model_chain.type != native_chain.type:
+            continue
+        alignment = alignment_cache.get(model_chain, native_chain)
+        if alignment[1].count(".") <= allowed_mismatches:
+            candidates.append(model_chain.id)
+    return candidates
+
+
+def chain_coords(residues):
+    return np.asarray([atom.coord for res in residues for atom in res.get_atoms()])
+
+
+def native_atom_coords(model_residues, native_residues, native_chain):
+    """Model coordinates in native atom order (NaN where the model has no such atom)."""
+    model_by_residue = {}
+    for model_res, native_res in zip(model_residues, native_residues):
+        model_by_residue[native_res.id] = {atom.id: atom.coord for atom in model_res.get_atoms()}
+
+    coords = []
+    for native_res in native_chain:
+        model_atoms = model_by_residue.get(native_res.id, {})
+        for atom in native_res.get_atoms():
+            coords.append(model_atoms.get(atom.id, (np.nan, np.nan, np.nan)))
+    return np.asarray(coords, dtype=float)
+
+
+def extract_candidate(model_structure, native_chains, chain_map, alignment_cache):
+    """Everything the batched metrics need for one (model, chain map) candidate."""
+    model_chains = [model_structure[chain_map[native_chain.id]] for native_chain in native_chains]
+    aligned = [
+        get_aligned_residues(model_chain, native_chain, alignment_cache.get(model_chain, native_chain))
+        for model_chain, native_chain in zip(model_chains, native_chains)
+    ]
+    (sample_1, ref_1), (sample_2, ref_2) = aligned
+
+    ref_res_distances = get_residue_distances(native_chains[0], native_chains[1], "ref")
+    if ref_res_distances.shape != (len(ref_1), len(ref_2)):
+        ref_res_distances = get_residue_distances(ref_1, ref_2, "ref")
+    interface_1, interface_2 = get_interacting_pairs(ref_res_distances, threshold=INTERFACE_THRESHOLD ** 2)
+
+    sample_interface_1, ref_interface_1 = subset_atoms(sample_1, ref_1, atom_types=BACKBONE_ATOMS, residue_subset=interface_1)
+    sample_interface_2, ref_interface_2 = subset_atoms(sample_2, ref_2, atom_types=BACKBONE_ATOMS, residue_subset=interface_2)
+
+    # receptor is the longer native chain, as in DockQ
+    receptor, ligand = ((sample_1, ref_1), (sample_2, ref_2)) if len(native_chains[0]) > len(native_chains[1]) else ((sample_2, ref_2), (sample_1, ref_1))
+    sample_receptor, ref_receptor = subset_atoms(receptor[0], receptor[1], atom_types=BACKBONE_ATOMS, what="receptor")
+    sample_ligand, ref_ligand = subset_atoms(ligand[0], ligand[1], atom_types=BACKBONE_ATOMS, what="ligand")
+
+    return {
+        "chain_map": chain_map,
+        "alignment": tuple(alignment_cache.get(c, n) for c, n in zip(model_chains, native_chains)),
+        "ref_res_distances": ref_res_distances,
+        "atoms_1": chain_coords(sample_1),
+        "atoms_2": chain_coords(sample_2),
+        "atoms_per_res_1": list_atoms_per_residue(sample_1, "sample"),
+        "atoms_per_res_2": list_atoms_per_residue(sample_2, "sample"),
+        "interface": np.asarray(sample_interface_1 + sample_interface_2),
+        "ref_interface": np.asarray(ref_interface_1 + ref_interface_2),
+        "receptor": np.asarray(sample_receptor),
+        "ref_receptor": np.asarray(ref_receptor),
+        "ligand": np.asarray(sample_ligand),
+        "ref_ligand": np.asarray(ref_ligand),
+        "lddt_atoms": np.concatenate(
+            [native_atom_coords(s, r, n) for (s, r), n in zip(aligned, native_chains)]
+        ),
+    }
+
+
+def segment_pairs(contacts, atoms_per_res_1, atoms_per_res_2):
+    """Atom index pairs of every residue pair in contacts, and the start of each pair's segment."""
+    starts_1 = np.concatenate(([0], np.cumsum(atoms_per_res_1)[:-1]))
+    starts_2 = np.concatenate(([0], np.cumsum(atoms_per_res_2)[:-1]))
+    atoms_1, atoms_2, segments = [], [], []
+    n_pairs = 0
+    for i, j in contacts:
+        a, b = np.meshgrid(
+            np.arange(starts_1[i], starts_1[i] + atoms_per_res_1[i]),
+            np.arange(starts_2[j], starts_2[j] + atoms_per_res_2[j]),
+            indexing="ij",
+        )
+        atoms_1.append(a.ravel())
+        atoms_2.append(b.ravel())
+        segments.append(n_pairs)
+        n_pairs += a.size
+    return np.concatenate(atoms_1), np.concatenate(atoms_2), np.asarray(segments)
+
+
+def score_candidates(candidates, nat_total):
+    """DockQ metrics for a group of candidates that share the same alignment and atom layout."""
+    first = candidates[0]
+    contacts = np.argwhere(first["ref_res_distances"] < FNAT_THRESHOLD ** 2)
+
+    if len(contacts):
+        atoms_1, atoms_2, segments = segment_pairs(contacts, first["atoms_per_res_1"], first["atoms_per_res_2"])
+        coords_1 = np.stack([c["atoms_1"] for c in candidates])
+        coords_2 = np.stack([c["atoms_2"] for c in candidates])
+        distances = ((coords_1[:, atoms_1] - coords_2[:, atoms_2]) ** 2).sum(-1)
+        contact_distances = np.minimum.reduceat(distances, segments, axis=1)
+        nat_correct = (contact_distances < FNAT_THRESHOLD ** 2).sum(-1)
+    else:
+        nat_correct = np.zeros(len(candidates), dtype=int)
+    fnat = nat_correct / nat_total
+
+    _, _, irmsd = batched_superpose(np.stack([c["interface"] for c in candidates]), first["ref_interface"])
+
+    rot, tran, _ = batched_superpose(np.stack([c["receptor"] for c in candidates]), first["ref_receptor"])
+    ligand = np.matmul(np.stack([c["ligand"] for c in candidates]), rot) + tran[:, None]
+    lrmsd = batched_rmsd(ligand, first["ref_ligand"])
+
+    dockq = np.asarray([dockq_formula(f, i, l) for f, i, l in zip(fnat, irmsd, lrmsd)])
+    return fnat, irmsd, lrmsd, dockq
+
+
+def layout_key(candidate):
+    return (
+        candidate["alignment"],
+        tuple(candidate["atoms_per_res_1"]),
+        tuple(candidate["atoms_per_res_2"]),
+        candidate["interface"].shape,
+        candidate["receptor"].shape,
+        candidate["ligand"].shape,
+    )
+
+
+def load_model(model_path):
+    model_structure = load_PDB(model_path)
+    model_structure = reformat_het(model_structure)
+    model_structure = reformat_type(model_structure)
+    return model_structure
+
+
+@chain_cache_scope()
+def score_target(native_path, prediction_paths, interfaces, allowed_mismatches=4):
+    """
+    Score all predictions of one target against its native in one call.
+
+    Parameters:
+    - native_path (str): The path to the native (ground truth) structure.
+    - prediction_paths (list): Paths of the predicted structures, e.g. the 5 seeds x 5 samples of a target.
+    - interfaces (list): Native chain id pairs [(id1, id2), ...] to score.
+    - allowed_mismatches (int): The maximum number of sequence mismatches between model and native chains.
+
+    Returns a list with one record per (prediction, interface) with fnat, irmsd, lrmsd,
+    dockq_score (best chain map per prediction, as in eval_by_dockqv2.dockq) and lddt
+    (all-atom lDDT over the two interface chains).
+    Interfaces involving small molecules, or without native contacts, get None metrics.
+    """
+    native_structure = load_native(native_path)
+    model_structures = [load_model(path) for path in prediction_paths]
+    alignment_cache = AlignmentCache()
+
+    records = []
+    for id1, id2 in interfaces:
+        native_chains = (native_structure[id1], native_structure[id2])
+        results = [None] * len(model_structures)
+
+        nat_total = np.sum(get_residue_distances(native_chains[0], native_chains[1], "ref") < FNAT_THRESHOLD ** 2)
+        if nat_total > 0 and not (native_chains[0].is_het or native_chains[1].is_het):
+            native_lddt_atoms = np.concatenate(
+                [np.asarray([atom.coord for atom in chain.get_atoms()], dtype=float) for chain in native_chains]
+            )
+            residue_index = np.concatenate(
+                [np.repeat(np.arange(len(chain)) + k * 100000, list_atoms_per_residue(chain, "ref")) for k, chain in enumerate(native_chains)]
+            )
+
+            groups = defaultdict(list)
+            for model_index, model_structure in enumerate(model_structures):
+                candidates_1 = get_candidate_chains(model_structure, native_chains[0], alignment_cache, allowed_mismatches)
+                candidates_2 = get_candidate_chains(model_structure, native_chains[1], alignment_cache, allowed_mismatches)
+                for chain_1, chain_2 in itertools.product(candidates_1, candidates_2):
+                    if chain_1 == chain_2:
+                        continue
+                    candidate = extract_candidate(model_structure, native_chains, {id1: chain_1, id2: chain_2}, alignment_cache)
+                    candidate["model_index"] = model_index
+                    groups[layout_key(candidate)].append(candidate)
+
+            for candidates in groups.values():
+                fnat, irmsd, lrmsd, dockq = score_candidates(candidates, nat_total)
+                lddt = batched_lddt(np.stack([c["lddt_atoms"] for c in candidates]), native_lddt_atoms, residue_index)
+                for k, candidate in enumerate(candidates):
+                    best = results[candidate["model_index"]]
+                    if best is None or dockq[k] > best["dockq_score"]:
+                        results[candidate["model_index"]] = {
+                            "fnat": fnat[k],
+                            "irmsd": irmsd[k],
+                            "lrmsd": lrmsd[k],
+                            "dockq_score": dockq[k],
+                            "lddt": lddt[k],
+                            "chain_map": candidate["chain_map"],
+                        }
+
+        for prediction_path, result in zip(prediction_paths, results):
+            record = {
+                "prediction_path": prediction_path,
+                "interface_chain_id_1": id1,
+                "interface_chain_id_2": id2,
+                "fnat": None,
+                "irmsd": None,
+                "lrmsd": None,
+                "dockq_score": None,
+                "lddt": None,
+            }
+            if result is not None:
+                record.update(result)
+            records.append(record)
+    return records
@@ -0,0 +1,282 @@
+"""
+Sharded evaluation on a shared filesystem.
+
+Every worker process, on any host that sees the evaluation dir, builds the same job graph
+(job_graph.build_jobs) and works through it largest first. A job is claimed by creating
+{queue_dir}/claims/{job_id} with O_CREAT | O_EXCL, which only one process can do, and its
+outcome is written to {queue_dir}/results/{job_id}.json through a rename, so a result is
+either complete or absent. The job id hashes the job key and the stamp of its inputs, so
+changed predictions are queued again.
+
+Workers touch their claims while the jobs run, a claim untouched for claim_timeout belongs
+to a dead worker and is taken over. Takeovers and releases check and replace a claim while
+holding {claim}.lock, created with O_CREAT | O_EXCL, so only one worker replaces a stale claim
+and a worker only touches or releases its own claim (the owner line). A failed
+job is released, so the next worker run retries it. Once all workers are done, finalize_queue
+assembles raw/{target_type}_*.csv.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+
+from .DockQv2.DockQ import INTERFACE_THRESHOLD
+from .eval_by_dockqv2 import set_dockqv2_options
+from .eval_by_ost import ost_mode
+from .job_graph import CheckpointEncoder, assemble_target, build_jobs, ost_output_path, run_job
+from .ost_worker_pool import OSTWorkerPool
+from .result_cache import ResultCache
+from .scheduler import available_workers, order_largest_first
+
+
+def job_id(job):
+    return hashlib.sha1(f"{job['key']}|{job['stamp']}".encode()).hexdigest()
+
+
+def atomic_write(path, text):
+    """Write text to path through a rename, readers never see a partial file."""
+    tmp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class WorkQueue():
+    """Claims and results of the jobs in queue_dir."""
+
+    def __init__(self, queue_dir, claim_timeout=3600):
+        self.claim_dir = os.path.join(queue_dir, 'claims')
+        self.result_dir = os.path.join(queue_dir, 'results')
+        self.claim_timeout = claim_timeout
+        # tells the claims of this queue apart from earlier ones of the same process
+        self.token = uuid.uuid4().hex
+        os.makedirs(self.claim_dir, exist_ok=True)
+        os.makedirs(self.result_dir, exist_ok=True)
+
+    def result_path(self, job):
+        return os.path.join(self.result_dir, f"{job_id(job)}.json")
+
+    def has_result(self, job):
+        return os.path.exists(self.result_path(job))
+
+    @staticmethod
+    def read_claim(path):
+        """The mtime and owner line of a claim."""
+        with open(path, 'r') as f:
+            return os.fstat(f.fileno()).st_mtime, f.read()
+
+    def claim_path(self, job):
+        return os.path.join(self.claim_dir, job_id(job))
+
+    def owner(self, job):
+        return f"{socket.gethostname()} {os.getpid()} {self.token} {job['key']}\n"
+
+    def lock(self, claim_path):
+        """
+        Try to take the lock of a claim. The lock is only held for a few file operations, one
+        older than claim_timeout was left by a worker that died holding it and is removed.
+        """
+        lock_path = f"{claim_path}.lock"
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            pass
+        try:
+            if time.time() - os.path.getmtime(lock_path) > self.claim_timeout:
+                os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+        return False
+
+    def unlock(self, claim_path):
+        os.remove(f"{claim_path}.lock")
+
+    def create_claim(self, job):
+        try:
+            fd = os.open(self.claim_path(job), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.owner(job))
+        return True
+
+    def claim(self, job):
+        """
+        Try to claim job. Returns None if it is done or claimed by a live worker, else whether
+        the claim was taken over from a dead worker.
+        """
+        if self.has_result(job):
+            return None
+        claim_path = self.claim_path(job)
+        stolen = False
+        if not self.create_claim(job):
+            try:
+                mtime, _ = self.read_claim(claim_path)
+            except FileNotFoundError:
+                # released or taken over since, leave it to the next pass
+                return None
+            if time.time() - mtime < self.claim_timeout or not self.lock(claim_path):
+                return None
+            try:
+                # the claim may have been replaced or touched since it was read
+                try:
+                    mtime, _ = self.read_claim(claim_path)
+                except FileNotFoundError:
+                    mtime = None
+                if mtime is not None and time.time() - mtime < self.claim_timeout:
+                    return None
+                if mtime is not None:
+                    os.remove(claim_path)
+                    stolen = True
+                # a worker claiming the job without the lock may still win here
+                if not self.create_claim(job):
+                    return None
+            finally:
+                self.unlock(claim_path)
+        # a result may have been written between the first check and the claim
+        if self.has_result(job):
+            return None
+        return stolen
+
+    def release(self, job):
+        """Remove the claim of job if it is still this worker's."""
+        claim_path = self.claim_path(job)
+        while not self.lock(claim_path):
+            time.sleep(0.01)
+        try:
+            if self.read_claim(claim_path)[1] == self.owner(job):
+                os.remove(claim_path)
+        except FileNotFoundError:
+            pass
+        finally:
+            self.unlock(claim_path)
+
+    def touch(self, job):
+        """Refresh the claim of job if it is still this worker's."""
+        try:
+            with open(self.claim_path(job), 'r') as f:
+                # touch the file that was read, even if it is replaced meanwhile
+                if f.read() == self.owner(job):
+                    os.utime(f.fileno())
+        except FileNotFoundError:
+            pass
+
+    def put(self, job, records, job_record):
+        atomic_write(self.result_path(job), json.dumps(
+            {'key': job['key'], 'stamp': job['stamp'], 'records': records, 'job': job_record, 'host': socket.gethostname()},
+            cls=CheckpointEncoder,
+        ))
+
+    def get(self, job):
+        try:
+            with open(self.result_path(job), 'r') as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return None
+
+
+def run_queue_worker(target_dfs,evaluation_dir,ground_truth_dir,queue_dir = None,monomer_scorer = 'ost',max_workers = None,ost_workers = 0,result_cache_path = None,job_timeout = 600,dockq_kdtree = False,dockq_max_chain_maps = None,claim_timeout = 3600):
+    """
+    Claim and run jobs of the shared queue until none is left. Can run in any number of
+    processes on any number of hosts. queue_dir defaults to {evaluation_dir}/queue.
+    """
+    target_dfs = {target_type: target_df for target_type, target_df in target_dfs.items() if ost_mode(target_type)}
+    detail_path = os.path.join(evaluation_dir, 'detail')
+    os.makedirs(detail_path, exist_ok=True)
+    queue = WorkQueue(queue_dir or os.path.join(evaluation_dir, 'queue'), claim_timeout)
+
+    jobs, _ = build_jobs(target_dfs, ground_truth_dir, detail_path, monomer_scorer)
+    pending = iter(order_largest_first([job for job in jobs.values() if not queue.has_result(job)], lambda job: job['size']))
+    pending_lock = threading.Lock()
+    counts = {'done': 0, 'failed': 0}
+
+    if max_workers is None:
+        max_workers = available_workers()
+    result_cache = ResultCache(result_cache_path) if result_cache_path else None
+    worker_pool = OSTWorkerPool(ost_workers) if ost_workers > 0 else None
+
+    def next_job():
+        with pending_lock:
+            for job in pending:
+                stolen = queue.claim(job)
+                if stolen is None:
+                    continue
+                if stolen and job['kind'] == 'ost' and os.path.exists(ost_output_path(job['args'])):
+                    # the dead worker may have left a partial ost output
+                    os.remove(ost_output_path(job['args']))
+                return job
+        return None
+
+    running = {}
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(claim_timeout / 4):
+            with pending_lock:
+                claimed = list(running.values())
+            for job in claimed:
+                queue.touch(job)
+
+    def work(process_pool):
+        while True:
+            job = next_job()
+            if job is None:
+                return
+            with pending_lock:
+                running[job['key']] = job
+            try:
+                records, job_record, done = run_job(job, process_pool, worker_pool, result_cache, job_timeout)
+            except Exception as e:
+                print(f"Error occurred for job: {job['key']}")
+                print(traceback.format_exc())
+                done = False
+            if done:
+                queue.put(job, records, job_record)
+            else:
+                queue.release(job)
+            with pending_lock:
+                del running[job['key']]
+                counts['done' if done else 'failed'] += 1
+
+    distance_cutoff = INTERFACE_THRESHOLD if dockq_kdtree else None
+    with Pool(max_workers, initializer=set_dockqv2_options, initargs=(distance_cutoff, dockq_max_chain_maps)) as process_pool, \
+            ThreadPoolExecutor(max_workers=max_workers + 1) as executor:
+        executor.submit(heartbeat)
+        try:
+            for future in [executor.submit(work, process_pool) for _ in range(max_workers)]:
+                future.result()
+        finally:
+            stop.set()
+
+    if worker_pool is not None:
+        worker_pool.close()
+    print(f"{socket.gethostname()}:{os.getpid()} ran {counts['done']} jobs, {counts['failed']} failed")
+
+
+def finalize_queue(target_dfs,evaluation_dir,ground_truth_dir,queue_dir = None,monomer_scorer = 'ost'):
+    """Assemble raw/{target_type}_*.csv from the results of the shared queue."""
+    target_dfs = {target_type: target_df for target_type, target_df in target_dfs.items() if ost_mode(target_type)}
+    detail_path = os.path.join(evaluation_dir, 'detail')
+    queue = WorkQueue(queue_dir or os.path.join(evaluation_dir, 'queue'))
+
+    jobs, target_rows = build_jobs(target_dfs, ground_truth_dir, detail_path, monomer_scorer)
+    finished = {}
+    for key, job in jobs.items():
+        entry = queue.get(job)
+        if entry is not None:
+            finished[key] = entry
+    if len(finished) < len(jobs):
+        print(f"{len(jobs) - len(finished)} of {len(jobs)} jobs have no result, their rows are missing or empty")
+
+    for target_type, rows in target_rows.items():
+        assemble_target(target_type, rows, finished, evaluation_dir, ground_truth_dir, detail_path)
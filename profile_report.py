@@ -0,0 +1,73 @@
+import pandas as pd
+import argparse
+import os
+
+
+def load_profile(profile_path):
+    """Read a profile written by evaluate.py --profile (parquet, or the csv fallback)."""
+    if profile_path.endswith('.csv'):
+        return pd.read_csv(profile_path, dtype={'pdb_id': str})
+    return pd.read_parquet(profile_path)
+
+
+def stage_columns(df):
+    return [column for column in df.columns if column.endswith('_s') and column != 'total_s']
+
+
+def slowest_targets(df, top):
+    """
+    Total time, samples and peak RSS per (tool, target), slowest first. For ost rows
+    peak_rss_mb is the evaluate.py process, ost_peak_rss_mb the ost job.
+    """
+    aggregations = {'total_s': ('total_s', 'sum'), 'samples': ('total_s', 'size'), 'peak_rss_mb': ('peak_rss_mb', 'max')}
+    for column in ['ost_peak_rss_mb', 'n_atoms_native', 'n_chain_maps']:
+        if column in df.columns:
+            aggregations[column] = (column, 'max')
+    targets = df.groupby(['tool', 'pdb_id']).agg(**aggregations).reset_index()
+    return targets.sort_values('total_s', ascending=False).head(top)
+
+
+def stage_totals(df):
+    """Total time per (tool, stage), with its share of the tool's total time."""
+    rows = []
+    for tool, tool_df in df.groupby('tool'):
+        tool_total = tool_df['total_s'].sum()
+        for column in stage_columns(tool_df):
+            seconds = tool_df[column].sum()
+            if seconds > 0:
+                rows.append({'tool': tool, 'stage': column[:-2], 'total_s': seconds, 'share': seconds / tool_total if tool_total else 0.0})
+        # time outside of all stages, e.g. reformatting structures or writing outputs
+        rest = tool_total - tool_df[stage_columns(tool_df)].sum().sum()
+        rows.append({'tool': tool, 'stage': '(other)', 'total_s': rest, 'share': rest / tool_total if tool_total else 0.0})
+    return pd.DataFrame(rows).sort_values('total_s', ascending=False)
+
+
+def slowest_samples(df, top):
+    columns = [column for column in ['tool', 'pdb_id', 'seed', 'sample', 'mode', 'interface_chain_id_1', 'interface_chain_id_2', 'total_s', 'peak_rss_mb', 'ost_peak_rss_mb', 'n_atoms_native', 'n_chain_maps'] if column in df.columns]
+    return df.sort_values('total_s', ascending=False)[columns].head(top)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--profile_path", required=False, default='./examples/outputs/evaluation/Protenix/profile.parquet', help="profile.parquet (or .csv) written by evaluate.py --profile.",
+    )
+    parser.add_argument(
+        "--top", required=False, type=int, default=20, help="Number of targets and samples to show.",
+    )
+    args = parser.parse_args()
+
+    if not os.path.exists(args.profile_path):
+        print(f"profile_path is not exists: {args.profile_path}")
+        exit(1)
+    df = load_profile(args.profile_path)
+
+    with pd.option_context('display.width', 200, 'display.max_columns', None, 'display.float_format', '{:.2f}'.format):
+        print(f"{len(df)} profiled samples, {df['total_s'].sum():.1f}s in total\n")
+        print("Slowest targets:")
+        print(slowest_targets(df, args.top).to_string(index=False))
+        print("\nStages:")
+        print(stage_totals(df).to_string(index=False))
+        print("\nSlowest samples:")
+        print(slowest_samples(df, args.top).to_string(index=False))
@@ -10,6 +10,12 @@ output_root_dir="./examples/outputs"
 time_log_root_dir="./examples/times"
 ground_truth_dir="./examples/ground_truths"
 overlay_size=2048
+# Set to a tmpfs dir (e.g. /dev/shm/foldbench) to score targets while they are postprocessed.
+# It must be an absolute path: it is bound into the container at the same path, since the
+# published paths are written inside the container and read by evaluate.py outside of it.
+# Only copies are handed off, the postprocessed files are kept next to the predictions, so this
+# overlaps postprocessing with scoring but does not cut the disk writes.
+handoff_root_dir=""
 
 
 prediction_root_dir="$output_root_dir/prediction"
@@ -77,18 +83,36 @@ for algorithm_dir in algorithms/*; do
                 # Create writable overlay for the container
                 apptainer overlay create --size $overlay_size --sparse "algorithms/${algorithm_name}/overlay.img"
 
+                handoff_dir=""
+                if [ -n "$handoff_root_dir" ]; then
+                    handoff_dir="$handoff_root_dir/${algorithm_name}"
+                    rm -rf "$handoff_dir"
+                    mkdir -p "$handoff_dir"
+                    echo "EVALUATE PREDICTIONS WHILE POSTPROCESSING"
+                    python evaluate.py --targets_dir ${targets_dir} --evaluation_dir ${evaluation_root_dir} --algorithm_name ${algorithm_name} --ground_truth_dir ${ground_truth_dir} --handoff_dir ${handoff_dir} &
+                    evaluate_pid=$!
+                fi
+
                 # Calculate predictions
                 echo "RUN ALGORITHM $algorithm_name"
                 { time ( apptainer exec --nv \
                     --overlay "algorithms/${algorithm_name}/overlay.img" \
                     -B $af3_input_json:/algo/alphafold3_inputs.json \
                     -B $output_root_dir:/algo/outputs \
+                    ${handoff_dir:+-B "$handoff_dir"} \
                     "algorithms/${algorithm_name}/container.sif" \
                     bash -c "cd /algo \
-                    && ./make_predictions.sh ${af3_input_json} ${input_dir} ${prediction_dir} ${evaluation_dir} ${gpu_id}" 2>&1 ); } 2> "$time_log_file"
+                    && ./make_predictions.sh ${af3_input_json} ${input_dir} ${prediction_dir} ${evaluation_dir} ${gpu_id} ${handoff_dir}" 2>&1 ); } 2> "$time_log_file"
                 
-                echo "EVALUATE PREDICTIONS"
-                python evaluate.py --targets_dir ${targets_dir} --prediction_dir ${prediction_dir} --evaluation_dir ${evaluation_dir} --ground_truth_dir ${ground_truth_dir}
+                if [ -n "$handoff_dir" ]; then
+                    # let evaluate.py finish even if the algorithm failed before publishing everything
+                    touch "$handoff_dir/done"
+                    wait $evaluate_pid
+                    rm -rf "$handoff_dir"
+                else
+                    echo "EVALUATE PREDICTIONS"
+                    python evaluate.py --targets_dir ${targets_dir} --prediction_dir ${prediction_dir} --evaluation_dir ${evaluation_dir} --ground_truth_dir ${ground_truth_dir}
+                fi
                 python task_score_summary.py --algorithm_names ${algorithm_name}
                 
             else
@@ -1,7 +1,11 @@
 import pandas as pd
+import numpy as np
 import os
 import glob
+import json
+import hashlib
 import argparse
+from bootstrap_summary import bootstrap_summary
 
 metric_max = ['dockq_score','lddt-lp','lddt-pli','gdt-ts','tm-score','lddt']
 metric_min = ['irmsd','lrmsd','rmsd']
@@ -18,59 +22,147 @@ target_metrics_summary['monomer_dna'] = {'gdt-ts': [], 'tm-score': [], 'rmsd': [
 target_metrics_summary['monomer_rna'] = {'gdt-ts': [], 'tm-score': [], 'rmsd': [], 'lddt': []}
 
 
+KEY_DTYPES = {
+    'pdb_id': str,
+    'interface_chain_id_1': str, 'interface_chain_id_2': str,
+    'native_chain_id_1': str, 'native_chain_id_2': str,
+    'chain_id': str,
+}
+
+# success metric -> (required columns, metric used to select the best row, success condition)
+SUCCESS_CRITERIA = {
+    'dockq_score': (['dockq_score'], 'dockq_score', lambda rows: rows['dockq_score'] >= 0.23),
+    'rmsd': (['rmsd'], 'rmsd', lambda rows: rows['rmsd'] < 2.0),
+    'rmsd_lddt-pli': (['rmsd', 'lddt-pli'], 'rmsd', lambda rows: (rows['rmsd'] < 2.0) & (rows['lddt-pli'] > 0.8)),
+}
+
+SUMMARY_CACHE_NAME = 'summary_cache.json'
+# the cached aggregates depend on the metric selection and success criteria defined here,
+# so the cache is keyed by the source of this file as well
+with open(__file__, 'rb') as _f:
+    SUMMARY_CACHE_VERSION = hashlib.sha256(_f.read()).hexdigest()
+
+_frames = {}
+
+
 def change_column_name(df):
     if 'native_chain_id_1' in df.columns and 'native_chain_id_2' in df.columns:
         df.rename(columns={'native_chain_id_1': 'interface_chain_id_1', 'native_chain_id_2': 'interface_chain_id_2'}, inplace=True)
     return df
 
-def find_overlap_sample(df, ref_df):
 
+def load_frame(path):
+    """Read a raw or target CSV once per process, with string typed key columns."""
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    if key not in _frames or _frames[key][0] != (stat.st_mtime_ns, stat.st_size):
+        df = change_column_name(pd.read_csv(path, dtype=KEY_DTYPES))
+        _frames[key] = ((stat.st_mtime_ns, stat.st_size), df)
+    return _frames[key][1]
+
+
+def get_key_columns(df):
     if 'interface_chain_id_1' in df.columns and 'interface_chain_id_2' in df.columns:
-        df_tuples = list(zip(df['pdb_id'], 
-                        df['interface_chain_id_1'], 
-                        df['interface_chain_id_2']))
+        return ["pdb_id", "interface_chain_id_1", "interface_chain_id_2"]
+    return ["pdb_id"]
 
 
-        ref_df_tuples = list(zip(ref_df['pdb_id'], 
-                                ref_df['interface_chain_id_1'], 
-                                ref_df['interface_chain_id_2']))
-    else:
-        df_tuples = list(zip(df['pdb_id']))
-        ref_df_tuples = list(zip(ref_df['pdb_id']))
+def find_overlap_sample(df, ref_df):
+    keys = get_key_columns(df)
+    if any(key not in ref_df.columns for key in keys):
+        keys = ["pdb_id"]
+    mask = pd.MultiIndex.from_frame(df[keys]).isin(pd.MultiIndex.from_frame(ref_df[keys]))
+    return df[mask]
 
-    
 
-    common_tuples = set(df_tuples).intersection(set(ref_df_tuples))
+def is_min_metric(metric):
+    return metric in metric_min or metric.replace('_', '-') in metric_min
 
 
-    if 'interface_chain_id_1' in df.columns and 'interface_chain_id_2' in df.columns:
-        mask = [tuple(row) in common_tuples for row in df[['pdb_id', 'interface_chain_id_1', 'interface_chain_id_2']].values]
-    else:
-        mask = [tuple(row) in common_tuples for row in df[['pdb_id']].values]
+def select_best_rows(df, selections, metric_type):
+    """
+    Select the best prediction of each target for several metrics in one groupby pass.
+
+    selections: name -> (selection metric, required columns). Only rows where all required
+    columns are present are considered, the best row is the one with the highest
+    ranking_score (metric_type 'rank') or the best selection metric value (metric_type 'best').
+    Returns name -> best rows.
+    """
+    keys = get_key_columns(df)
+    scores = pd.DataFrame(index=df.index)
+    for name, (metric, required) in selections.items():
+        valid = df[required].notna().all(axis=1)
+        if metric_type == 'rank':
+            score = df['ranking_score']
+        elif is_min_metric(metric):
+            score = -df[metric]
+        else:
+            score = df[metric]
+        scores[name] = score.where(valid).astype(float)
+
+    grouped = scores.fillna(-np.inf).groupby([df[key] for key in keys])
+    best_index = grouped.idxmax()
+    has_valid = scores.notna().groupby([df[key] for key in keys]).any()
+
+    return {
+        name: df.loc[best_index.loc[has_valid[name], name].values]
+        for name in selections
+    }
 
-    
-    df = df[mask]
-    return df
 
 # Get best prediction for each target
 def get_best_rows(df, metric, metric_type):
-    if metric_type == 'rank':
-        if 'interface_chain_id_1' in df.columns and 'interface_chain_id_2' in df.columns:
-            best_rows = df.loc[df.groupby(["pdb_id","interface_chain_id_1","interface_chain_id_2"])['ranking_score'].idxmax()]
+    return select_best_rows(df, {metric: (metric, [metric])}, metric_type)[metric]
+
+
+def target_values(df, requests, metric_type):
+    """
+    requests: name -> ('avg', metric) or ('success', success metric in SUCCESS_CRITERIA).
+    All best-row selections are done in a single pass. Returns name -> per-target values
+    (a Series indexed by the target keys); success requests give 1.0/0.0 per target.
+    """
+    selections = {}
+    for name, (kind, metric) in requests.items():
+        if kind == 'success':
+            required, selection_metric, _ = SUCCESS_CRITERIA[metric]
+            selections[name] = (selection_metric, required)
+        else:
+            selections[name] = (metric, [metric])
+
+    best_rows = select_best_rows(df, selections, metric_type)
+    keys = get_key_columns(df)
+
+    values = {}
+    for name, (kind, metric) in requests.items():
+        rows = best_rows[name]
+        if kind == 'success':
+            column = SUCCESS_CRITERIA[metric][2](rows).astype(float)
         else:
-            best_rows = df.loc[df.groupby(["pdb_id"])['ranking_score'].idxmax()]
-    elif metric_type == 'best':
-        if metric in metric_max:
-            if 'interface_chain_id_1' in df.columns and 'interface_chain_id_2' in df.columns:
-                best_rows = df.loc[df.groupby(["pdb_id","interface_chain_id_1","interface_chain_id_2"])[metric].idxmax()]
-            else:
-                best_rows = df.loc[df.groupby(["pdb_id"])[metric].idxmax()]
-        elif metric in metric_min:
-            if 'interface_chain_id_1' in df.columns and 'interface_chain_id_2' in df.columns:
-                best_rows = df.loc[df.groupby(["pdb_id","interface_chain_id_1","interface_chain_id_2"])[metric].idxmin()]
-            else:
-                best_rows = df.loc[df.groupby(["pdb_id"])[metric].idxmin()]
-    return best_rows
+            column = rows[metric].astype(float)
+        values[name] = pd.Series(column.to_numpy(), index=pd.MultiIndex.from_frame(rows[keys]), name=name)
+    return values
+
+
+def metric_scale(name):
+    # success rates are reported in percent
+    return 100 if name.endswith('success_rate') else 1
+
+
+def summarize_values(values):
+    """name -> per-target values to name -> value (None without data)."""
+    return {
+        name: None if len(column) == 0 else column.mean() * metric_scale(name)
+        for name, column in values.items()
+    }
+
+
+def summarize(df, requests, metric_type):
+    """
+    requests: name -> ('avg', metric) or ('success', success metric in SUCCESS_CRITERIA).
+    Returns name -> value (None without data).
+    """
+    return summarize_values(target_values(df, requests, metric_type))
+
 
 def calculate_success_rate(df, metric, metric_type):
     """
@@ -78,52 +170,94 @@ def calculate_success_rate(df, metric, metric_type):
     
     Args:
         df (pd.DataFrame): Input dataframe
-        threshold (float): Threshold value for success
+        metric (str): One of SUCCESS_CRITERIA
     Returns:
         float: Success rate
     """
-
-
-
-    if metric  == 'dockq_score':
-        df=df[df[metric].notna()]
-        best_rows = get_best_rows(df, metric,metric_type)
-
-        success_rate = (len(best_rows[best_rows[metric] >= 0.23])/len(best_rows))*100
-        
-    elif metric == 'rmsd':
-        df=df[df[metric].notna()]
-        best_rows = get_best_rows(df, metric,metric_type)
-        success_rate = (len(best_rows[best_rows[metric] < 2.0])/len(best_rows))*100
-    elif metric == 'rmsd_lddt-pli':
-        df=df[df['rmsd'].notna() & df['lddt-pli'].notna()]
-        # use rmsd to select best by default
-        best_rows = get_best_rows(df, 'rmsd',metric_type)
-        success_rate = (len(best_rows[(best_rows['rmsd']<2.0) & (best_rows['lddt-pli']>0.8)])/len(best_rows))*100
-
-    return success_rate
+    return summarize(df, {metric: ('success', metric)}, metric_type)[metric]
 
 
 def calculate_score_avg(df, metric, metric_type):
     """
-    Calculate success rate based on a metric and threshold.
+    Calculate the average of a metric over the best prediction of each target.
     
     Args:
         df (pd.DataFrame): Input dataframe
-        threshold (float): Threshold value for success
+        metric (str): Metric column
     Returns:
-        float: Success rate
+        float: Average score
     """
+    return summarize(df, {metric: ('avg', metric)}, metric_type)[metric]
+
+
+def file_signature(path):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_mtime_ns, stat.st_size]
+
+
+def summarize_target_values(evaluation_dir, target_dir, model, target, metric_type):
+    result_path = os.path.join(evaluation_dir,model,'raw',f"{target}_ost.csv")
+    result_path_dockqv2 = os.path.join(evaluation_dir,model,'raw', f"{target}_dockqv2.csv")
+    target_path = os.path.join(target_dir, f"{target}.csv")
+
+    result_df = load_frame(result_path)
+    target_df = load_frame(target_path)
+    print(f'{target} num: {len(target_df)}')
+
+    result_df = find_overlap_sample(result_df,target_df)
+
+    # Process pp interface: dockq success_rate,irmsd,lrmsd,lddt
+    if target in ["interface_protein_protein", "interface_protein_peptide", "interface_antibody_antigen","interface_protein_dna", "interface_protein_rna"]:
+        results = target_values(result_df, {'lddt': ('avg', 'lddt')}, metric_type)
+        dockq_requests = {
+            'dockq_score_success_rate': ('success', 'dockq_score'),
+            'irmsd': ('avg', 'irmsd'),
+            'lrmsd': ('avg', 'lrmsd'),
+        }
+        if target in ["interface_protein_dna", "interface_protein_rna"]:
+            if os.path.exists(result_path_dockqv2):
+                result_df_dockqv2 = find_overlap_sample(load_frame(result_path_dockqv2),target_df)
+                results.update(target_values(result_df_dockqv2, dockq_requests, metric_type))
+        else:
+            results.update(target_values(result_df, dockq_requests, metric_type))
+
+    # Process pl interface: rmsd_lddt-pli success_rate,lddt-lp,lddt-pli
+    elif target in ["interface_protein_ligand"]:
+        results = target_values(result_df, {
+            'rmsd_lddt-pli_success_rate': ('success', 'rmsd_lddt-pli'),
+            'lddt-lp': ('avg', 'lddt-lp'),
+            'lddt-pli': ('avg', 'lddt-pli'),
+        }, metric_type)
+
+    # Process monomer: gdt_ts,tm-score,rmsd,lddt
+    elif target in ["monomer_dna", "monomer_rna", "monomer_protein"]:
+        requests = {}
+        for name, columns in [('gdt-ts', ['gdt_ts', 'gdt-ts']), ('tm-score', ['tm-score', 'tm_score'])]:
+            for column in columns:
+                if column in result_df.columns:
+                    requests[name] = ('avg', column)
+                    break
+        requests['rmsd'] = ('avg', 'rmsd')
+        requests['lddt'] = ('avg', 'lddt')
+        results = target_values(result_df, requests, metric_type)
+    else:
+        results = {}
 
-    df=df[df[metric].notna()]
-    best_rows = get_best_rows(df, metric,metric_type)
-    avg_score = best_rows[metric].mean()
+    return {metric: values for metric, values in results.items() if len(values) > 0}
 
 
-        
-    return avg_score
+def summarize_target(evaluation_dir, target_dir, model, target, metric_type):
+    return summarize_values(summarize_target_values(evaluation_dir, target_dir, model, target, metric_type))
+
 
 def process_csv_files(evaluation_dir,target_dir,output_path,models,targets,metric_type):
+    """
+    Summarize every model on every target. Per-model aggregates are cached in
+    {evaluation_dir}/{model}/summary_cache.json and only recomputed when one of
+    their input CSVs or the summary code changes, so adding a model only computes that model.
+    """
 
     results = {}
     
@@ -131,64 +265,39 @@ def process_csv_files(evaluation_dir,target_dir,output_path,models,targets,metri
     for model in models:
         results[model] = {}
 
+        cache_path = os.path.join(evaluation_dir,model,SUMMARY_CACHE_NAME)
+        cache = {}
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                cache = json.load(f)
+        if cache.get('version') != SUMMARY_CACHE_VERSION:
+            cache = {'version': SUMMARY_CACHE_VERSION}
+        cache_changed = False
+
         for target in targets:
             result_path = os.path.join(evaluation_dir,model,'raw',f"{target}_ost.csv")
             # 
             if not os.path.exists(result_path):
                 print(f'{result_path} not found')
                 continue
-            target_path = os.path.join(target_dir, f"{target}.csv")
-
-            result_df = pd.read_csv(result_path)
-            result_df = change_column_name(result_df)
-
-            target_df = pd.read_csv(target_path)
-            target_df = change_column_name(target_df)
-            print(f'{target} num: {len(target_df)}')
-
-            result_df = find_overlap_sample(result_df,target_df)
-
-            results[model][target] = {}
-
-            # Process pp interface: dockq success_rate,irmsd,lrmsd,lddt
-            if target in ["interface_protein_protein", "interface_protein_peptide", "interface_antibody_antigen","interface_protein_dna", "interface_protein_rna"]:
-                   
-                results[model][target]['lddt'] = calculate_score_avg(result_df, 'lddt',metric_type)
-                
-                
-                if target in ["interface_protein_dna", "interface_protein_rna"]:
-                    if os.path.exists(os.path.join(evaluation_dir,model,'raw', f"{target}_dockqv2.csv")):
-                        result_path_dockqv2 = os.path.join(evaluation_dir,model,'raw', f"{target}_dockqv2.csv")
-                        result_df_dockqv2 = pd.read_csv(result_path_dockqv2)
-                        result_df_dockqv2 = change_column_name(result_df_dockqv2)
-                        result_df_dockqv2 = find_overlap_sample(result_df_dockqv2,target_df)
-                        results[model][target]['dockq_score_success_rate']  = calculate_success_rate(result_df_dockqv2, 'dockq_score',metric_type)
-                        results[model][target]['irmsd'] = calculate_score_avg(result_df_dockqv2, 'irmsd',metric_type)
-                        results[model][target]['lrmsd'] = calculate_score_avg(result_df_dockqv2, 'lrmsd',metric_type)
-                else:
-                    results[model][target]['dockq_score_success_rate']  = calculate_success_rate(result_df, 'dockq_score',metric_type)
-                    results[model][target]['irmsd'] = calculate_score_avg(result_df, 'irmsd',metric_type)
-                    results[model][target]['lrmsd'] = calculate_score_avg(result_df, 'lrmsd',metric_type)
-
-            # Process pl interface: rmsd_lddt-pli success_rate,lddt-lp,lddt-pli
-            elif target in ["interface_protein_ligand"]:
-                results[model][target]['rmsd_lddt-pli_success_rate'] = calculate_success_rate(result_df, 'rmsd_lddt-pli',metric_type)
-                results[model][target]['lddt-lp'] = calculate_score_avg(result_df, 'lddt-lp',metric_type)
-                results[model][target]['lddt-pli'] = calculate_score_avg(result_df, 'lddt-pli',metric_type)
-
-            # Process monomer: gdt_ts,tm-score,rmsd,lddt
-            elif target in ["monomer_dna", "monomer_rna", "monomer_protein"]:
-                if 'gdt_ts' in result_df.columns:
-                    results[model][target]['gdt-ts'] = calculate_score_avg(result_df, 'gdt_ts',metric_type)
-                elif 'gdt-ts' in result_df.columns:
-                    results[model][target]['gdt-ts'] = calculate_score_avg(result_df, 'gdt-ts',metric_type)
-                if 'tm-score' in result_df.columns:
-                    results[model][target]['tm-score'] = calculate_score_avg(result_df, 'tm-score',metric_type)
-                elif 'tm_score' in result_df.columns:
-                    results[model][target]['tm-score'] = calculate_score_avg(result_df, 'tm_score',metric_type)
-                
-                results[model][target]['rmsd'] = calculate_score_avg(result_df, 'rmsd',metric_type)
-                results[model][target]['lddt'] = calculate_score_avg(result_df, 'lddt',metric_type)
+
+            signature = [
+                file_signature(result_path),
+                file_signature(os.path.join(evaluation_dir,model,'raw', f"{target}_dockqv2.csv")),
+                file_signature(os.path.join(target_dir, f"{target}.csv")),
+            ]
+            cache_key = f'{target}|{metric_type}'
+            if cache_key in cache and cache[cache_key]['signature'] == signature:
+                results[model][target] = cache[cache_key]['metrics']
+                continue
+
+            results[model][target] = summarize_target(evaluation_dir, target_dir, model, target, metric_type)
+            cache[cache_key] = {'signature': signature, 'metrics': results[model][target]}
+            cache_changed = True
+
+        if cache_changed:
+            with open(cache_path, 'w') as f:
+                json.dump(cache, f, indent=2, default=float)
         
     return results
 
@@ -213,6 +322,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "--metric_type", required=False, default= "rank", help="rank or best",
     )
+    parser.add_argument(
+        "--n_bootstrap", required=False, default=0, type=int, help="bootstrap resamples for confidence intervals and paired tests, 0 to disable",
+    )
+    parser.add_argument(
+        "--alpha", required=False, default=0.05, type=float, help="confidence intervals are (1 - alpha)",
+    )
     args = parser.parse_args()
     results = process_csv_files(args.evaluation_dir,args.target_dir,args.output_path,args.algorithm_names,args.targets,args.metric_type)
     
@@ -279,3 +394,27 @@ if __name__ == "__main__":
             print(metric_str)
     
     print("\n" + "=" * 80)
+
+    if args.n_bootstrap > 0:
+        values = {
+            model: {
+                target: summarize_target_values(args.evaluation_dir, args.target_dir, model, target, args.metric_type)
+                for target in results[model]
+            }
+            for model in args.algorithm_names
+        }
+        metrics = {target: list(target_metrics_summary[target].keys()) for target in args.targets}
+        intervals_df, paired_df = bootstrap_summary(
+            values, args.algorithm_names, metrics, metric_scale, n_boot=args.n_bootstrap, alpha=args.alpha,
+        )
+        output_stem = os.path.splitext(args.output_path)[0]
+        intervals_df.to_csv(f'{output_stem}_bootstrap.csv', index=False)
+        paired_df.to_csv(f'{output_stem}_paired.csv', index=False)
+
+        print(f"\nBootstrap ({args.n_bootstrap} resamples, {100 * (1 - args.alpha):.0f}% CI):")
+        for _, row in intervals_df.iterrows():
+            print(f"{row['target']:<30}{row['metric']:<30}{row['model']:<15}"
+                  f"{row['estimate']:8.2f} [{row['ci_low']:.2f}, {row['ci_high']:.2f}]")
+        for _, row in paired_df.iterrows():
+            print(f"{row['target']:<30}{row['metric']:<30}{row['model_a']} - {row['model_b']}: "
+                  f"{row['diff']:.2f} [{row['ci_low']:.2f}, {row['ci_high']:.2f}] p={row['p_value']:.3g}")